@@ -0,0 +1,386 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timedelta
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, lit, udf
+from pyspark.sql.types import TimestampType
+
+from compact import compact_song_data, read_compacted
+from etl import add_songplay_id, add_time_columns, latest_users
+from manifest import filter_condition, may_match, read_manifest, read_table
+from schemas import LOG_SCHEMA, SONG_SCHEMA, read_json
+from writers import table_path, write_table
+
+TIME_COLUMNS = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def create_local_spark_session(cores):
+    """
+    Creates a local mode SparkSession for benchmarking on the bundled data
+
+    :params cores: Number of local cores
+    :return SparkSession
+    """
+    return SparkSession \
+        .builder \
+        .master('local[{}]'.format(cores)) \
+        .appName('sparkify-benchmark') \
+        .getOrCreate()
+
+
+def add_time_columns_udf(df):
+    """
+    The time dimension columns as built before add_time_columns, with Python UDFs returning strings
+
+    :params df: Log data with ts in epoch milliseconds
+    :return DataFrame with start_time, hour, day, week, month, year and weekday columns
+    """
+    get_datetime = udf(lambda x: datetime.fromtimestamp(int(int(x) / 1000)), TimestampType())
+    get_weekday = udf(lambda x: x.weekday())
+    get_week = udf(lambda x: datetime.isocalendar(x)[1])
+    get_hour = udf(lambda x: x.hour)
+    get_day = udf(lambda x: x.day)
+    get_year = udf(lambda x: x.year)
+    get_month = udf(lambda x: x.month)
+
+    df = df.withColumn('start_time', get_datetime(df.ts))
+    df = df.withColumn('hour', get_hour(df.start_time))
+    df = df.withColumn('day', get_day(df.start_time))
+    df = df.withColumn('week', get_week(df.start_time))
+    df = df.withColumn('month', get_month(df.start_time))
+    df = df.withColumn('year', get_year(df.start_time))
+    df = df.withColumn('weekday', get_weekday(df.start_time))
+    return df
+
+
+def time_table(df, builder):
+    """
+    Builds the time table the way process_log_data does
+
+    :params df: NextSong log data
+    :params builder: add_time_columns or add_time_columns_udf
+    :return Time table DataFrame
+    """
+    return builder(df)[TIME_COLUMNS].drop_duplicates(subset=['start_time'])
+
+
+def benchmark_time_table(spark, log_data, repeat, scale):
+    """
+    Times the time table built with the Python UDFs and with native functions, and checks both give the same rows
+
+    :params spark: SparkSession
+    :params log_data: Glob of the log data files
+    :params repeat: Timed runs per variant, the fastest is reported
+    :params scale: Number of copies of the log data, to measure on more rows than the bundled sample
+    :return None
+    """
+    df = spark.read.json(log_data).where(col('page') == 'NextSong')
+    base = df
+    for _ in range(scale - 1):
+        df = df.union(base)
+    df = df.cache()
+    rows = df.count()
+
+    print("{:<10} {:>10} {:>10}".format('variant', 'rows', 'seconds'))
+    for name, builder in [('udf', add_time_columns_udf), ('native', add_time_columns)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            time_table(df, builder).write.format('noop').mode('overwrite').save()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{:<10} {:>10} {:>10.3f}".format(name, rows, best))
+
+    legacy = time_table(df, add_time_columns_udf)
+    legacy = legacy.select('start_time', *[col(name).cast('int').alias(name) for name in TIME_COLUMNS[1:]])
+    native = time_table(df, add_time_columns)
+    differences = legacy.subtract(native).count() + native.subtract(legacy).count()
+    print("Rows differing between udf and native: {}".format(differences))
+
+
+def benchmark_json_read(spark, song_data, log_data, repeat):
+    """
+    Times reading the song and log JSON with schema inference and with the declared schemas
+
+    :params spark: SparkSession
+    :params song_data: Glob of the song data files
+    :params log_data: Glob of the log data files
+    :params repeat: Timed runs per variant, the fastest is reported
+    :return None
+    """
+    print("{:<10} {:<10} {:>10} {:>10}".format('dataset', 'schema', 'rows', 'seconds'))
+    for dataset, path, schema in [('song_data', song_data, SONG_SCHEMA), ('log_data', log_data, LOG_SCHEMA)]:
+        for name, declared in [('inferred', None), ('declared', schema)]:
+            best, rows = None, 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                reader = spark.read if declared is None else spark.read.schema(declared)
+                rows = reader.json(path).count()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("{:<10} {:<10} {:>10} {:>10.3f}".format(dataset, name, rows, best))
+
+
+def job_group_metrics(spark, job_group, timeout=10):
+    """
+    Sums the shuffle metrics of the stages of a job group from the Spark UI REST API
+    
+    :params spark: SparkSession
+    :params job_group: Job group set with setJobGroup before running the jobs
+    :params timeout: Seconds to wait for the UI to see the jobs finish
+    :return Dict with shuffle_read_bytes and shuffle_write_bytes
+    """
+    api = '{}/api/v1/applications/{}'.format(spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId)
+    deadline = time.time() + timeout
+    while True:
+        with urllib.request.urlopen(api + '/jobs') as response:
+            jobs = [job for job in json.load(response) if job.get('jobGroup') == job_group]
+        # the UI is updated from the listener bus asynchronously, wait until it has seen the jobs end
+        if all(job['status'] != 'RUNNING' for job in jobs) or time.time() > deadline:
+            break
+        time.sleep(0.2)
+
+    metrics = {'shuffle_read_bytes': 0, 'shuffle_write_bytes': 0}
+    for stage_id in {stage_id for job in jobs for stage_id in job['stageIds']}:
+        with urllib.request.urlopen('{}/stages/{}'.format(api, stage_id)) as response:
+            for attempt in json.load(response):
+                metrics['shuffle_read_bytes'] += attempt.get('shuffleReadBytes', 0)
+                metrics['shuffle_write_bytes'] += attempt.get('shuffleWriteBytes', 0)
+    return metrics
+
+
+def users_sorted(df):
+    """
+    The users table as built before latest_users, with a global sort followed by dropDuplicates
+    
+    :params df: NextSong log data
+    :return DataFrame with userId, firstName, lastName, gender and level
+    """
+    users_table = df['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']
+    return users_table.orderBy('ts', ascending=False).dropDuplicates(subset=['userId']).drop('ts')
+
+
+def benchmark_users(spark, log_data, repeat, scale):
+    """
+    Times the users table built with a global sort and with the per-user aggregation, reports the bytes each
+    shuffles and checks both give the same rows
+    
+    :params spark: SparkSession
+    :params log_data: Glob of the log data files
+    :params repeat: Timed runs per variant, the fastest is reported
+    :params scale: Number of copies of the log data, to measure on more rows than the bundled sample
+    :return None
+    """
+    df = spark.read.schema(LOG_SCHEMA).json(log_data).where(col('page') == 'NextSong')
+    base = df
+    for _ in range(scale - 1):
+        df = df.union(base)
+    df = df.cache()
+    rows = df.count()
+
+    print("{:<10} {:>10} {:>10} {:>15} {:>15}".format('variant', 'rows', 'seconds', 'shuffle write', 'shuffle read'))
+    for name, builder in [('sort', users_sorted), ('aggregate', latest_users)]:
+        best, metrics = None, None
+        for run in range(repeat):
+            job_group = 'users-{}-{}'.format(name, run)
+            spark.sparkContext.setJobGroup(job_group, job_group)
+            start = time.perf_counter()
+            builder(df).write.format('noop').mode('overwrite').save()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best, metrics = elapsed, job_group_metrics(spark, job_group)
+        print("{:<10} {:>10} {:>10.3f} {:>15} {:>15}".format(name, rows, best, metrics['shuffle_write_bytes'],
+                                                           metrics['shuffle_read_bytes']))
+    spark.sparkContext.setLocalProperty('spark.jobGroup.id', None)
+
+    sorted_users, aggregated_users = users_sorted(df), latest_users(df)
+    differences = sorted_users.subtract(aggregated_users).count() + aggregated_users.subtract(sorted_users).count()
+    print("Rows differing between sort and aggregate: {}".format(differences))
+
+
+def build_songplays_table(spark, log_data, months):
+    """
+    Builds a songplays table from all NextSong events, copied into consecutive months to get many partitions.
+    The song and artist ids are left empty, as the bundled songs match almost no events.
+    
+    :params spark: SparkSession
+    :params log_data: Glob of the log data files
+    :params months: Number of months, each a copy of the log data shifted by 30 days
+    :return Songplays DataFrame
+    """
+    df = spark.read.schema(LOG_SCHEMA).json(log_data).where(col('page') == 'NextSong')
+    base = df
+    for month in range(1, months):
+        df = df.union(base.withColumn('ts', col('ts') + month * 30 * DAY_MS))
+    df = add_songplay_id(add_time_columns(df))
+    return df.select('songplay_id', 'start_time', 'userId', 'level', lit(None).cast('string').alias('song_id'),
+                     lit(None).cast('string').alias('artist_id'), 'sessionId', 'location', 'userAgent', 'year',
+                     'month')
+
+
+def benchmark_pruning(spark, log_data, months, repeat, target_file_mb):
+    """
+    Compares filtered reads of a songplays table listing its directory with reads through its manifest,
+    which only opens the files whose partition values and statistics may match
+    
+    :params spark: SparkSession
+    :params log_data: Glob of the log data files
+    :params months: Number of months of data
+    :params repeat: Timed runs per variant, the fastest is reported
+    :params target_file_mb: Target size of the table's files, small to get many files from the sample
+    :return None
+    """
+    work_dir = tempfile.mkdtemp(prefix='sparkify_lake_')
+    try:
+        write_table(spark, build_songplays_table(spark, log_data, months), work_dir, 'songplays',
+                    target_file_mb=target_file_mb)
+        path = table_path(work_dir, 'songplays')
+        manifest = read_manifest(spark, path)
+        day = datetime(2018, 11, 15)
+        queries = [
+            ('one day', [('start_time', '>=', day), ('start_time', '<', day + timedelta(days=1))]),
+            ('one month', [('year', '=', 2018), ('month', '=', 11)]),
+            ('one user', [('userId', '=', '15')]),
+        ]
+
+        print("{:<10} {:<10} {:>8} {:>8} {:>10}".format('query', 'read', 'files', 'rows', 'seconds'))
+        for name, filters in queries:
+            files = sum(1 for entry in manifest['files'] if may_match(entry, filters))
+            for variant, reader in [('listing', lambda: spark.read.parquet(path).where(filter_condition(filters))),
+                                    ('manifest', lambda: read_table(spark, path, filters))]:
+                best, rows = None, 0
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    rows = reader().count()
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print("{:<10} {:<10} {:>8} {:>8} {:>10.3f}".format(
+                    name, variant, len(manifest['files']) if variant == 'listing' else files, rows, best))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def generate_song_files(song_data, target_dir, num_files):
+    """
+    Generates many single-record song files laid out like song_data/<A-Z>/<A-Z>/<A-Z>/<track>.json,
+    cycling through the sample songs with unique song ids
+
+    :params song_data: Glob of the sample song files
+    :params target_dir: Input root the song_data directory is created in
+    :params num_files: Number of files to generate
+    :return None
+    """
+    samples = []
+    for path in sorted(glob.glob(song_data)):
+        with open(path) as f:
+            samples.append(json.load(f))
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    for number in range(num_files):
+        record = dict(samples[number % len(samples)], song_id='SO{:016d}'.format(number))
+        directory = os.path.join(target_dir, 'song_data', letters[number % 26], letters[number // 26 % 26],
+                                 letters[number // 676 % 26])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'TR{:016d}.json'.format(number)), 'w') as f:
+            json.dump(record, f)
+
+
+def build_songs_table(df):
+    """
+    Builds the songs table the way process_song_data does and runs it without writing
+
+    :params df: Song data
+    :return None
+    """
+    songs_table = df['song_id', 'title', 'artist_id', 'artist_name', 'year', 'duration']
+    songs_table.drop_duplicates(subset=['song_id']).write.format('noop').mode('overwrite').save()
+
+
+def benchmark_compaction(spark, song_data, num_files, file_format):
+    """
+    Compares building the songs table from many tiny JSON files with compacting them first and
+    building it from the compacted files
+
+    :params spark: SparkSession
+    :params song_data: Glob of the sample song files
+    :params num_files: Number of tiny files to generate
+    :params file_format: Format of the compacted files, parquet or json
+    :return None
+    """
+    work_dir = tempfile.mkdtemp(prefix='sparkify_songs_')
+    try:
+        generate_song_files(song_data, work_dir, num_files)
+        compacted_path = os.path.join(work_dir, 'compacted')
+
+        start = time.perf_counter()
+        build_songs_table(read_json(spark, os.path.join(work_dir, 'song_data/*/*/*/*.json'), SONG_SCHEMA))
+        raw_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        manifest = compact_song_data(spark, work_dir, compacted_path, file_format)
+        compact_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        build_songs_table(read_compacted(spark, compacted_path))
+        compacted_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("{} tiny song files compacted into {} {} files".format(num_files, len(manifest['files']), file_format))
+    print("{:<30} {:>10}".format('step', 'seconds'))
+    print("{:<30} {:>10.3f}".format('songs from raw JSON', raw_seconds))
+    print("{:<30} {:>10.3f}".format('compaction', compact_seconds))
+    print("{:<30} {:>10.3f}".format('songs from compacted files', compacted_seconds))
+
+
+def main():
+    """
+    Benchmarks the Spark ETL in local mode on the bundled data/ logs
+
+    :params None
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify Spark ETL in local mode')
+    parser.add_argument('--song-data', default='data/song_data/*/*/*/*.json', help='Glob of the song data files')
+    parser.add_argument('--log-data', default='data/*-events.json', help='Glob of the log data files')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per variant')
+    parser.add_argument('--cores', default='*', help='Local cores')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    time_parser = subparsers.add_parser('time', help='Time table with Python UDFs against native functions')
+    time_parser.add_argument('--scale', type=int, default=1, help='Copies of the log data to process')
+    subparsers.add_parser('read', help='JSON reads with schema inference against declared schemas')
+    users_parser = subparsers.add_parser('users', help='Users table from a global sort against a per-user aggregation')
+    users_parser.add_argument('--scale', type=int, default=1, help='Copies of the log data to process')
+    prune_parser = subparsers.add_parser('prune', help='Filtered table reads listing the directory against the manifest')
+    prune_parser.add_argument('--months', type=int, default=24, help='Months of copies of the log data')
+    prune_parser.add_argument('--target-file-mb', type=float, default=0.05, help='Target size of the table files')
+    compact_parser = subparsers.add_parser('compact', help='Songs table from many tiny files against compacted files')
+    compact_parser.add_argument('--files', type=int, default=20000, help='Number of tiny song files to generate')
+    compact_parser.add_argument('--format', choices=['parquet', 'json'], default='parquet',
+                                help='Format of the compacted files')
+    args = parser.parse_args()
+
+    spark = create_local_spark_session(args.cores)
+    if args.benchmark == 'time':
+        benchmark_time_table(spark, args.log_data, args.repeat, args.scale)
+    elif args.benchmark == 'read':
+        benchmark_json_read(spark, args.song_data, args.log_data, args.repeat)
+    elif args.benchmark == 'users':
+        benchmark_users(spark, args.log_data, args.repeat, args.scale)
+    elif args.benchmark == 'prune':
+        benchmark_pruning(spark, args.log_data, args.months, args.repeat, args.target_file_mb)
+    elif args.benchmark == 'compact':
+        benchmark_compaction(spark, args.song_data, args.files, args.format)
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
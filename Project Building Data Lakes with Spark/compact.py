@@ -0,0 +1,105 @@
+import argparse
+import json
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+from filesystem import get_filesystem, read_text, write_text
+from incremental import list_input_files
+from schemas import SONG_SCHEMA
+
+MANIFEST_NAME = '_manifest.json'
+FILE_EXTENSIONS = {'parquet': '.parquet', 'json': '.json'}
+
+
+def input_summary(spark, path):
+    """
+    Number and total size of the files below a path
+
+    :params spark: SparkSession
+    :params path: Input directory
+    :return Tuple of (number of files, size in bytes)
+    """
+    fs, hadoop_path = get_filesystem(spark, path)
+    summary = fs.getContentSummary(hadoop_path)
+    return summary.getFileCount(), summary.getLength()
+
+
+def manifest_path(compacted_path):
+    """
+    Location of the manifest of a compacted dataset
+
+    :params compacted_path: Directory of the compacted dataset
+    :return Manifest path
+    """
+    return os.path.join(compacted_path, MANIFEST_NAME)
+
+
+def compact_song_data(spark, input_data, compacted_path, file_format='parquet', target_file_mb=128):
+    """
+    Packs the single-record song JSON files into a few large Parquet or JSON-lines files of about target_file_mb
+    and writes a manifest listing them
+
+    :params spark: SparkSession
+    :params input_data: Root of the input data, holding song_data
+    :params compacted_path: Directory the compacted files and manifest are written to
+    :params file_format: parquet or json
+    :params target_file_mb: Target size of a compacted file in MB, measured on the raw JSON
+    :return Manifest as a dict
+    """
+    source_files, source_bytes = input_summary(spark, os.path.join(input_data, 'song_data'))
+    num_files = max(1, math.ceil(source_bytes / (target_file_mb * 1024 * 1024)))
+
+    df = spark.read.schema(SONG_SCHEMA).json(os.path.join(input_data, 'song_data/*/*/*/*.json'))
+    df.repartition(num_files).write.format(file_format).save(compacted_path, mode='overwrite')
+
+    # counting the compacted files is cheap, unlike another pass over the source files
+    files = list_input_files(spark, compacted_path, FILE_EXTENSIONS[file_format])
+    records = spark.read.format(file_format).schema(SONG_SCHEMA).load(files).count() if files else 0
+    manifest = {'format': file_format, 'files': files, 'records': records, 'source_files': source_files,
+                'created_at': datetime.now(timezone.utc).isoformat()}
+    write_text(spark, manifest_path(compacted_path), json.dumps(manifest, indent=2))
+    return manifest
+
+
+def read_compacted(spark, compacted_path):
+    """
+    Reads a compacted dataset through its manifest, so only the listed files are opened and nothing is listed
+
+    :params spark: SparkSession
+    :params compacted_path: Directory of the compacted dataset
+    :return DataFrame with the song schema
+    """
+    manifest = json.loads(read_text(spark, manifest_path(compacted_path)))
+    return spark.read.format(manifest['format']).schema(SONG_SCHEMA).load(manifest['files'])
+
+
+def main():
+    """
+    Compacts the song data into a few large files that process_song_data can read with --compacted-songs
+
+    :params None
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Compact the Sparkify song JSON into a few large files')
+    parser.add_argument('--input-data', default='s3a://udacity-dend/', help='Root of the input data')
+    parser.add_argument('--output', default='output/_compacted/song_data', help='Directory of the compacted files')
+    parser.add_argument('--format', choices=['parquet', 'json'], default='parquet', help='Format of the files')
+    parser.add_argument('--target-file-mb', type=int, default=128, help='Target size of a file')
+    parser.add_argument('--s3-endpoint', help='URL of an S3 stand-in like MinIO for s3a:// paths, AWS if not given')
+    args = parser.parse_args()
+
+    from etl import create_spark_session
+    from storage import storage_settings
+
+    spark = create_spark_session(storage_settings([args.input_data, args.output], args.s3_endpoint))
+    start = time.perf_counter()
+    manifest = compact_song_data(spark, args.input_data, args.output, args.format, args.target_file_mb)
+    print("{} song files -> {} {} files with {} records in {:.2f}s, manifest {}".format(
+        manifest['source_files'], len(manifest['files']), manifest['format'], manifest['records'],
+        time.perf_counter() - start, manifest_path(args.output)))
+
+
+if __name__ == "__main__":
+    main()
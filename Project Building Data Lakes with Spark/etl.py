@@ -1,133 +1,294 @@
-import configparser
-from datetime import datetime
+import argparse
 import os
+from contextlib import nullcontext
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.functions import monotonically_increasing_id
+from pyspark.sql.functions import broadcast, col, concat_ws, floor, from_unixtime, md5, struct
+from pyspark.sql.functions import max as spark_max
+from pyspark.sql.functions import year, month, dayofmonth, dayofweek, hour, weekofyear
 from pyspark.sql.types import TimestampType
+from compact import read_compacted
+from incremental import list_input_files, merge_partitions, merge_users, read_state, write_state
+from manifest import read_table
+from metrics import StageMetricsCollector
+from schemas import LOG_SCHEMA, SONG_SCHEMA, read_json
+from storage import storage_settings
+from tuning import list_profiles, load_profile
+from writers import TARGET_FILE_MB, table_path, write_table
 
 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
+SONG_LOOKUP_COLUMNS = ['song_id', 'artist_id', 'title', 'artist_name', 'duration']
 
-os.environ['AWS_ACCESS_KEY_ID']=config["CREDENTIALS"]['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config["CREDENTIALS"]['AWS_SECRET_ACCESS_KEY']
+USER_COLUMNS = ['firstName', 'lastName', 'gender', 'level']
 
+# A user's session plays one item at a time, so these identify a songplay
+SONGPLAY_KEY_COLUMNS = ['userId', 'sessionId', 'ts', 'itemInSession']
 
-def create_spark_session():
+# Song lookups up to this many rows are broadcast to the executors instead of shuffled for the songplays join
+BROADCAST_MAX_ROWS = 1000000
+
+
+def create_spark_session(settings=None):
     """
     Creates the SparkSession
     If SparkSession exists, returns SparkSession
     
-    :params None
+    :params settings: Spark settings, e.g. of a tuning profile and storage_settings
     """
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+    builder = SparkSession.builder
+    for key, value in (settings or {}).items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def add_time_columns(df):
+    """
+    Adds start_time and its time dimension columns to the log data with native Spark SQL functions,
+    which run in the JVM and keep integer types
+    
+    :params df: Log data with ts in epoch milliseconds
+    :return DataFrame with start_time, hour, day, week, month, year and weekday columns
+    """
+    df = df.withColumn('start_time', from_unixtime(floor(col('ts') / 1000)).cast(TimestampType()))
+    df = df.withColumn('hour', hour('start_time'))
+    df = df.withColumn('day', dayofmonth('start_time'))
+    df = df.withColumn('week', weekofyear('start_time'))
+    df = df.withColumn('month', month('start_time'))
+    df = df.withColumn('year', year('start_time'))
+    # dayofweek counts from Sunday = 1, weekday from Monday = 0 like datetime.weekday()
+    df = df.withColumn('weekday', (dayofweek('start_time') + 5) % 7)
+    return df
+
+
+def latest_users(df):
+    """
+    Builds the users table from each user's latest event with a partial aggregation per userId instead of a global
+    sort. The maximum of a struct starting with ts picks the latest event, and ties on ts are broken by the
+    remaining fields, so the result does not depend on partitioning.
+    
+    :params df: NextSong log data
+    :return DataFrame with userId, firstName, lastName, gender and level
+    """
+    latest = df.groupBy('userId').agg(spark_max(struct('ts', *USER_COLUMNS)).alias('latest'))
+    return latest.select('userId', *['latest.{}'.format(name) for name in USER_COLUMNS])
+
+
+def add_songplay_id(df):
+    """
+    Adds songplay_id as the MD5 of the event's user, session, timestamp and item in session. Unlike
+    monotonically_increasing_id it does not depend on partitioning, so reruns and incremental runs give an event
+    the same id, and it is computed on the executors without collecting anything.
+    
+    :params df: NextSong log data
+    :return DataFrame with a songplay_id column
+    """
+    key = concat_ws('|', *[col(name).cast('string') for name in SONGPLAY_KEY_COLUMNS])
+    return df.withColumn('songplay_id', md5(key))
+
+
+def read_song_lookup(spark, output_data):
+    """
+    Reads the song lookup back from the songs table in the lake, for when the log stage runs on its own
+    
+    :params spark: SparkSession
+    :params output_data: path the tables were written to
+    :return Cached DataFrame with song_id, artist_id, title, artist_name and duration
+    """
+    return read_table(spark, table_path(output_data, 'songs'))[SONG_LOOKUP_COLUMNS].cache()
+
+
+def join_song_lookup(df, song_df, broadcast_max_rows=BROADCAST_MAX_ROWS):
+    """
+    Matches the log events to songs on title, artist name and duration.
+    The lookup is broadcast when it is small enough, which avoids shuffling the log data.
+    
+    :params df: NextSong log data
+    :params song_df: Cached song lookup
+    :params broadcast_max_rows: Largest lookup that is broadcast
+    :return Joined DataFrame
+    """
+    if song_df.count() <= broadcast_max_rows:
+        song_df = broadcast(song_df)
+    return df.join(song_df, (song_df.title == df.song) & (song_df.artist_name == df.artist)
+                   & (song_df.duration == df.length))
+
+
+def quarantine_path(output_data, dataset, strict):
+    """
+    Where malformed records of a dataset are written in strict mode
+    
+    :params output_data: Root of the lake
+    :params dataset: song_data or log_data
+    :params strict: Whether malformed records are quarantined
+    :return Quarantine path, or None when not strict
+    """
+    return os.path.join(output_data, '_quarantine', dataset) if strict else None
+
+
+def process_song_data(spark, input_data, output_data, target_file_mb=TARGET_FILE_MB, strict=False, compacted_path=None):
     """
     Reads data from S3 to Local directory
     Creates Required dimension tables
     
     :params spark: SparkSession
     :params input_data: path to file in s3
-    :return None
+    :params target_file_mb: Target size of the written files in MB
+    :params strict: Quarantine malformed records below output_data/_quarantine instead of reading them as nulls
+    :params compacted_path: Read the song data compacted by compact.py from there instead of the raw JSON files
+    :return Cached song lookup, shared with process_log_data for the songplays join
     """
 
     # get filepath to song data file
     song_data = os.path.join(input_data,"song_data/*/*/*/*.json")
     
     # read song data file
-    df = spark.read.json(song_data)
+    if compacted_path:
+        df = read_compacted(spark, compacted_path)
+    else:
+        df = read_json(spark, song_data, SONG_SCHEMA, quarantine_path(output_data, 'song_data', strict))
     
     # extract columns to create songs table
     songs_table = df['song_id', 'title', 'artist_id','artist_name', 'year', 'duration']
     songs_table = songs_table.drop_duplicates(subset=['song_id'])
     
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id').parquet(os.path.join(output_data, 'songs.parquet'), 'overwrite')
+    # write songs table to parquet files partitioned by year
+    write_table(spark, songs_table, output_data, 'songs', target_file_mb=target_file_mb)
     
     # extract columns to create artists table
     artists_table = df['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']
     artists_table = artists_table.drop_duplicates(subset=['artist_id'])
     
     # write artists table to parquet files
-    artists_table.write.parquet(os.path.join(output_data, 'artists.parquet'), 'overwrite')
+    write_table(spark, artists_table, output_data, 'artists', target_file_mb=target_file_mb)
 
+    # keep the columns the songplays join needs in memory
+    return songs_table[SONG_LOOKUP_COLUMNS].cache()
 
-def process_log_data(spark, input_data, output_data):
+
+def process_log_data(spark, input_data, output_data, song_df=None, target_file_mb=TARGET_FILE_MB, log_paths=None,
+                     strict=False):
     """
     Reads data from S3 to Local directory
     Creates Required dimension tables
+    With log_paths only those log files are read and merged into the existing tables: users are merged on userId,
+    time and songplays replace only the year/month partitions the new events fall into.
     
     :params spark: SparkSession
     :params input_data: path to file in s3
+    :params song_df: Song lookup returned by process_song_data, read back from output_data if not given
+    :params target_file_mb: Target size of the written files in MB
+    :params log_paths: Log files to merge incrementally, all log data is reloaded if not given
+    :params strict: Quarantine malformed records below output_data/_quarantine instead of reading them as nulls
     :return None
     """
     
     # get filepath to log data file
-    log_data =os.path.join(input_data,"log_data/*/*/*.json")
+    log_data = log_paths if log_paths is not None else os.path.join(input_data,"log_data/*/*/*.json")
 
     # read log data file
-    df = spark.read.json(log_data)
+    df = read_json(spark, log_data, LOG_SCHEMA, quarantine_path(output_data, 'log_data', strict))
     
     # filter by actions for song plays
     df= df.where(col("page")=="NextSong")
    
     # extract columns for users table 
     # user_id, first_name, last_name, gender, level
-    users_table = df['userId', 'firstName', 'lastName', 'gender', 'level','ts']
-    users_table = users_table.orderBy("ts",ascending=False).dropDuplicates(subset=["userId"]).drop('ts')
-    
-    # write users table to parquet files
-    users_table.write.parquet(os.path.join(output_data, 'users.parquet'), 'overwrite')
-    
-    # create datetime column from original timestamp column
-    #define udfs
-    get_datetime = udf(lambda x: datetime.fromtimestamp(int(int(x)/1000)), TimestampType())
-    get_weekday = udf(lambda x: x.weekday())
-    get_week = udf(lambda x: datetime.isocalendar(x)[1])
-    get_hour = udf(lambda x: x.hour)
-    get_day = udf(lambda x : x.day)
-    get_year = udf(lambda x: x.year)
-    get_month = udf(lambda x: x.month)
-    
-    #applu udfs
-    df = df.withColumn('start_time', get_datetime(df.ts))
-    df = df.withColumn('hour', get_hour(df.start_time))
-    df = df.withColumn('day', get_day(df.start_time))
-    df = df.withColumn('week', get_week(df.start_time))
-    df = df.withColumn('month', get_month(df.start_time))
-    df = df.withColumn('year', get_year(df.start_time))
-    df = df.withColumn('weekday', get_weekday(df.start_time))
+    users_table = latest_users(df)
+    
+    # write users table to parquet files, merged with the existing users in incremental mode
+    if log_paths is not None:
+        users_table, changed = merge_users(spark, users_table, output_data)
+        print("users: {} new or changed".format(changed))
+    if users_table is not None:
+        write_table(spark, users_table, output_data, 'users', target_file_mb=target_file_mb)
+    overwrite_mode = 'dynamic' if log_paths is not None else 'static'
+    
+    # create datetime column from original timestamp column and the time dimension columns
+    df = add_time_columns(df)
     time_table  = df['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
     time_table = time_table.drop_duplicates(subset=['start_time'])
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'time.parquet'), 'overwrite')
+    if log_paths is not None:
+        time_table = merge_partitions(spark, time_table, output_data, 'time', ['start_time'])
+    write_table(spark, time_table, output_data, 'time', target_file_mb=target_file_mb, overwrite_mode=overwrite_mode)
 
-    # read in song data to use for songplays table
-    song_df = spark.read.parquet("output/songs.parquet")
+    # read in song data to use for songplays table when the song stage did not run in this session
+    if song_df is None:
+        song_df = read_song_lookup(spark, output_data)
 
     # extract columns from joined song and log datasets to create songplays table 
-    df = df.join(song_df, (song_df.title == df.song) & (song_df.artist_name == df.artist))
-    df = df.withColumn('songplay_id', monotonically_increasing_id()) 
-    songplays_table = df['songplay_id','start_time', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent']
+    df = join_song_lookup(df, song_df)
+    df = add_songplay_id(df)
+    songplays_table = df['songplay_id','start_time', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent',
+                         'year', 'month']
     
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.parquet(os.path.join(output_data, 'songplays.parquet'), 'overwrite')
+    if log_paths is not None:
+        songplays_table = merge_partitions(spark, songplays_table, output_data, 'songplays', ['songplay_id'])
+    write_table(spark, songplays_table, output_data, 'songplays', target_file_mb=target_file_mb,
+                overwrite_mode=overwrite_mode)
+
+
 def main():
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "output"
+    """
+    Runs the song and log stages, by default both in one session sharing the song lookup
+    
+    :params None
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify data lake')
+    parser.add_argument('--stage', choices=['all', 'songs', 'logs'], default='all',
+                        help='Run both stages or only one, logs reads the song lookup back from the lake')
+    parser.add_argument('--target-file-mb', type=int, default=TARGET_FILE_MB, help='Target size of the written files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only merge the log files not processed by earlier runs, listed in the state file')
+    parser.add_argument('--state-file', default='etl_state.json', help='Processed input paths of incremental runs')
+    parser.add_argument('--strict', action='store_true', help='Quarantine malformed JSON records instead of nulls')
+    parser.add_argument('--compacted-songs', help='Read the song data compacted by compact.py from this directory')
+    parser.add_argument('--input-data', default='s3a://udacity-dend/', help='Root of the song_data and log_data')
+    parser.add_argument('--output-data', default='output', help='Root of the lake')
+    parser.add_argument('--s3-endpoint', help='URL of an S3 stand-in like MinIO for s3a:// paths, AWS if not given')
+    parser.add_argument('--profile', choices=list_profiles(),
+                        help='Tuning profile of dl.cfg to apply, Spark defaults if not given')
+    parser.add_argument('--metrics-report',
+                        help='Write the duration, shuffle and spill of the stages of every step to this JSON file')
+    args = parser.parse_args()
+
+    input_data = args.input_data
+    output_data = args.output_data
+    profile_settings = load_profile(args.profile) if args.profile else {}
+    spark = create_spark_session(dict(profile_settings, **storage_settings([input_data, output_data],
+                                                                           args.s3_endpoint, args.incremental)))
 
-    process_song_data(spark, input_data, output_data) 
-    process_log_data(spark, input_data, output_data)
+    collector = StageMetricsCollector(spark) if args.metrics_report else None
+    measure = collector.measure if collector else lambda step: nullcontext()
+    try:
+        song_df = None
+        if args.stage in ('all', 'songs'):
+            with measure('process_song_data'):
+                song_df = process_song_data(spark, input_data, output_data, args.target_file_mb, args.strict,
+                                            args.compacted_songs)
+        if args.stage in ('all', 'logs'):
+            if not args.incremental:
+                with measure('process_log_data'):
+                    process_log_data(spark, input_data, output_data, song_df, args.target_file_mb, strict=args.strict)
+                return
+            state = read_state(args.state_file)
+            log_files = list_input_files(spark, os.path.join(input_data, 'log_data'))
+            new_files = [path for path in log_files if path not in state.get('log_data', set())]
+            if not new_files:
+                print("No new log files")
+                return
+            print("Merging {} new log files".format(len(new_files)))
+            with measure('process_log_data'):
+                process_log_data(spark, input_data, output_data, song_df, args.target_file_mb, new_files, args.strict)
+            state['log_data'] = state.get('log_data', set()) | set(new_files)
+            write_state(args.state_file, state)
+    finally:
+        if collector:
+            collector.write_report(args.metrics_report, dict(profile_settings, profile=args.profile))
+            print("Stage metrics written to {}".format(args.metrics_report))
 
 
 if __name__ == "__main__":
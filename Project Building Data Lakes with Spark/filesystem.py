@@ -0,0 +1,54 @@
+def get_filesystem(spark, path):
+    """
+    Hadoop FileSystem of a path, so listing works the same for local paths, HDFS and S3
+
+    :params spark: SparkSession
+    :params path: Path or URI
+    :return Tuple of (FileSystem, Hadoop Path)
+    """
+    hadoop_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def path_exists(spark, path):
+    """
+    Checks whether a path exists
+
+    :params spark: SparkSession
+    :params path: Path or URI
+    :return True if it exists
+    """
+    fs, hadoop_path = get_filesystem(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def read_text(spark, path):
+    """
+    Reads a small text file from any file system Spark can reach
+
+    :params spark: SparkSession
+    :params path: Path or URI of the file
+    :return Content as a string
+    """
+    # Spark file sources skip files starting with an underscore like manifests, so read it directly
+    fs, hadoop_path = get_filesystem(spark, path)
+    stream = fs.open(hadoop_path)
+    try:
+        return spark.sparkContext._jvm.org.apache.commons.io.IOUtils.toString(stream, 'UTF-8')
+    finally:
+        stream.close()
+
+
+def write_text(spark, path, text):
+    """
+    Writes a small text file to any file system Spark can reach
+
+    :params spark: SparkSession
+    :params path: Path or URI of the file
+    :params text: Content
+    :return None
+    """
+    fs, hadoop_path = get_filesystem(spark, path)
+    stream = fs.create(hadoop_path, True)
+    stream.write(bytearray(text.encode('utf-8')))
+    stream.close()
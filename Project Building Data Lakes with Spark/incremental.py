@@ -0,0 +1,108 @@
+import json
+import os
+
+from filesystem import get_filesystem, path_exists
+from writers import TABLE_PARTITIONS, table_path
+
+
+def list_input_files(spark, path, suffix='.json'):
+    """
+    Lists all input files below a path
+
+    :params spark: SparkSession
+    :params path: Input directory, e.g. input_data/log_data
+    :params suffix: Suffix of the files to list
+    :return Sorted list of file URIs
+    """
+    if not path_exists(spark, path):
+        return []
+    fs, hadoop_path = get_filesystem(spark, path)
+    files = []
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        file_path = iterator.next().getPath().toString()
+        if file_path.endswith(suffix):
+            files.append(file_path)
+    return sorted(files)
+
+
+def table_exists(spark, path):
+    """
+    Checks whether a table has data files, a write of no rows leaves only the _SUCCESS marker
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :return True if the table has Parquet files
+    """
+    return len(list_input_files(spark, path, '.parquet')) > 0
+
+
+def read_state(state_file):
+    """
+    Reads the input paths processed by earlier incremental runs
+
+    :params state_file: Path of the JSON state file
+    :return Dict mapping dataset name to the set of processed paths
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return {dataset: set(paths) for dataset, paths in json.load(f).items()}
+
+
+def write_state(state_file, state):
+    """
+    Records the processed input paths, written after all tables of a run are written
+
+    :params state_file: Path of the JSON state file
+    :params state: Dict mapping dataset name to the set of processed paths
+    :return None
+    """
+    directory = os.path.dirname(os.path.abspath(state_file))
+    os.makedirs(directory, exist_ok=True)
+    with open(state_file, 'w') as f:
+        json.dump({dataset: sorted(paths) for dataset, paths in state.items()}, f, indent=2)
+
+
+def merge_partitions(spark, new_df, output_data, table, keys):
+    """
+    Merges new rows into the partitions of a table they fall into. Written with dynamic partition overwrite,
+    only those partitions are replaced, so they need their existing rows too. Existing rows with the key of a new
+    row are replaced by it. The result is checkpointed, as the table is overwritten while being read.
+
+    :params spark: SparkSession
+    :params new_df: New rows of the table
+    :params output_data: Root of the lake
+    :params table: Table name
+    :params keys: Columns identifying a row
+    :return DataFrame with all rows of the affected partitions
+    """
+    path = table_path(output_data, table)
+    if not table_exists(spark, path):
+        return new_df
+    partition_by = TABLE_PARTITIONS[table]
+    existing = spark.read.parquet(path).join(new_df.select(*partition_by).distinct(), partition_by, 'left_semi')
+    existing = existing.join(new_df.select(*keys), keys, 'left_anti')
+    return existing.unionByName(new_df).localCheckpoint()
+
+
+def merge_users(spark, users_table, output_data):
+    """
+    Merges the latest user rows of new log data into the users table, keeping only rows that are new or changed
+
+    :params spark: SparkSession
+    :params users_table: Latest row per user of the new log data
+    :params output_data: Root of the lake
+    :return Tuple of (merged users table or None if nothing changed, number of new or changed users)
+    """
+    path = table_path(output_data, 'users')
+    if not table_exists(spark, path):
+        return users_table, users_table.count()
+    existing = spark.read.parquet(path)
+    # one row per user on both sides, so the set difference is exact
+    changed = users_table.select(*existing.columns).subtract(existing).cache()
+    changed_count = changed.count()
+    if changed_count == 0:
+        return None, 0
+    merged = existing.join(changed.select('userId'), 'userId', 'left_anti').unionByName(changed)
+    return merged.localCheckpoint(), changed_count
@@ -0,0 +1,338 @@
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+import pyarrow.parquet as pq
+from pyspark.sql.functions import col
+from pyspark.sql.types import StructType
+
+from filesystem import get_filesystem, path_exists, read_text, write_text
+
+MANIFEST_NAME = '_lake_manifest.json'
+
+# Columns with min/max statistics per file, the ones queries filter on besides the partition columns
+TABLE_STATS_COLUMNS = {
+    'songs': ['song_id', 'artist_id'],
+    'artists': ['artist_id'],
+    'users': ['userId'],
+    'time': ['start_time'],
+    'songplays': ['start_time', 'userId'],
+}
+
+FILTER_OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'in']
+
+# Above this fraction of matching files the whole table is read instead of the single files
+MAX_PRUNED_FRACTION = 0.5
+
+
+def table_manifest_path(path):
+    """
+    Location of the manifest of a table, Spark readers skip it as it starts with an underscore
+
+    :params path: Path of the table
+    :return Manifest path
+    """
+    return os.path.join(path, MANIFEST_NAME)
+
+
+def read_manifest(spark, path):
+    """
+    Reads the manifest of a table
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :return Manifest as a dict, or None if the table has none
+    """
+    manifest_file = table_manifest_path(path)
+    if not path_exists(spark, manifest_file):
+        return None
+    return json.loads(read_text(spark, manifest_file))
+
+
+def to_json_value(value):
+    """
+    Converts a statistic to a JSON value, timestamps as ISO strings which compare like the timestamps
+
+    :params value: Value of a Row
+    :return JSON serializable value
+    """
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        # footers hold UTC, Spark gives and takes timestamps in local time
+        value = value.astimezone().replace(tzinfo=None)
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def partition_values(relative_path):
+    """
+    Partition values of a file from its directory names, e.g. year=2018/month=11
+
+    :params relative_path: Path of the file relative to the table
+    :return Dict of partition column to value, integers where the value is one
+    """
+    values = {}
+    for directory in relative_path.split('/')[:-1]:
+        name, _, value = directory.partition('=')
+        values[name] = int(value) if value.lstrip('-').isdigit() else value
+    return values
+
+
+class HadoopInputFile(io.RawIOBase):
+    """
+    Seekable file over a Hadoop input stream, so pyarrow reads the Parquet footer from any file system Spark can
+    reach, fetching only the bytes it asks for
+    """
+
+    def __init__(self, spark, path):
+        fs, hadoop_path = get_filesystem(spark, path)
+        self.jvm = spark.sparkContext._jvm
+        self.size = fs.getFileStatus(hadoop_path).getLen()
+        self.stream = fs.open(hadoop_path)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def read(self, size=-1):
+        size = self.size - self.position if size is None or size < 0 else min(size, self.size - self.position)
+        if size <= 0:
+            return b''
+        self.stream.seek(self.position)
+        data = bytes(self.jvm.org.apache.commons.io.IOUtils.toByteArray(self.stream, size))
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super().close()
+
+
+def footer_stats(metadata, stats_columns):
+    """
+    Row count and min/max of the statistics columns of a file from its Parquet footer, combined over its row
+    groups. Columns without statistics in a row group holding values get no range.
+
+    :params metadata: FileMetaData of the file
+    :params stats_columns: Columns to collect min/max for
+    :return Tuple of (rows, dict of column to [min, max])
+    """
+    ranges = {name: [None, None] for name in stats_columns}
+    unknown = set()
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        for position in range(row_group.num_columns):
+            chunk = row_group.column(position)
+            name = chunk.path_in_schema
+            if name not in ranges:
+                continue
+            statistics = chunk.statistics
+            if statistics is None or not statistics.has_min_max:
+                # a row group of nulls only has nothing to add
+                if statistics is None or statistics.null_count != row_group.num_rows:
+                    unknown.add(name)
+                continue
+            low, high = ranges[name]
+            ranges[name] = [statistics.min if low is None else min(low, statistics.min),
+                            statistics.max if high is None else max(high, statistics.max)]
+    return metadata.num_rows, {name: [None, None] if name in unknown else [to_json_value(value) for value in bounds]
+                               for name, bounds in ranges.items()}
+
+
+def file_stats(spark, files, stats_columns):
+    """
+    Row count and min/max of the statistics columns of each file, read from the Parquet footers only, the rows
+    are not scanned
+
+    :params spark: SparkSession
+    :params files: Full paths of the files
+    :params stats_columns: Columns to collect min/max for
+    :return Dict of full file path to (rows, dict of column to [min, max])
+    """
+    stats = {}
+    for file_path in files:
+        with HadoopInputFile(spark, file_path) as source:
+            stats[file_path] = footer_stats(pq.ParquetFile(source).metadata, stats_columns)
+    return stats
+
+
+def update_manifest(spark, path, table, partition_by, schema, files):
+    """
+    Writes the manifest of a table after a write: the schema, and per file its size, partition values, row count
+    and the min/max of the table's statistics columns. Statistics are only computed for files that are not in the
+    previous manifest, so a dynamic partition overwrite only reads the footers of the files it wrote.
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :params table: Table name
+    :params partition_by: Partition columns
+    :params schema: Schema of the table as written
+    :params files: Listing of the table's files as returned by list_table_files
+    :return Manifest as a dict
+    """
+    # reading a partitioned table gives the partition columns last
+    schema = StructType([field for field in schema.fields if field.name not in partition_by]
+                        + [schema[name] for name in partition_by])
+    fs, hadoop_path = get_filesystem(spark, path)
+    root = fs.makeQualified(hadoop_path).toString().rstrip('/') + '/'
+    previous = read_manifest(spark, path) or {}
+    known = {entry['path']: entry for entry in previous.get('files', [])}
+
+    stats_columns = [name for name in TABLE_STATS_COLUMNS.get(table, []) if name in schema.fieldNames()]
+    new_files = [file_path for file_path, _, _ in files if file_path[len(root):] not in known]
+    stats = file_stats(spark, new_files, stats_columns) if new_files else {}
+
+    entries = []
+    for file_path, _, size in files:
+        relative_path = file_path[len(root):]
+        if relative_path in known:
+            entries.append(known[relative_path])
+            continue
+        rows, columns = stats.get(file_path, (0, {}))
+        entries.append({'path': relative_path, 'bytes': size, 'rows': rows,
+                        'partition': partition_values(relative_path), 'stats': columns})
+
+    manifest = {'table': table, 'partition_by': partition_by, 'schema': schema.jsonValue(),
+                'updated_at': datetime.now(timezone.utc).isoformat(), 'files': entries}
+    write_text(spark, table_manifest_path(path), json.dumps(manifest, indent=2))
+    return manifest
+
+
+def value_range(entry, name):
+    """
+    Smallest and largest value of a column in a file, from its partition value or statistics
+
+    :params entry: File entry of the manifest
+    :params name: Column name
+    :return [min, max], or None if the manifest has nothing on the column
+    """
+    if name in entry['partition']:
+        return [entry['partition'][name]] * 2
+    return entry['stats'].get(name)
+
+
+def may_match(entry, filters):
+    """
+    Checks whether a file may hold rows matching all filters, files are only ruled out when their
+    value range excludes a filter
+
+    :params entry: File entry of the manifest
+    :params filters: List of (column, operator, value) tuples
+    :return False if no row of the file can match
+    """
+    for name, operator, value in filters:
+        bounds = value_range(entry, name)
+        if bounds is None or bounds[0] is None:
+            continue
+        low, high = bounds
+        values = [to_json_value(item) for item in value] if operator == 'in' else [to_json_value(value)]
+        if operator == '=' and not low <= values[0] <= high:
+            return False
+        if operator == '!=' and low == high == values[0]:
+            return False
+        if operator == '<' and not low < values[0]:
+            return False
+        if operator == '<=' and not low <= values[0]:
+            return False
+        if operator == '>' and not high > values[0]:
+            return False
+        if operator == '>=' and not high >= values[0]:
+            return False
+        if operator == 'in' and not any(low <= item <= high for item in values):
+            return False
+    return True
+
+
+def filter_condition(filters):
+    """
+    Spark condition of all filters
+
+    :params filters: List of (column, operator, value) tuples
+    :return Column
+    """
+    conditions = []
+    for name, operator, value in filters:
+        if operator not in FILTER_OPERATORS:
+            raise ValueError("Unknown filter operator {}, use one of {}".format(operator, ', '.join(FILTER_OPERATORS)))
+        column = col(name)
+        conditions.append({
+            '=': lambda: column == value,
+            '!=': lambda: column != value,
+            '<': lambda: column < value,
+            '<=': lambda: column <= value,
+            '>': lambda: column > value,
+            '>=': lambda: column >= value,
+            'in': lambda: column.isin(list(value)),
+        }[operator]())
+    condition = conditions[0]
+    for other in conditions[1:]:
+        condition = condition & other
+    return condition
+
+
+def pruned_paths(path, manifest, filters):
+    """
+    Paths to read for the filters: partition directories of which every file may match, which Spark lists
+    in one call, and the matching files of the other partitions. When most files may match the whole table is
+    read, as Spark lists many single files in a separate job, which costs more than the few files skipped.
+
+    :params path: Path of the table
+    :params manifest: Manifest of the table
+    :params filters: List of (column, operator, value) tuples
+    :return List of paths
+    """
+    partitions = {}
+    for entry in manifest['files']:
+        directory = os.path.dirname(entry['path'])
+        partitions.setdefault(directory, []).append((entry['path'], may_match(entry, filters)))
+    matches = sum(match for files in partitions.values() for _, match in files)
+    if matches > len(manifest['files']) * MAX_PRUNED_FRACTION:
+        return [path]
+
+    paths = []
+    for directory, files in sorted(partitions.items()):
+        if all(match for _, match in files):
+            paths.append(os.path.join(path, directory) if directory else path)
+        else:
+            paths += [os.path.join(path, file_path) for file_path, match in files if match]
+    return paths
+
+
+def read_table(spark, path, filters=None):
+    """
+    Reads a table of the lake, with its manifest only the files whose partition values and statistics may match
+    the filters are opened, and the schema is taken from the manifest instead of the Parquet footers.
+    Tables without a manifest are read from the directory.
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :params filters: List of (column, operator, value) tuples, e.g. [('start_time', '>=', datetime(2018, 11, 1))]
+    :return DataFrame with the rows matching the filters
+    """
+    filters = filters or []
+    condition = filter_condition(filters) if filters else None
+    manifest = read_manifest(spark, path)
+    if manifest is None:
+        df = spark.read.parquet(path)
+    else:
+        schema = StructType.fromJson(manifest['schema'])
+        paths = pruned_paths(path, manifest, filters)
+        if not paths:
+            return spark.createDataFrame([], schema)
+        df = spark.read.schema(schema).option('basePath', path).parquet(*paths)
+    return df.where(condition) if filters else df
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from pyspark.java_gateway import ensure_callback_server_started
+
+STAGE_TOTALS = ['duration_ms', 'executor_run_time_ms', 'input_bytes', 'shuffle_read_bytes', 'shuffle_write_bytes',
+                'memory_spilled_bytes', 'disk_spilled_bytes']
+
+
+class StageListener:
+    """
+    SparkListener implemented in Python through Py4J, recording the job group of every job's stages
+    and the metrics of every completed stage
+    """
+
+    def __init__(self, jvm):
+        self.jvm = jvm
+        self.stage_groups = {}
+        self.stages = []
+
+    def onJobStart(self, event):
+        """
+        Records the job group of the stages of a starting job
+
+        :params event: SparkListenerJobStart
+        :return None
+        """
+        properties = event.properties()
+        job_group = properties.getProperty('spark.jobGroup.id') if properties is not None else None
+        for stage_id in self.jvm.scala.collection.JavaConverters.seqAsJavaList(event.stageIds()):
+            self.stage_groups.setdefault(int(stage_id), job_group)
+
+    def onStageCompleted(self, event):
+        """
+        Records the duration and the task metrics summed over the tasks of a completed stage
+
+        :params event: SparkListenerStageCompleted
+        :return None
+        """
+        info = event.stageInfo()
+        task_metrics = info.taskMetrics()
+        submitted, completed = info.submissionTime(), info.completionTime()
+        self.stages.append({
+            'stage_id': info.stageId(),
+            'attempt': info.attemptNumber(),
+            'name': info.name(),
+            'job_group': self.stage_groups.get(info.stageId()),
+            'tasks': info.numTasks(),
+            'failed': info.failureReason().isDefined(),
+            'duration_ms': completed.get() - submitted.get() if submitted.isDefined() and completed.isDefined() else 0,
+            'executor_run_time_ms': task_metrics.executorRunTime(),
+            'input_bytes': task_metrics.inputMetrics().bytesRead(),
+            'shuffle_read_bytes': task_metrics.shuffleReadMetrics().totalBytesRead(),
+            'shuffle_write_bytes': task_metrics.shuffleWriteMetrics().bytesWritten(),
+            'memory_spilled_bytes': task_metrics.memoryBytesSpilled(),
+            'disk_spilled_bytes': task_metrics.diskBytesSpilled(),
+        })
+
+    def __getattr__(self, name):
+        # the listener bus calls a handler for every event, the others are ignored
+        if name.startswith('on'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+    class Java:
+        implements = ['org.apache.spark.scheduler.SparkListenerInterface']
+
+
+class StageMetricsCollector:
+    """
+    Collects per-stage duration, shuffle read/write and spill of the steps of a run, e.g. every process_* call,
+    and writes them to a JSON report, so runs with different tuning can be compared
+    """
+
+    def __init__(self, spark):
+        self.spark = spark
+        self.steps = []
+        ensure_callback_server_started(spark.sparkContext._gateway)
+        self.listener = StageListener(spark.sparkContext._jvm)
+        # every call passing the Python object creates a new proxy, keep one so the listener can be removed again
+        proxies = spark.sparkContext._jvm.java.util.ArrayList()
+        proxies.add(self.listener)
+        self.java_listener = proxies.get(0)
+        spark.sparkContext._jsc.sc().addSparkListener(self.java_listener)
+
+    @contextmanager
+    def measure(self, step):
+        """
+        Runs the jobs of a step in a job group named after it and records its wall clock time
+
+        :params step: Step name, e.g. process_song_data
+        :return None
+        """
+        self.spark.sparkContext.setJobGroup(step, step)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((step, time.perf_counter() - start))
+            self.spark.sparkContext.setLocalProperty('spark.jobGroup.id', None)
+
+    def report(self, settings=None):
+        """
+        Summarizes the stages of every step, after waiting for the listener to see all events
+
+        :params settings: Tuning settings of the run to record with the metrics
+        :return Report as a dict
+        """
+        self.spark.sparkContext._jsc.sc().listenerBus().waitUntilEmpty()
+        steps = []
+        for step, seconds in self.steps:
+            stages = [stage for stage in self.listener.stages if stage['job_group'] == step]
+            totals = {name: sum(stage[name] for stage in stages) for name in STAGE_TOTALS}
+            steps.append(dict(step=step, seconds=round(seconds, 3), stage_count=len(stages), stages=stages, **totals))
+        return {'app_id': self.spark.sparkContext.applicationId, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'settings': settings or {}, 'steps': steps}
+
+    def write_report(self, path, settings=None):
+        """
+        Writes the report as JSON and stops collecting
+
+        :params path: Path of the report
+        :params settings: Tuning settings of the run to record with the metrics
+        :return Report as a dict
+        """
+        report = self.report(settings)
+        self.spark.sparkContext._jsc.sc().removeSparkListener(self.java_listener)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def compare_reports(paths):
+    """
+    Prints the totals of every step of several reports side by side
+
+    :params paths: Paths of the reports
+    :return None
+    """
+    print("{:<20} {:<20} {:>10} {:>8} {:>15} {:>15} {:>15}".format(
+        'report', 'step', 'seconds', 'stages', 'shuffle read', 'shuffle write', 'spill'))
+    for path in paths:
+        with open(path) as f:
+            report = json.load(f)
+        for step in report['steps']:
+            print("{:<20} {:<20} {:>10.3f} {:>8} {:>15} {:>15} {:>15}".format(
+                os.path.basename(path)[:20], step['step'][:20], step['seconds'], step['stage_count'],
+                step['shuffle_read_bytes'], step['shuffle_write_bytes'],
+                step['memory_spilled_bytes'] + step['disk_spilled_bytes']))
+
+
+def main():
+    """
+    Compares the stage metrics reports of runs with different tuning
+
+    :params None
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Compare Sparkify ETL stage metrics reports')
+    parser.add_argument('reports', nargs='+', help='Reports written by etl.py --metrics-report')
+    args = parser.parse_args()
+    compare_reports(args.reports)
+
+
+if __name__ == "__main__":
+    main()
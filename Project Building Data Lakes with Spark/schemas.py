@@ -0,0 +1,71 @@
+from pyspark.sql.functions import col
+from pyspark.sql.types import DoubleType, LongType, StringType, StructField, StructType
+
+# Declared schemas of the raw JSON, the types match what schema inference gives on the Udacity data
+SONG_SCHEMA = StructType([
+    StructField('artist_id', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_longitude', DoubleType()),
+    StructField('artist_name', StringType()),
+    StructField('duration', DoubleType()),
+    StructField('num_songs', LongType()),
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('year', LongType()),
+])
+
+LOG_SCHEMA = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', LongType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType()),
+])
+
+CORRUPT_RECORD_COLUMN = '_corrupt_record'
+
+
+def read_json(spark, path, schema, quarantine_path=None):
+    """
+    Reads JSON with a declared schema, which skips the extra pass over every file schema inference needs.
+    With a quarantine path (strict mode) records that are malformed or do not match the schema are written there
+    as they were and left out of the result, otherwise their fields are read as nulls.
+
+    :params spark: SparkSession
+    :params path: Path, glob or list of paths of the JSON files
+    :params schema: Declared StructType of the records
+    :params quarantine_path: Where malformed records are written in strict mode
+    :return DataFrame with the schema's columns
+    """
+    if quarantine_path is None:
+        return spark.read.schema(schema).json(path)
+
+    strict_schema = StructType(schema.fields + [StructField(CORRUPT_RECORD_COLUMN, StringType())])
+    df = spark.read \
+        .schema(strict_schema) \
+        .option('mode', 'PERMISSIVE') \
+        .option('columnNameOfCorruptRecord', CORRUPT_RECORD_COLUMN) \
+        .json(path) \
+        .cache()
+
+    # Spark only allows queries on the corrupt record column of cached JSON reads
+    corrupt = df.where(col(CORRUPT_RECORD_COLUMN).isNotNull())
+    corrupt_count = corrupt.count()
+    if corrupt_count:
+        corrupt.select(CORRUPT_RECORD_COLUMN).write.mode('append').text(quarantine_path)
+        print("Quarantined {} malformed records in {}".format(corrupt_count, quarantine_path))
+    return df.where(col(CORRUPT_RECORD_COLUMN).isNull()).drop(CORRUPT_RECORD_COLUMN)
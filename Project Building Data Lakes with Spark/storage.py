@@ -0,0 +1,67 @@
+from tuning import read_config
+
+S3_SCHEMES = ('s3a://', 's3n://', 's3://')
+
+
+def is_s3(path):
+    """
+    Checks whether a path is on S3
+
+    :params path: Path or URI
+    :return True for s3a, s3n and s3 URIs
+    """
+    return path.startswith(S3_SCHEMES)
+
+
+def read_credentials(config):
+    """
+    Reads the AWS credentials of the config file, only called when S3 is used
+
+    :params config: ConfigParser of dl.cfg
+    :return Dict of Spark settings, empty when no keys are configured so the default AWS provider chain is used
+    """
+    if not config.has_section('CREDENTIALS'):
+        return {}
+    access_key = config.get('CREDENTIALS', 'AWS_ACCESS_KEY_ID', fallback='').strip('\'"')
+    secret_key = config.get('CREDENTIALS', 'AWS_SECRET_ACCESS_KEY', fallback='').strip('\'"')
+    if not access_key or not secret_key:
+        return {}
+    return {'spark.hadoop.fs.s3a.access.key': access_key, 'spark.hadoop.fs.s3a.secret.key': secret_key}
+
+
+def endpoint_settings(endpoint):
+    """
+    Points S3A at an S3 stand-in like MinIO or moto server instead of AWS
+
+    :params endpoint: URL of the stand-in, e.g. http://localhost:9000
+    :return Dict of Spark settings
+    """
+    return {
+        'spark.hadoop.fs.s3a.endpoint': endpoint,
+        'spark.hadoop.fs.s3a.path.style.access': 'true',
+        'spark.hadoop.fs.s3a.connection.ssl.enabled': str(endpoint.startswith('https://')).lower(),
+    }
+
+
+def storage_settings(paths, endpoint=None, dynamic_overwrite=False, config_path='dl.cfg'):
+    """
+    Spark settings needed to read and write the given paths. Local and HDFS paths need none. When any path is on S3,
+    the S3A connector and its tuning ([S3] of dl.cfg) and the credentials are added, as well as the magic committer
+    ([S3_COMMITTER]) unless partitions are overwritten dynamically, which the S3A committers do not support.
+
+    :params paths: Input and output paths of the job
+    :params endpoint: URL of an S3 stand-in, AWS if not given
+    :params dynamic_overwrite: Whether tables are written with dynamic partition overwrite
+    :params config_path: Path of the config file
+    :return Dict of Spark settings
+    """
+    if not any(is_s3(path) for path in paths):
+        return {}
+    config = read_config(config_path)
+    settings = dict(config.items('S3')) if config.has_section('S3') else {}
+    if not dynamic_overwrite and config.has_section('S3_COMMITTER'):
+        settings.update(config.items('S3_COMMITTER'))
+    settings.update(read_credentials(config))
+    if endpoint:
+        settings.update(endpoint_settings(endpoint))
+    return settings
@@ -0,0 +1,43 @@
+import configparser
+
+PROFILE_PREFIX = 'PROFILE:'
+
+
+def read_config(config_path='dl.cfg'):
+    """
+    Reads the config file keeping the case of the keys, Spark settings are case sensitive
+
+    :params config_path: Path of the config file
+    :return ConfigParser
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(config_path)
+    return config
+
+
+def list_profiles(config_path='dl.cfg'):
+    """
+    Names of the tuning profiles in the config file
+
+    :params config_path: Path of the config file
+    :return List of profile names
+    """
+    return [section[len(PROFILE_PREFIX):] for section in read_config(config_path).sections()
+            if section.startswith(PROFILE_PREFIX)]
+
+
+def load_profile(name, config_path='dl.cfg'):
+    """
+    Reads the Spark settings of a tuning profile, a [PROFILE:<name>] section of the config file
+
+    :params name: Profile name, e.g. local, small-cluster or large-cluster
+    :params config_path: Path of the config file
+    :return Dict of Spark settings
+    """
+    config = read_config(config_path)
+    section = PROFILE_PREFIX + name
+    if not config.has_section(section):
+        raise ValueError("Unknown tuning profile {}, {} has {}".format(
+            name, config_path, ', '.join(list_profiles(config_path))))
+    return dict(config.items(section))
@@ -0,0 +1,149 @@
+import math
+import os
+from collections import defaultdict
+
+from filesystem import get_filesystem
+from manifest import update_manifest
+
+# Partition columns of every table in the lake
+TABLE_PARTITIONS = {
+    'songs': ['year'],
+    'artists': [],
+    'users': [],
+    'time': ['year', 'month'],
+    'songplays': ['year', 'month'],
+}
+
+# Rows are sorted on these within every file, so the min/max ranges of the files in the manifest do not overlap
+TABLE_SORT_COLUMNS = {
+    'songs': ['song_id'],
+    'artists': ['artist_id'],
+    'users': ['userId'],
+    'time': ['start_time'],
+    'songplays': ['start_time'],
+}
+
+# Target uncompressed size of one Parquet file
+TARGET_FILE_MB = 128
+
+
+def estimate_row_bytes(df):
+    """
+    Estimates the uncompressed size of a row from the schema, as Spark's planner does
+
+    :params df: DataFrame to write
+    :return Bytes per row
+    """
+    return max(1, df._jdf.schema().defaultSize())
+
+
+def records_per_file(df, target_file_mb):
+    """
+    Number of rows that fill one file of about target_file_mb
+
+    :params df: DataFrame to write
+    :params target_file_mb: Target uncompressed file size in MB
+    :return Rows per file
+    """
+    return max(1, int(target_file_mb * 1024 * 1024 / estimate_row_bytes(df)))
+
+
+def table_path(output_data, table):
+    """
+    Location of a table in the lake
+
+    :params output_data: Root of the lake
+    :params table: Table name
+    :return Path of the table
+    """
+    return os.path.join(output_data, '{}.parquet'.format(table))
+
+
+def list_table_files(spark, path):
+    """
+    Lists the Parquet files of a table with the Hadoop FileSystem API, so it works for local paths, HDFS and S3
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :return List of (file path, partition directory, size in bytes)
+    """
+    fs, hadoop_path = get_filesystem(spark, path)
+    files = []
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        if status.getPath().getName().endswith('.parquet'):
+            files.append((status.getPath().toString(), status.getPath().getParent().toString(), status.getLen()))
+    return files
+
+
+def file_report(spark, path, files=None):
+    """
+    Summarizes the files of a table
+
+    :params spark: SparkSession
+    :params path: Path of the table
+    :params files: Listing of the table as returned by list_table_files, listed if not given
+    :return Dict with files, partitions, bytes and the largest number of files in a partition
+    """
+    files_per_partition = defaultdict(int)
+    total_bytes = 0
+    for _, partition, size in list_table_files(spark, path) if files is None else files:
+        files_per_partition[partition] += 1
+        total_bytes += size
+    return {'files': sum(files_per_partition.values()), 'partitions': len(files_per_partition), 'bytes': total_bytes,
+            'max_files_per_partition': max(files_per_partition.values(), default=0)}
+
+
+def write_table(spark, df, output_data, table, partition_by=None, target_file_mb=TARGET_FILE_MB,
+                overwrite_mode='static'):
+    """
+    Writes a table to the lake as Parquet with at most target_file_mb per file. Tables are range partitioned on their
+    partition columns and TABLE_SORT_COLUMNS over as many tasks as their size needs, so small partitions are written
+    by one task and a large one, like the songs of unknown year (year=0), is split across several by the sort
+    columns instead of going to one task. Tables without sort columns are repartitioned on their partition columns.
+    Files are sorted on TABLE_SORT_COLUMNS. Prints and returns the file counts and sizes written
+    and updates the table's manifest.
+    With overwrite_mode dynamic only the partitions present in df are replaced, the others are kept.
+
+    :params spark: SparkSession
+    :params df: Table to write
+    :params output_data: Root of the lake
+    :params table: Table name
+    :params partition_by: Partition columns, TABLE_PARTITIONS of the table if not given
+    :params target_file_mb: Target uncompressed file size in MB
+    :params overwrite_mode: static to replace the whole table, dynamic to replace only the partitions written
+    :return File report as returned by file_report
+    """
+    partition_by = TABLE_PARTITIONS.get(table, []) if partition_by is None else partition_by
+    sort_by = [name for name in TABLE_SORT_COLUMNS.get(table, []) if name in df.columns]
+    max_records = records_per_file(df, target_file_mb)
+    if sort_by:
+        df = df.repartitionByRange(max(1, math.ceil(df.count() / max_records)), *partition_by, *sort_by)
+    elif partition_by:
+        df = df.repartition(*partition_by)
+    else:
+        df = df.repartition(max(1, math.ceil(df.count() / max_records)))
+    # sorted on the partition columns first, as the writer needs, so it does not sort again
+    df = df.sortWithinPartitions(*partition_by, *sort_by)
+
+    path = table_path(output_data, table)
+    # INT96, Spark's default for timestamps, has no statistics in the footers the manifest is built from
+    timestamp_type = spark.conf.get('spark.sql.parquet.outputTimestampType')
+    spark.conf.set('spark.sql.parquet.outputTimestampType', 'TIMESTAMP_MICROS')
+    try:
+        df.write \
+            .partitionBy(*partition_by) \
+            .option('maxRecordsPerFile', max_records) \
+            .option('partitionOverwriteMode', overwrite_mode) \
+            .parquet(path, 'overwrite')
+    finally:
+        spark.conf.set('spark.sql.parquet.outputTimestampType', timestamp_type)
+
+    files = list_table_files(spark, path)
+    update_manifest(spark, path, table, partition_by, df.schema, files)
+    report = file_report(spark, path, files)
+    print("{}: {} files in {} partitions, {:.2f} MB, at most {} files per partition".format(
+        table, report['files'], report['partitions'], report['bytes'] / 1024 / 1024,
+        report['max_files_per_partition']))
+    return report
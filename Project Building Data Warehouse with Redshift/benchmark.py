@@ -0,0 +1,227 @@
+import argparse
+import configparser
+import random
+import time
+
+from psycopg2.extras import execute_values
+
+from dialect import connect, storage_paths
+from etl import compacted_copy_queries
+from sql_queries import copy_table_order, copy_table_queries, insert_table_order, insert_table_queries
+from sql_queries import truncate_staging_queries
+
+STAGING_EVENTS_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+                          'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+STAGING_SONGS_COLUMNS = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location', 'artist_name',
+                         'song_id', 'title', 'duration', 'year']
+WAREHOUSE_TABLES = ['songplays', 'users', 'songs', 'artists', 'time', 'song_lookup']
+
+# The songplays match before the song lookup: title-only join against staging_songs, deduplicated over the product
+legacy_songplay_select = ("""
+    SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' AS start_time, e.userId as user_id,
+    e.level, s.song_id AS song_id, s.artist_id AS artist_id, e.sessionId AS session_id, e.location AS location, e.userAgent AS user_agent
+    FROM staging_events e, staging_songs s
+    WHERE e.page = 'NextSong' AND e.song = s.title
+""")
+
+lookup_songplay_select = ("""
+    SELECT TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time, e.userId AS user_id,
+    e.level, l.song_id AS song_id, l.artist_id AS artist_id, e.sessionId AS session_id, e.location AS location, e.userAgent AS user_agent
+    FROM staging_events e
+    JOIN song_lookup l ON e.song = l.title AND e.artist = l.artist_name AND e.length = l.duration
+    WHERE e.page = 'NextSong'
+""")
+
+# 2018-11-01 00:00:00 UTC in epoch milliseconds, the start of the Sparkify log data
+BASE_TS = 1541030400000
+
+
+def make_staging_rows(size, batch, seed=42):
+    """
+    Generates synthetic staging rows shaped like the Sparkify song and log data.
+    Every batch uses its own key range so consecutive batches add new rows to the warehouse.
+
+    :params size: Number of staging_events rows to generate
+    :params batch: Index of the batch, used to offset keys and timestamps
+    :params seed: Seed for the random generator
+
+    :return Tuple of (event rows, song rows)
+    """
+    rng = random.Random(seed + batch)
+    num_songs = max(size // 10, 1)
+    num_users = max(size // 50, 1)
+    songs = []
+    for i in range(num_songs):
+        song_key = batch * num_songs + i
+        songs.append((1, 'AR{:016d}'.format(song_key % (num_songs // 2 + 1)), None, None, 'Somewhere',
+                      'Artist {}'.format(song_key % (num_songs // 2 + 1)), 'SO{:016d}'.format(song_key),
+                      'Song {}'.format(song_key), round(rng.uniform(60, 600), 5), 2000 + song_key % 20))
+    events = []
+    for i in range(size):
+        song = songs[rng.randrange(num_songs)]
+        user_id = rng.randrange(num_users) + 1
+        ts = BASE_TS + (batch * size + i) * 1000
+        events.append((song[5], 'Logged In', 'First{}'.format(user_id), rng.choice('MF'), i % 100,
+                       'Last{}'.format(user_id), song[8], rng.choice(['free', 'paid']), 'Somewhere, US', 'PUT',
+                       'NextSong', 1540919166796.0, batch * size + i // 20, song[7], 200, ts, 'Mozilla/5.0', user_id))
+    return events, songs
+
+
+def load_staging_rows(cur, conn, events, songs):
+    """
+    Replaces the content of the staging tables with the given rows
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params events: Rows for staging_events
+    :params songs: Rows for staging_songs
+
+    :return None
+    """
+    cur.execute("TRUNCATE staging_events")
+    cur.execute("TRUNCATE staging_songs")
+    execute_values(cur, "INSERT INTO staging_events ({}) VALUES %s".format(', '.join(STAGING_EVENTS_COLUMNS)), events,
+                   page_size=1000)
+    execute_values(cur, "INSERT INTO staging_songs ({}) VALUES %s".format(', '.join(STAGING_SONGS_COLUMNS)), songs,
+                   page_size=1000)
+    conn.commit()
+
+
+def time_insert_tables(cur, conn):
+    """
+    Runs every insert query once and measures how long each one takes
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+
+    :return Dict mapping table name to elapsed seconds
+    """
+    timings = {}
+    for table, query in zip(insert_table_order, insert_table_queries):
+        start = time.perf_counter()
+        cur.execute(query)
+        conn.commit()
+        timings[table] = time.perf_counter() - start
+    return timings
+
+
+def benchmark_load_scaling(cur, conn, sizes, batches):
+    """
+    Loads several consecutive batches of synthetic staging data for every size into an initially empty warehouse.
+    Later batches run against a warehouse that already holds the earlier ones, so a load path that scales with
+    the target table shows up as growing time per staging row.
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params sizes: Staging sizes (staging_events rows) to benchmark
+    :params batches: Number of consecutive batches loaded per size
+
+    :return None
+    """
+    print("{:>10} {:>6} {:>10} {:>14}".format('rows', 'batch', 'seconds', 'us per row'))
+    for size in sizes:
+        for table in WAREHOUSE_TABLES:
+            cur.execute("TRUNCATE {}".format(table))
+        conn.commit()
+        for batch in range(batches):
+            events, songs = make_staging_rows(size, batch)
+            load_staging_rows(cur, conn, events, songs)
+            elapsed = sum(time_insert_tables(cur, conn).values())
+            print("{:>10} {:>6} {:>10.3f} {:>14.1f}".format(size, batch, elapsed, elapsed / size * 1e6))
+
+
+def benchmark_songplays_match(cur, repeat):
+    """
+    Compares the legacy title-only songplays match with the song lookup join on the data currently in staging.
+    Run it after etl.py so staging and song_lookup are populated.
+
+    :params cur: The cursor for executing queries in the database
+    :params repeat: Number of timed runs per query, the fastest one is reported
+
+    :return None
+    """
+    print("{:<10} {:>10} {:>10}".format('query', 'rows', 'seconds'))
+    for name, query in [('legacy', legacy_songplay_select), ('lookup', lookup_songplay_select)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute("SELECT COUNT(*) FROM ({}) songplays_match".format(query))
+            rows = cur.fetchone()[0]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{:<10} {:>10} {:>10.3f}".format(name, rows, best))
+
+
+def benchmark_copy_formats(cur, conn, formats, paths):
+    """
+    Times the staging COPY from the raw JSON objects and from the files written by compact.py.
+    Run compact.py for every compacted format first.
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params formats: COPY formats to benchmark (json, gzip, parquet)
+    :params paths: Data locations as returned by dialect.storage_paths
+
+    :return None
+    """
+    print("{:<10} {:<16} {:>10} {:>10}".format('format', 'table', 'rows', 'seconds'))
+    for file_format in formats:
+        queries = copy_table_queries if file_format == 'json' else compacted_copy_queries(file_format, paths)
+        for table, truncate, query in zip(copy_table_order, truncate_staging_queries, queries):
+            cur.execute(truncate)
+            conn.commit()
+            start = time.perf_counter()
+            cur.execute(query)
+            conn.commit()
+            elapsed = time.perf_counter() - start
+            cur.execute("SELECT COUNT(*) FROM {}".format(table))
+            print("{:<10} {:<16} {:>10} {:>10.3f}".format(file_format, table, cur.fetchone()[0], elapsed))
+
+
+def main():
+    """
+    Benchmarks the warehouse load against the database configured in dwh.cfg.
+    The staging and warehouse tables are overwritten, so do not run this against production data.
+
+    :params None
+
+    :return None
+    """
+    # every benchmark takes --target after its name, like the options of the other scripts
+    target_parser = argparse.ArgumentParser(add_help=False)
+    target_parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                               help='Benchmark the Redshift cluster or the local Postgres stand-in')
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify Redshift ETL')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    load_parser = subparsers.add_parser('load', parents=[target_parser],
+                                        help='Scaling of the warehouse load with synthetic staging data')
+    load_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000, 200000],
+                             help='Number of staging_events rows per batch')
+    load_parser.add_argument('--batches', type=int, default=3, help='Consecutive batches loaded per size')
+    songplays_parser = subparsers.add_parser('songplays', parents=[target_parser],
+                                             help='Legacy songplays match against the song lookup join')
+    songplays_parser.add_argument('--repeat', type=int, default=3, help='Timed runs per query')
+    copy_parser = subparsers.add_parser('copy', parents=[target_parser],
+                                        help='Staging COPY from raw JSON against compacted files')
+    copy_parser.add_argument('--formats', nargs='+', choices=['json', 'gzip', 'parquet'],
+                             default=['json', 'gzip', 'parquet'], help='COPY formats to compare')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = connect(args.target)
+    cur = conn.cursor()
+
+    if args.benchmark == 'load':
+        benchmark_load_scaling(cur, conn, args.sizes, args.batches)
+    elif args.benchmark == 'songplays':
+        benchmark_songplays_match(cur, args.repeat)
+    elif args.benchmark == 'copy':
+        benchmark_copy_formats(cur, conn, args.formats, storage_paths(config, args.target))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
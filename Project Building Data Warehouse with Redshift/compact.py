@@ -0,0 +1,279 @@
+import argparse
+import configparser
+import gzip
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from manifest import build_manifest, list_object_sizes, read_object, strip_quotes, upload_file, write_manifest
+
+# Staging columns in table order with their Parquet type, COPY ... FORMAT AS PARQUET matches columns by position
+STAGING_COLUMNS = {
+    'staging_events': [('artist', 'string'), ('auth', 'string'), ('firstName', 'string'), ('gender', 'string'),
+                       ('itemInSession', 'int32'), ('lastName', 'string'), ('length', 'decimal(12,5)'),
+                       ('level', 'string'), ('location', 'string'), ('method', 'string'), ('page', 'string'),
+                       ('registration', 'float64'), ('sessionId', 'int32'), ('song', 'string'), ('status', 'int32'),
+                       ('ts', 'int64'), ('userAgent', 'string'), ('userId', 'int32')],
+    'staging_songs': [('num_songs', 'int32'), ('artist_id', 'string'), ('artist_latitude', 'decimal(12,5)'),
+                      ('artist_longitude', 'decimal(12,5)'), ('artist_location', 'string'), ('artist_name', 'string'),
+                      ('song_id', 'string'), ('title', 'string'), ('duration', 'decimal(15,5)'), ('year', 'int32')],
+}
+FILE_EXTENSIONS = {'gzip': 'json.gz', 'parquet': 'parquet'}
+
+
+def compacted_manifest_uri(compact_prefix, table, file_format):
+    """
+    Location of the COPY manifest of a compacted staging table
+
+    :params compact_prefix: COMPACT_PREFIX from dwh.cfg
+    :params table: Staging table name
+    :params file_format: gzip or parquet
+
+    :return Manifest URI or path
+    """
+    return '{}/{}/{}.manifest'.format(strip_quotes(compact_prefix).rstrip('/'), table, file_format)
+
+
+def get_slice_count():
+    """
+    Reads the number of slices of the cluster configured in dwh.cfg
+
+    :params None
+
+    :return Number of slices
+    """
+    from dialect import connect
+
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM stv_slices")
+    slices = cur.fetchone()[0]
+    conn.close()
+    return slices
+
+
+def iter_records(uris, workers):
+    """
+    Reads JSON records from many small objects concurrently.
+    Song objects hold one JSON document, log objects one JSON document per line.
+
+    :params uris: Object URIs or file paths
+    :params workers: Number of objects fetched concurrently
+
+    :return Generator of record dicts
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for content in executor.map(read_object, uris):
+            for line in content.decode('utf-8').splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+def to_parquet_value(value, parquet_type):
+    """
+    Converts a JSON value to the Python value pyarrow expects for a staging column,
+    e.g. log userIds are strings and empty for logged out users
+
+    :params value: Value from the JSON record
+    :params parquet_type: Parquet type of the column as listed in STAGING_COLUMNS
+
+    :return Converted value or None
+    """
+    if value is None or value == '':
+        return None
+    if parquet_type.startswith('int'):
+        return int(value)
+    if parquet_type == 'float64':
+        return float(value)
+    if parquet_type.startswith('decimal'):
+        scale = int(parquet_type.rstrip(')').split(',')[1])
+        return Decimal(str(value)).quantize(Decimal(1).scaleb(-scale))
+    return str(value)
+
+
+def parquet_schema(table):
+    """
+    Builds the pyarrow schema of a staging table
+
+    :params table: Staging table name
+
+    :return pyarrow.Schema
+    """
+    import pyarrow as pa
+
+    fields = []
+    for name, parquet_type in STAGING_COLUMNS[table]:
+        if parquet_type.startswith('decimal'):
+            precision, scale = parquet_type[len('decimal('):-1].split(',')
+            fields.append(pa.field(name, pa.decimal128(int(precision), int(scale))))
+        else:
+            fields.append(pa.field(name, getattr(pa, parquet_type)()))
+    return pa.schema(fields)
+
+
+def write_files(records, table, file_format, num_files, work_dir, batch_rows=10000):
+    """
+    Spreads the records round-robin over num_files gzip JSON-lines or Parquet files
+
+    :params records: Iterable of record dicts
+    :params table: Staging table name
+    :params file_format: gzip or parquet
+    :params num_files: Number of files to write
+    :params work_dir: Local directory for the files
+    :params batch_rows: Rows buffered per Parquet file before a row group is written
+
+    :return Tuple of (list of local file paths, number of records)
+    """
+    paths = [os.path.join(work_dir, 'part-{:05d}.{}'.format(i, FILE_EXTENSIONS[file_format])) for i in range(num_files)]
+    count = 0
+    if file_format == 'gzip':
+        writers = [gzip.open(path, 'wt', encoding='utf-8') for path in paths]
+        for count, record in enumerate(records, 1):
+            writers[count % num_files].write(json.dumps(record) + '\n')
+        for writer in writers:
+            writer.close()
+        return paths, count
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(table)
+    columns = STAGING_COLUMNS[table]
+    writers = [pq.ParquetWriter(path, schema, compression='snappy') for path in paths]
+    buffers = [[] for _ in paths]
+
+    def flush(index):
+        rows = buffers[index]
+        arrays = [pa.array([row[position] for row in rows], type=schema.field(position).type)
+                  for position in range(len(columns))]
+        writers[index].write_table(pa.Table.from_arrays(arrays, schema=schema))
+        buffers[index] = []
+
+    for count, record in enumerate(records, 1):
+        index = count % num_files
+        buffers[index].append([to_parquet_value(record.get(name), parquet_type) for name, parquet_type in columns])
+        if len(buffers[index]) >= batch_rows:
+            flush(index)
+    for index in range(num_files):
+        if buffers[index]:
+            flush(index)
+        writers[index].close()
+    return paths, count
+
+
+def compact_table(source, compact_prefix, table, file_format, slices, target_mb, workers):
+    """
+    Compacts the small JSON objects below a source prefix into a multiple of the cluster slice count of
+    gzip or Parquet files of about target_mb uncompressed each, and writes a COPY manifest for them
+
+    :params source: LOG_DATA or SONG_DATA prefix
+    :params compact_prefix: COMPACT_PREFIX from dwh.cfg
+    :params table: Staging table the data is loaded into
+    :params file_format: gzip or parquet
+    :params slices: Number of slices of the cluster
+    :params target_mb: Target uncompressed size of one file in MB
+    :params workers: Number of objects fetched concurrently
+
+    :return Dict with manifest, objects, records and files
+    """
+    objects = [(uri, size) for uri, size in list_object_sizes(source) if uri.endswith('.json')]
+    raw_bytes = sum(size for _, size in objects)
+    num_files = slices * max(1, math.ceil(raw_bytes / (slices * target_mb * 1024 * 1024)))
+
+    work_dir = tempfile.mkdtemp(prefix='compact_{}_'.format(table))
+    try:
+        paths, records = write_files(iter_records([uri for uri, _ in objects], workers), table, file_format,
+                                     num_files, work_dir)
+        target = '{}/{}'.format(strip_quotes(compact_prefix).rstrip('/'), table)
+        uris, sizes = [], []
+        for path in paths:
+            uris.append(upload_file(path, '{}/{}'.format(target, os.path.basename(path))))
+            sizes.append(os.path.getsize(path))
+    finally:
+        shutil.rmtree(work_dir)
+
+    manifest = build_manifest(uris, sizes if file_format == 'parquet' else None)
+    manifest_uri = write_manifest(manifest, compacted_manifest_uri(compact_prefix, table, file_format))
+    return {'manifest': manifest_uri, 'objects': len(objects), 'records': records, 'files': len(uris),
+            'raw_bytes': raw_bytes, 'compacted_bytes': sum(sizes)}
+
+
+def count_compacted_records(manifest_uri, table, file_format):
+    """
+    Counts the records in the files of a compacted manifest, to validate a compaction
+
+    :params manifest_uri: Manifest URI or path
+    :params table: Staging table name
+    :params file_format: gzip or parquet
+
+    :return Number of records
+    """
+    manifest = json.loads(read_object(manifest_uri).decode('utf-8'))
+    count = 0
+    for entry in manifest['entries']:
+        content = read_object(entry['url'])
+        if file_format == 'gzip':
+            count += sum(1 for line in gzip.decompress(content).splitlines() if line.strip())
+        else:
+            import io
+            import pyarrow.parquet as pq
+
+            table_data = pq.read_table(io.BytesIO(content))
+            assert table_data.schema.names == [name for name, _ in STAGING_COLUMNS[table]]
+            count += table_data.num_rows
+    return count
+
+
+def main():
+    """
+    Compacts the song and log JSON objects into a few large gzip or Parquet files for faster COPY.
+    Sources and target default to dwh.cfg and may be local directories standing in for S3.
+
+    :params None
+
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Compact the Sparkify JSON data for COPY')
+    parser.add_argument('--format', choices=['gzip', 'parquet'], default='gzip', help='Format of the compacted files')
+    parser.add_argument('--slices', type=int, help='Slices of the cluster, read from stv_slices if not given')
+    parser.add_argument('--target-mb', type=int, default=256, help='Target uncompressed size of a file in MB')
+    parser.add_argument('--workers', type=int, default=16, help='Objects fetched concurrently')
+    parser.add_argument('--log-data', help='Log data prefix, LOG_DATA from dwh.cfg if not given')
+    parser.add_argument('--song-data', help='Song data prefix, SONG_DATA from dwh.cfg if not given')
+    parser.add_argument('--compact-prefix', help='Target prefix, COMPACT_PREFIX from dwh.cfg if not given')
+    parser.add_argument('--verify', action='store_true', help='Re-read the compacted files and compare record counts')
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Use the S3 or the LOCAL data locations of dwh.cfg; postgres has a single slice')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    section = 'S3' if args.target == 'redshift' else 'LOCAL'
+    compact_prefix = args.compact_prefix or config.get(section, 'COMPACT_PREFIX')
+    if not strip_quotes(compact_prefix):
+        parser.error('set COMPACT_PREFIX in the {} section of dwh.cfg or pass --compact-prefix'.format(section))
+    slices = args.slices or (get_slice_count() if args.target == 'redshift' else 1)
+    sources = {'staging_events': args.log_data or config.get(section, 'LOG_DATA'),
+               'staging_songs': args.song_data or config.get(section, 'SONG_DATA')}
+
+    for table, source in sources.items():
+        start = time.perf_counter()
+        result = compact_table(source, compact_prefix, table, args.format, slices, args.target_mb, args.workers)
+        print("{}: {} objects ({:.1f} MB) -> {} {} files ({:.1f} MB), {} records in {:.2f}s, manifest {}".format(
+            table, result['objects'], result['raw_bytes'] / 1e6, result['files'], args.format,
+            result['compacted_bytes'] / 1e6, result['records'], time.perf_counter() - start, result['manifest']))
+        if args.verify:
+            compacted = count_compacted_records(result['manifest'], table, args.format)
+            if compacted != result['records']:
+                raise ValueError("{} compacted records of {} do not match {} source records".format(
+                    compacted, table, result['records']))
+            print("{}: verified {} records".format(table, compacted))
+
+
+if __name__ == "__main__":
+    main()
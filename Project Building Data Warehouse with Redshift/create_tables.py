@@ -1,5 +1,5 @@
-import configparser
-import psycopg2
+import argparse
+from dialect import connect
 from sql_queries import create_table_queries, drop_table_queries
 
 
@@ -38,17 +38,19 @@ def main():
     Creates Connection to DB
     Creartes Cursor object
     Closes connection to DB after queries have finished executing
+    With --target postgres the tables are created on the local Postgres stand-in of the LOCAL section
     
     
     :params None
     
     :return None
     """
-    
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser(description='Create the Sparkify staging and warehouse tables')
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Create the tables on the Redshift cluster or the local Postgres stand-in')
+    args = parser.parse_args()
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = connect(args.target)
     cur = conn.cursor()
 
     drop_tables(cur, conn)
@@ -0,0 +1,199 @@
+import configparser
+import csv
+import gzip
+import io
+import json
+import os
+import re
+
+import psycopg2
+import psycopg2.extensions
+
+from manifest import list_objects, read_object, strip_quotes
+
+STORAGE_KEYS = ['LOG_DATA', 'LOG_JSONPATH', 'SONG_DATA', 'MANIFEST_PREFIX', 'COMPACT_PREFIX']
+NULL_MARKER = '\\N'
+NUMERIC_TYPES = {'smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision'}
+
+# Redshift EXTRACT date parts and their Postgres names
+DATE_PARTS = {'hr': 'hour', 'd': 'day', 'w': 'week', 'mon': 'month', 'yr': 'year', 'weekday': 'dow'}
+
+
+def to_postgres(query):
+    """
+    Translates the Redshift-only parts of a statement from sql_queries to Postgres:
+    IDENTITY columns, distribution and sort keys, foreign keys (informational only on Redshift),
+    GETDATE() and the EXTRACT date part abbreviations
+
+    :params query: Redshift statement
+
+    :return Postgres statement
+    """
+    query = re.sub(r'\bIDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)',
+                   r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 MINVALUE \1 INCREMENT BY \2)', query,
+                   flags=re.IGNORECASE)
+    query = re.sub(r'\bDISTSTYLE\s+\w+', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\b(?:COMPOUND\s+|INTERLEAVED\s+)?(?:DISTKEY|SORTKEY)\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\s+(?:DISTKEY|SORTKEY)\b', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\s+REFERENCES\s+\w+\s*\(\s*\w+\s*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bGETDATE\(\)', 'LOCALTIMESTAMP', query, flags=re.IGNORECASE)
+    return re.sub(r'\bEXTRACT\s*\(\s*(\w+)\s+FROM\b',
+                  lambda match: 'EXTRACT({} FROM'.format(DATE_PARTS.get(match.group(1).lower(), match.group(1))),
+                  query, flags=re.IGNORECASE)
+
+
+def parse_copy(query):
+    """
+    Parses a Redshift COPY statement from sql_queries
+
+    :params query: COPY statement
+
+    :return Dict with table, source, manifest, gzip, format (json or parquet) and jsonpaths
+    """
+    table, source = re.search(r"copy\s+(\w+)\s+from\s+'([^']*)'", query, re.IGNORECASE).groups()
+    jsonpaths = re.search(r"format\s+as\s+json\s+'([^']*)'", query, re.IGNORECASE)
+    return {'table': table.lower(), 'source': source,
+            'manifest': re.search(r'\bmanifest\b', query, re.IGNORECASE) is not None,
+            'gzip': re.search(r'\bgzip\b', query, re.IGNORECASE) is not None,
+            'format': 'parquet' if re.search(r'format\s+as\s+parquet', query, re.IGNORECASE) else 'json',
+            'jsonpaths': jsonpaths.group(1) if jsonpaths and jsonpaths.group(1).lower() != 'auto' else None}
+
+
+def read_records(uri, copy):
+    """
+    Reads the records of one object for a COPY, as dicts for JSON and as lists in column order for Parquet
+
+    :params uri: Local path of the object
+    :params copy: Parsed COPY statement as returned by parse_copy
+
+    :return List of records
+    """
+    content = read_object(uri)
+    if copy['format'] == 'parquet':
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(io.BytesIO(content))
+        return [list(row.values()) for row in table.to_pylist()]
+    if copy['gzip'] or uri.endswith('.gz'):
+        content = gzip.decompress(content)
+    return [json.loads(line) for line in content.decode('utf-8').splitlines() if line.strip()]
+
+
+class PostgresCursor(psycopg2.extensions.cursor):
+    """
+    Cursor running the Redshift statements of sql_queries on Postgres. Statements are translated with
+    to_postgres, and COPY statements load local files standing in for S3 through COPY FROM STDIN.
+    path_map maps the S3 locations of dwh.cfg to their local stand-ins.
+    """
+    path_map = {}
+
+    def localize(self, uri):
+        """
+        Maps an S3 location of dwh.cfg to its local stand-in
+
+        :params uri: S3 URI or local path
+
+        :return Local path
+        """
+        uri = strip_quotes(uri)
+        for s3_prefix, local_prefix in self.path_map.items():
+            if s3_prefix and uri.startswith(s3_prefix):
+                return local_prefix + uri[len(s3_prefix):]
+        return uri
+
+    def execute(self, query, vars=None):
+        # psycopg2.extras helpers like execute_values pass already composed bytes
+        if isinstance(query, bytes):
+            return super().execute(query, vars)
+        if re.match(r"\s*copy\s+\w+\s+from\s+'", query, re.IGNORECASE):
+            return self.copy_from_local(parse_copy(query))
+        return super().execute(to_postgres(query), vars)
+
+    def copy_from_local(self, copy):
+        """
+        Emulates a Redshift COPY: reads the JSON (optionally gzip) or Parquet objects below a local prefix or named
+        in a local manifest and streams them into the table with COPY FROM STDIN
+
+        :params copy: Parsed COPY statement as returned by parse_copy
+
+        :return None
+        """
+        source = self.localize(copy['source'])
+        if copy['manifest']:
+            manifest = json.loads(read_object(source).decode('utf-8'))
+            uris = [self.localize(entry['url']) for entry in manifest['entries']]
+        else:
+            uris = list_objects(source) if os.path.isdir(source) else [source]
+            uris = [uri for uri in uris if not os.path.basename(uri).startswith('.')]
+
+        super().execute("SELECT column_name, data_type FROM information_schema.columns "
+                        "WHERE table_name = %s ORDER BY ordinal_position", (copy['table'],))
+        columns = self.fetchall()
+        # Without a local JSONPaths file, keys are matched to the columns by name ignoring case
+        jsonpaths_uri = self.localize(copy['jsonpaths']) if copy['jsonpaths'] else ''
+        if jsonpaths_uri:
+            jsonpaths = json.loads(read_object(jsonpaths_uri).decode('utf-8'))['jsonpaths']
+            keys = [re.sub(r"^\$\.|^\$\['|'\]$", '', path) for path in jsonpaths]
+        else:
+            keys = [name for name, _ in columns]
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for uri in uris:
+            for record in read_records(uri, copy):
+                if isinstance(record, dict):
+                    lowered = {key.lower(): value for key, value in record.items()}
+                    record = [lowered.get(key.lower()) for key in keys]
+                writer.writerow([NULL_MARKER if value is None or (value == '' and data_type in NUMERIC_TYPES) else value
+                                 for value, (_, data_type) in zip(record, columns)])
+        buffer.seek(0)
+        self.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+            copy['table'], ', '.join(name for name, _ in columns), NULL_MARKER), buffer)
+
+
+def storage_paths(config, target):
+    """
+    Data locations for a target: the S3 section of dwh.cfg for Redshift, the LOCAL section for Postgres
+
+    :params config: Parsed dwh.cfg
+    :params target: redshift or postgres
+
+    :return Dict mapping LOG_DATA, LOG_JSONPATH, SONG_DATA, MANIFEST_PREFIX and COMPACT_PREFIX to their location
+    """
+    section = 'S3' if target == 'redshift' else 'LOCAL'
+    return {key: config.get(section, key) for key in STORAGE_KEYS}
+
+
+def connection_string(config, target):
+    """
+    Connection string of the Redshift cluster (CLUSTER section of dwh.cfg) or of the local Postgres (LOCAL section)
+
+    :params config: Parsed dwh.cfg
+    :params target: redshift or postgres
+
+    :return libpq connection string
+    """
+    section = 'CLUSTER' if target == 'redshift' else 'LOCAL'
+    return "host={} dbname={} user={} password={} port={}".format(
+        *[config.get(section, key) for key in ['HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_PORT']])
+
+
+def connect(target='redshift'):
+    """
+    Connects to the Redshift cluster, or to a local Postgres standing in for it whose cursors translate
+    the Redshift statements and COPY from the local data locations
+
+    :params target: redshift or postgres
+
+    :return psycopg2 connection
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if target == 'redshift':
+        return psycopg2.connect(connection_string(config, target))
+
+    local_paths = storage_paths(config, 'postgres')
+    cursor_class = type('LocalPostgresCursor', (PostgresCursor,), {'path_map': {
+        strip_quotes(s3_path): strip_quotes(local_paths[key])
+        for key, s3_path in storage_paths(config, 'redshift').items() if strip_quotes(s3_path)}})
+    return psycopg2.connect(connection_string(config, target), cursor_factory=cursor_class)
@@ -1,56 +1,244 @@
+import argparse
 import configparser
-import psycopg2
+import time
+from datetime import datetime, timezone
+from compact import compacted_manifest_uri
+from dialect import connect, storage_paths
+from maintenance import maintenance_stage
+from manifest import build_manifest, last_log_date, list_log_objects, strip_quotes, write_manifest
 from sql_queries import copy_table_order, copy_table_queries, insert_table_order, insert_table_queries
+from sql_queries import DWH_IAM_ROLE_ARN, compacted_copy_table_queries, table_version_bump
+from sql_queries import high_water_mark_select, high_water_mark_update, staging_events_copy_manifest
+from sql_queries import staging_events_delete_loaded, staging_songs_copy, truncate_staging_queries
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, queries=copy_table_queries):
     """
     Loads data from logs into the staging tables for further processing
     
     :params cur: The cursor for executing queries in the database
     :params conn: The connection to the database
+    :params queries: COPY statements in the order of copy_table_order, the raw JSON objects by default
     
-    :return None
+    :return Dict mapping staging table to the seconds its COPY took
     """
+    timings = {}
     count = 0
-    for query in copy_table_queries:
+    for query in queries:
         print("Loading data into {} ".format(copy_table_order[count]))
+        start = time.perf_counter()
         cur.execute(query)
         conn.commit()
+        timings[copy_table_order[count]] = time.perf_counter() - start
         count += 1
         print("Loaded Successfully")
+    return timings
+
+
+def compacted_copy_queries(file_format, paths):
+    """
+    Builds the COPY statements loading the staging tables from the files written by compact.py
+
+    :params file_format: gzip or parquet
+    :params paths: Data locations as returned by dialect.storage_paths
+
+    :return List of COPY statements in the order of copy_table_order
+    """
+    queries = []
+    for table, query in zip(copy_table_order, compacted_copy_table_queries[file_format]):
+        manifest_uri = compacted_manifest_uri(paths['COMPACT_PREFIX'], table, file_format)
+        if table == 'staging_events' and file_format == 'gzip':
+            queries.append(query.format(manifest_uri, DWH_IAM_ROLE_ARN, paths['LOG_JSONPATH']))
+        else:
+            queries.append(query.format(manifest_uri, DWH_IAM_ROLE_ARN))
+    return queries
 
 
 def insert_tables(cur, conn):
     """
     Extract and Transform data from staging Tables
     Load the transformed data into another table for analysis
+    Bumps the version stamp of every loaded table, which invalidates cached query results
     
     :params cur: The cursor for executing queries in the database
     :params conn: The connection to the database
     
-    :return None
+    :return Dict mapping table to the seconds its insert took
     """
+    timings = {}
     count = 0
     for query in insert_table_queries:
         print("Loading data into {} ".format(insert_table_order[count]))
+        start = time.perf_counter()
         cur.execute(query)
+        cur.execute(table_version_bump.format(insert_table_order[count]))
         conn.commit()
+        timings[insert_table_order[count]] = time.perf_counter() - start
         count += 1
         print("Loaded Successfully")
+    return timings
+
+
+def update_high_water_mark(cur, conn):
+    """
+    Records the newest loaded event timestamp, so the next incremental run only merges newer events
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+
+    :return None
+    """
+    cur.execute(high_water_mark_update)
+    conn.commit()
+
+
+def get_high_water_mark(cur):
+    """
+    Reads the newest event timestamp (epoch milliseconds) merged by earlier runs
+
+    :params cur: The cursor for executing queries in the database
+
+    :return High-water mark, or None if nothing was loaded yet
+    """
+    cur.execute(high_water_mark_select)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def load_staging_window(cur, conn, start_date, end_date, with_songs, paths):
+    """
+    Truncates the staging tables and COPYs only the log objects of the days between start_date and end_date,
+    listed in a manifest. Events below the high-water mark are dropped from staging, so the inserts
+    only merge the new part of the window.
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params start_date: First day of the window
+    :params end_date: Last day of the window
+    :params with_songs: Whether to reload staging_songs as well
+    :params paths: Data locations as returned by dialect.storage_paths
+
+    :return Number of log objects in the window
+    """
+    for query in truncate_staging_queries:
+        cur.execute(query)
+    conn.commit()
+
+    log_objects = list_log_objects(paths['LOG_DATA'], start_date, end_date)
+    if not log_objects:
+        print("No log objects between {} and {}".format(start_date, end_date))
+        return 0
+    manifest_uri = write_manifest(build_manifest(log_objects), '{}/staging_events/{}_{}.manifest'.format(
+        strip_quotes(paths['MANIFEST_PREFIX']).rstrip('/'), start_date.isoformat(), end_date.isoformat()))
+
+    print("Loading {} log objects into staging_events ".format(len(log_objects)))
+    cur.execute(staging_events_copy_manifest.format(manifest_uri, DWH_IAM_ROLE_ARN, paths['LOG_JSONPATH']))
+    cur.execute(staging_events_delete_loaded)
+    conn.commit()
+    print("Loaded Successfully")
+
+    if with_songs:
+        print("Loading data into staging_songs ")
+        cur.execute(staging_songs_copy)
+        conn.commit()
+        print("Loaded Successfully")
+    return len(log_objects)
+
+
+def parse_date(value):
+    """
+    Parses a YYYY-MM-DD command line argument
+
+    :params value: Date string
+
+    :return datetime.date
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def print_stage_timings(timings):
+    """
+    Prints the seconds every stage of the load took
+
+    :params timings: List of (stage, seconds) in the order the stages ran
+
+    :return None
+    """
+    print("{:<30} {:>10}".format('stage', 'seconds'))
+    for stage, seconds in timings:
+        print("{:<30} {:>10.3f}".format(stage, seconds))
+    print("{:<30} {:>10.3f}".format('total', sum(seconds for _, seconds in timings)))
 
 
 def main():
+    """
+    Main Driver function
+    Runs a full load of all song and log data, or with --incremental only the log data of one window of days.
+    Without --start the window starts at the day of the high-water mark, without --end it ends at the last day
+    with log objects.
+    With --target postgres the load runs on the local Postgres and data configured in the LOCAL section of dwh.cfg.
+
+    :params None
+
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify data from S3 into Redshift')
+    parser.add_argument('--incremental', action='store_true', help='Only load the log objects of one window of days')
+    parser.add_argument('--start', type=parse_date, help='First day of the window (YYYY-MM-DD)')
+    parser.add_argument('--end', type=parse_date, help='Last day of the window (YYYY-MM-DD)')
+    parser.add_argument('--with-songs', action='store_true', help='Reload the song data in incremental mode')
+    parser.add_argument('--copy-format', choices=['json', 'gzip', 'parquet'], default='json',
+                        help='Load the raw JSON objects or the gzip/Parquet files written by compact.py')
+    parser.add_argument('--skip-maintenance', action='store_true', help='Do not ANALYZE/VACUUM after the load')
+    parser.add_argument('--time-queries', action='store_true',
+                        help='Time the analytical queries before and after the maintenance stage')
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Load the Redshift cluster or the local Postgres stand-in')
+    parser.add_argument('--benchmark', action='store_true', help='Report the seconds every stage of the load took')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    paths = storage_paths(config, args.target)
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = connect(args.target)
     cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+
+    timings = []
+    if args.incremental:
+        if not strip_quotes(paths['MANIFEST_PREFIX']):
+            parser.error('set MANIFEST_PREFIX in dwh.cfg for incremental loads')
+        start_date = args.start
+        if start_date is None:
+            high_water_mark = get_high_water_mark(cur)
+            if high_water_mark is None:
+                parser.error('nothing loaded yet, pass --start for the first incremental window')
+            start_date = datetime.fromtimestamp(high_water_mark / 1000, tz=timezone.utc).date()
+        # not today, the log data may end long before and every month up to today would be listed
+        end_date = args.end or last_log_date(paths['LOG_DATA']) or start_date
+        start = time.perf_counter()
+        loaded = load_staging_window(cur, conn, start_date, end_date, args.with_songs, paths)
+        timings.append(('staging window', time.perf_counter() - start))
+    else:
+        if args.copy_format == 'json':
+            copy_timings = load_staging_tables(cur, conn)
+        else:
+            copy_timings = load_staging_tables(cur, conn, compacted_copy_queries(args.copy_format, paths))
+        timings.extend(('copy {}'.format(table), seconds) for table, seconds in copy_timings.items())
+        loaded = True
+
+    if loaded:
+        insert_timings = insert_tables(cur, conn)
+        timings.extend(('insert {}'.format(table), seconds) for table, seconds in insert_timings.items())
+        update_high_water_mark(cur, conn)
+        if not args.skip_maintenance:
+            start = time.perf_counter()
+            maintenance_stage(conn, time_queries=args.time_queries)
+            timings.append(('maintenance', time.perf_counter() - start))
 
     conn.close()
+    if args.benchmark:
+        print_stage_timings(timings)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+import argparse
+import time
+
+import psycopg2
+
+from dialect import connect
+from sql_queries import analytical_queries, analytical_query_titles
+
+# Unsorted and stale-statistics percentages of every table; svv_table_info on Redshift
+redshift_table_health_select = ("""
+    SELECT "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0), tbl_rows
+    FROM svv_table_info
+    WHERE schema = 'public'
+""")
+
+# Postgres has no sort order, dead rows stand in for the unsorted region and rows modified since the last
+# ANALYZE for stale statistics
+postgres_table_health_select = ("""
+    SELECT relname,
+    100.0 * n_dead_tup / GREATEST(n_live_tup + n_dead_tup, 1),
+    LEAST(100.0, 100.0 * n_mod_since_analyze / GREATEST(n_live_tup, 1)),
+    n_live_tup
+    FROM pg_stat_user_tables
+    WHERE schemaname = 'public'
+""")
+
+
+def get_table_health(cur, conn):
+    """
+    Reads the unsorted and stats-off percentages of the tables, from svv_table_info on Redshift
+    or the Postgres equivalents in pg_stat_user_tables elsewhere
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+
+    :return Tuple of (is_redshift, dict mapping table name to a dict with unsorted, stats_off and rows)
+    """
+    try:
+        cur.execute(redshift_table_health_select)
+        is_redshift = True
+    except psycopg2.Error:
+        conn.rollback()
+        cur.execute(postgres_table_health_select)
+        is_redshift = False
+    health = {table: {'unsorted': float(unsorted), 'stats_off': float(stats_off), 'rows': int(rows)}
+              for table, unsorted, stats_off, rows in cur.fetchall()}
+    conn.commit()
+    return is_redshift, health
+
+
+def plan_maintenance(health, is_redshift, unsorted_pct, stats_off_pct):
+    """
+    Picks the ANALYZE and VACUUM statements needed, only for tables above the thresholds
+
+    :params health: Table health as returned by get_table_health
+    :params is_redshift: Whether the database is Redshift
+    :params unsorted_pct: Unsorted (dead rows on Postgres) percentage above which a table is vacuumed
+    :params stats_off_pct: Stale statistics percentage above which a table is analyzed
+
+    :return List of (table, statement, reason)
+    """
+    statements = []
+    for table, metrics in sorted(health.items()):
+        if metrics['rows'] == 0:
+            continue
+        if metrics['unsorted'] > unsorted_pct:
+            statement = 'VACUUM SORT ONLY {}' if is_redshift else 'VACUUM {}'
+            statements.append((table, statement.format(table), 'unsorted {:.1f}%'.format(metrics['unsorted'])))
+        if metrics['stats_off'] > stats_off_pct:
+            statements.append((table, 'ANALYZE {}'.format(table), 'stats off {:.1f}%'.format(metrics['stats_off'])))
+    return statements
+
+
+def time_analytical_queries(cur, repeat):
+    """
+    Runs every analytical query and keeps the fastest of repeat runs
+
+    :params cur: The cursor for executing queries in the database
+    :params repeat: Number of runs per query
+
+    :return List of elapsed seconds in the order of analytical_queries
+    """
+    timings = []
+    for query in analytical_queries:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+    return timings
+
+
+def maintenance_stage(conn, unsorted_pct=5.0, stats_off_pct=10.0, time_queries=False, repeat=3):
+    """
+    Post-load maintenance: runs targeted ANALYZE and VACUUM SORT ONLY statements on the tables whose unsorted
+    or stats-off percentage is above the thresholds, optionally timing the analytical queries before and after
+
+    :params conn: The connection to the database
+    :params unsorted_pct: Unsorted percentage above which a table is vacuumed
+    :params stats_off_pct: Stale statistics percentage above which a table is analyzed
+    :params time_queries: Whether to time the analytical queries before and after the maintenance
+    :params repeat: Runs per analytical query when timing
+
+    :return None
+    """
+    cur = conn.cursor()
+    if time_queries:
+        before = time_analytical_queries(cur, repeat)
+        conn.commit()
+
+    is_redshift, health = get_table_health(cur, conn)
+    statements = plan_maintenance(health, is_redshift, unsorted_pct, stats_off_pct)
+    if not statements:
+        print("No table needs maintenance")
+
+    # VACUUM cannot run inside a transaction block
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for table, statement, reason in statements:
+            print("{} ({})".format(statement, reason))
+            start = time.perf_counter()
+            cur.execute(statement)
+            print("Done in {:.2f}s".format(time.perf_counter() - start))
+    finally:
+        conn.autocommit = autocommit
+
+    if time_queries:
+        after = time_analytical_queries(cur, repeat)
+        conn.commit()
+        print("{:<45} {:>10} {:>10}".format('query', 'before s', 'after s'))
+        for title, before_seconds, after_seconds in zip(analytical_query_titles, before, after):
+            print("{:<45} {:>10.3f} {:>10.3f}".format(title, before_seconds, after_seconds))
+
+
+def main():
+    """
+    Runs the maintenance stage on the database configured in dwh.cfg and reports analytical query timings
+    before and after it
+
+    :params None
+
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='ANALYZE/VACUUM the Sparkify tables where needed')
+    parser.add_argument('--unsorted-pct', type=float, default=5.0, help='Vacuum tables with more unsorted rows')
+    parser.add_argument('--stats-off-pct', type=float, default=10.0, help='Analyze tables with staler statistics')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per analytical query when timing')
+    parser.add_argument('--no-timing', action='store_true', help='Do not time the analytical queries')
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Maintain the Redshift cluster or the local Postgres stand-in')
+    args = parser.parse_args()
+
+    conn = connect(args.target)
+
+    maintenance_stage(conn, args.unsorted_pct, args.stats_off_pct, not args.no_timing, args.repeat)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
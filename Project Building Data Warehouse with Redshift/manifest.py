@@ -0,0 +1,215 @@
+import configparser
+import json
+import os
+import re
+import shutil
+from datetime import datetime, timedelta
+
+LOG_FILE_DATE = re.compile(r'(\d{4}-\d{2}-\d{2})-events\.json$')
+
+
+def strip_quotes(uri):
+    """
+    Removes the quotes around S3 paths in dwh.cfg, which are there for the COPY statements
+
+    :params uri: Path as written in dwh.cfg
+
+    :return Path without quotes
+    """
+    return uri.strip().strip("'\"")
+
+
+def split_s3_uri(uri):
+    """
+    Splits an s3:// URI into bucket and key
+
+    :params uri: s3://bucket/key URI
+
+    :return Tuple of (bucket, key)
+    """
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def get_s3_client():
+    """
+    Creates a boto3 S3 client with the credentials from the AWS section of dwh.cfg
+
+    :params None
+
+    :return boto3 S3 client
+    """
+    import boto3
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    return boto3.client('s3', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET'))
+
+
+def list_object_sizes(uri):
+    """
+    Lists all objects below an S3 prefix or all files below a local directory, which stands in for S3,
+    together with their size
+
+    :params uri: s3://bucket/prefix URI or local directory
+
+    :return List of (object URI or file path, size in bytes) sorted by URI
+    """
+    uri = strip_quotes(uri)
+    if uri.startswith('s3://'):
+        bucket, prefix = split_s3_uri(uri)
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        return sorted(('s3://{}/{}'.format(bucket, item['Key']), item['Size'])
+                      for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+                      for item in page.get('Contents', []))
+    return sorted((os.path.join(root, name), os.path.getsize(os.path.join(root, name)))
+                  for root, _, files in os.walk(uri) for name in files)
+
+
+def list_objects(uri):
+    """
+    Lists all objects below an S3 prefix or all files below a local directory, which stands in for S3
+
+    :params uri: s3://bucket/prefix URI or local directory
+
+    :return Sorted list of object URIs or file paths
+    """
+    return [path for path, _ in list_object_sizes(uri)]
+
+
+def list_prefixes(uri):
+    """
+    Lists the prefixes one level below an S3 prefix, like directories, or the subdirectories of a local directory
+
+    :params uri: s3://bucket/prefix URI or local directory
+
+    :return Sorted list of the names of the prefixes, without the parent and trailing slash
+    """
+    uri = strip_quotes(uri).rstrip('/')
+    if uri.startswith('s3://'):
+        bucket, prefix = split_s3_uri(uri + '/')
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        return sorted(item['Prefix'][len(prefix):].rstrip('/')
+                      for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+                      for item in page.get('CommonPrefixes', []))
+    if not os.path.isdir(uri):
+        return []
+    return sorted(name for name in os.listdir(uri) if os.path.isdir(os.path.join(uri, name)))
+
+
+def read_object(uri):
+    """
+    Reads the content of an S3 object or a local file
+
+    :params uri: s3:// URI or local path
+
+    :return Content as bytes
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        return get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    with open(uri, 'rb') as f:
+        return f.read()
+
+
+def upload_file(path, uri):
+    """
+    Copies a local file to S3, or to another local path when the target stands in for S3
+
+    :params path: Local file
+    :params uri: s3:// URI or local path of the target
+
+    :return URI or path of the target
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        get_s3_client().upload_file(path, bucket, key)
+    elif os.path.abspath(path) != os.path.abspath(uri):
+        os.makedirs(os.path.dirname(os.path.abspath(uri)), exist_ok=True)
+        shutil.copyfile(path, uri)
+    return uri
+
+
+def list_log_objects(log_data, start_date, end_date):
+    """
+    Lists the log objects of the days between start_date and end_date (both inclusive).
+    Log data is laid out as log_data/<year>/<month>/<year>-<month>-<day>-events.json, so only the
+    month prefixes of the window are listed.
+
+    :params log_data: LOG_DATA prefix from dwh.cfg
+    :params start_date: First day of the window
+    :params end_date: Last day of the window
+
+    :return Sorted list of log object URIs or file paths
+    """
+    log_data = strip_quotes(log_data).rstrip('/')
+    months, day = set(), start_date
+    while day <= end_date:
+        months.add((day.year, day.month))
+        day += timedelta(days=1)
+    objects = []
+    for year, month in sorted(months):
+        for uri in list_objects('{}/{}/{:02d}/'.format(log_data, year, month)):
+            match = LOG_FILE_DATE.search(uri)
+            if match and start_date.isoformat() <= match.group(1) <= end_date.isoformat():
+                objects.append(uri)
+    return objects
+
+
+def last_log_date(log_data):
+    """
+    Day of the newest log object, found by listing the year and month prefixes from the newest down, so only the
+    prefixes up to the last month holding objects are listed
+
+    :params log_data: LOG_DATA prefix from dwh.cfg
+
+    :return datetime.date, or None if there are no log objects
+    """
+    log_data = strip_quotes(log_data).rstrip('/')
+    for year in reversed([name for name in list_prefixes(log_data) if name.isdigit()]):
+        months = [name for name in list_prefixes('{}/{}'.format(log_data, year)) if name.isdigit()]
+        for month in reversed(months):
+            days = [match.group(1) for match in map(LOG_FILE_DATE.search,
+                                                    list_objects('{}/{}/{}/'.format(log_data, year, month))) if match]
+            if days:
+                return datetime.strptime(max(days), '%Y-%m-%d').date()
+    return None
+
+
+def build_manifest(uris, content_lengths=None):
+    """
+    Builds a COPY manifest naming exactly the given objects.
+    Columnar formats like Parquet need the size of every object in the manifest.
+
+    :params uris: Object URIs or file paths
+    :params content_lengths: Optional sizes in bytes of the objects
+
+    :return Manifest as a dict
+    """
+    entries = [{'url': uri, 'mandatory': True} for uri in uris]
+    if content_lengths is not None:
+        for entry, content_length in zip(entries, content_lengths):
+            entry['meta'] = {'content_length': content_length}
+    return {'entries': entries}
+
+
+def write_manifest(manifest, uri):
+    """
+    Writes a COPY manifest to S3 or to a local file
+
+    :params manifest: Manifest as a dict
+    :params uri: s3:// URI or local path of the manifest
+
+    :return URI or path the manifest was written to
+    """
+    uri = strip_quotes(uri)
+    body = json.dumps(manifest, indent=2)
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(uri)), exist_ok=True)
+        with open(uri, 'w') as f:
+            f.write(body)
+    return uri
@@ -0,0 +1,355 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import psycopg2
+
+from dialect import connect
+from sql_queries import analytical_queries, analytical_query_titles, table_versions_select
+
+
+def read_workload(path):
+    """
+    Reads a workload file of analytic queries separated by semicolons.
+    A '-- name: <title>' comment line before a query sets its title.
+
+    :params path: Path of the workload file
+
+    :return List of (title, query)
+    """
+    with open(path) as f:
+        content = f.read()
+    workload = []
+    for number, statement in enumerate(content.split(';'), 1):
+        title = re.search(r'^\s*--\s*name:\s*(.+)$', statement, re.MULTILINE)
+        query = '\n'.join(line for line in statement.splitlines() if not line.strip().startswith('--')).strip()
+        if query:
+            workload.append((title.group(1).strip() if title else 'Query {}'.format(number), query))
+    return workload
+
+
+def referenced_tables(query):
+    """
+    Lists the tables a query reads from
+
+    :params query: SQL query
+
+    :return Sorted list of table names
+    """
+    return sorted({table.lower() for table in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)', query, re.IGNORECASE)})
+
+
+def get_table_versions(cur, conn):
+    """
+    Reads the version stamps the ETL bumps on every load
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+
+    :return Dict mapping table name to version, None if the table_versions table cannot be read
+    """
+    try:
+        cur.execute(table_versions_select)
+        versions = dict(cur.fetchall())
+    except psycopg2.Error as e:
+        print("Cannot read the table versions, the result cache is off for this run: {}".format(
+            str(e).strip().splitlines()[0]))
+        versions = None
+    conn.rollback()
+    return versions
+
+
+def version_stamp(query, versions):
+    """
+    Version stamp of the data a query reads, changes whenever one of its tables is reloaded
+
+    :params query: SQL query
+    :params versions: Table versions as returned by get_table_versions
+
+    :return Stamp string
+    """
+    return ','.join('{}:{}'.format(table, versions.get(table, 0)) for table in referenced_tables(query))
+
+
+def cache_key(query, stamp):
+    """
+    Key of the cached result of a query on one version of its tables
+
+    :params query: SQL query
+    :params stamp: Version stamp as returned by version_stamp
+
+    :return Hex digest
+    """
+    return hashlib.sha256('{}\n{}'.format(' '.join(query.split()), stamp).encode('utf-8')).hexdigest()
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile
+
+    :params values: List of numbers
+    :params pct: Percentile between 0 and 100
+
+    :return Percentile of the values
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def plan_hash(plan):
+    """
+    Hash of the shape of a plan, ignoring the cost and row estimates that change with every load
+
+    :params plan: EXPLAIN output
+
+    :return Short hex digest
+    """
+    shape = re.sub(r'\(cost=[^)]*\)', '', plan)
+    return hashlib.sha256(shape.encode('utf-8')).hexdigest()[:16]
+
+
+class QueryRunner:
+    """
+    Runs a workload of analytic queries with a pool of connections, capturing wall time and EXPLAIN plans and
+    caching results on disk keyed on the query text and the version stamp of the tables it reads
+    """
+
+    def __init__(self, target, concurrency, cache_dir, history_path):
+        self.target = target
+        self.concurrency = concurrency
+        self.cache_dir = cache_dir
+        self.history_path = history_path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def connection(self):
+        """
+        Connection of the current worker thread, opened on first use
+
+        :return psycopg2 connection
+        """
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = connect(self.target)
+            with self.lock:
+                self.connections.append(self.local.conn)
+        return self.local.conn
+
+    def close(self):
+        """
+        Closes the connections of all worker threads
+        """
+        for conn in self.connections:
+            conn.close()
+
+    def cached_result(self, key):
+        """
+        Reads a cached result
+
+        :params key: Cache key as returned by cache_key
+
+        :return Dict with title, columns and rows, or None if the result is not cached or unreadable
+        """
+        path = os.path.join(self.cache_dir, '{}.json'.format(key))
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_result(self, key, title, columns, rows):
+        """
+        Caches the result of a query. The result is written to a temporary file that replaces the cache entry
+        in one step, so concurrent runs of the same query never read a partly written entry.
+
+        :params key: Cache key as returned by cache_key
+        :params title: Title of the query
+        :params columns: Column names of the result
+        :params rows: Result rows
+
+        :return None
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.{}.'.format(key), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'title': title, 'columns': columns, 'rows': rows}, f, default=str)
+            os.replace(temp_path, os.path.join(self.cache_dir, '{}.json'.format(key)))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def explain(self, query):
+        """
+        Captures the EXPLAIN plan of a query
+
+        :params query: SQL query
+
+        :return Plan text
+        """
+        conn = self.connection()
+        cur = conn.cursor()
+        cur.execute("EXPLAIN {}".format(query))
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        conn.rollback()
+        return plan
+
+    def execute(self, title, query, stamp, use_cache):
+        """
+        Returns the result of a query from the cache, or executes and times it and caches the result
+
+        :params title: Title of the query
+        :params query: SQL query
+        :params stamp: Version stamp of the tables the query reads, None if unknown, then nothing is cached
+        :params use_cache: Whether a cached result may be returned
+
+        :return Dict with title, cached, seconds and rows
+        """
+        key = cache_key(query, stamp or '')
+        if use_cache and stamp is not None:
+            cached = self.cached_result(key)
+            if cached is not None:
+                return {'title': title, 'cached': True, 'seconds': None, 'rows': len(cached['rows'])}
+        conn = self.connection()
+        cur = conn.cursor()
+        start = time.perf_counter()
+        cur.execute(query)
+        rows = cur.fetchall()
+        seconds = time.perf_counter() - start
+        conn.rollback()
+        if stamp is not None:
+            self.store_result(key, title, [column[0] for column in cur.description], rows)
+        return {'title': title, 'cached': False, 'seconds': seconds, 'rows': len(rows)}
+
+    def run(self, workload, runs, use_cache):
+        """
+        Runs every query of the workload runs times on the worker pool and appends the timings to the history
+
+        :params workload: List of (title, query)
+        :params runs: Number of runs of the whole workload
+        :params use_cache: Whether cached results may be returned instead of executing
+
+        :return Dict mapping query title to a dict with stamp, plan, plan_hash and results
+        """
+        # without the versions a stamp could not tell a reloaded table, so results are neither read nor stored
+        versions = get_table_versions(self.connection().cursor(), self.connection())
+        report = {}
+        for title, query in workload:
+            plan = self.explain(query)
+            stamp = version_stamp(query, versions) if versions is not None else None
+            report[title] = {'query': query, 'stamp': stamp, 'plan': plan,
+                             'plan_hash': plan_hash(plan), 'results': []}
+
+        tasks = [(title, query) for _ in range(runs) for title, query in workload]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(lambda task: self.execute(task[0], task[1], report[task[0]]['stamp'], use_cache),
+                                   tasks)
+            for result in results:
+                report[result['title']]['results'].append(result)
+
+        with open(self.history_path, 'a') as f:
+            for title, entry in report.items():
+                for result in entry['results']:
+                    if not result['cached']:
+                        f.write(json.dumps({'at': datetime.now(timezone.utc).isoformat(), 'title': title,
+                                            'query_hash': cache_key(entry['query'], ''), 'stamp': entry['stamp'],
+                                            'plan_hash': entry['plan_hash'], 'seconds': result['seconds']}) + '\n')
+        return report
+
+
+def read_history(path):
+    """
+    Reads the timings of all earlier runs
+
+    :params path: Path of the history file
+
+    :return List of history entries
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_report(report, history, previous_history):
+    """
+    Prints p50/p95 wall time of every query across all recorded runs of the same query text,
+    the cache hits of this invocation and whether the plan differs from the one of the previous invocation
+
+    :params report: Report as returned by QueryRunner.run
+    :params history: History entries including this invocation, as returned by read_history
+    :params previous_history: History entries recorded before this invocation
+
+    :return None
+    """
+    print("{:<45} {:>6} {:>6} {:>10} {:>10} {:>8}".format('query', 'runs', 'cached', 'p50 s', 'p95 s', 'plan'))
+    for title, entry in report.items():
+        query_hash = cache_key(entry['query'], '')
+        timings = [item for item in history if item['query_hash'] == query_hash]
+        seconds = [item['seconds'] for item in timings]
+        cached = sum(1 for result in entry['results'] if result['cached'])
+        previous = [item['plan_hash'] for item in previous_history if item['query_hash'] == query_hash]
+        plan_state = 'new' if not previous else 'same' if previous[-1] == entry['plan_hash'] else 'changed'
+        if seconds:
+            print("{:<45} {:>6} {:>6} {:>10.3f} {:>10.3f} {:>8}".format(
+                title[:45], len(seconds), cached, percentile(seconds, 50), percentile(seconds, 95), plan_state))
+        else:
+            print("{:<45} {:>6} {:>6} {:>10} {:>10} {:>8}".format(title[:45], 0, cached, '-', '-', plan_state))
+
+
+def main():
+    """
+    Runs the analytic workload (analytical_queries from sql_queries by default) against the database
+    configured in dwh.cfg and reports p50/p95 wall time per query across runs
+
+    :params None
+
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Run the Sparkify analytic queries with timing and caching')
+    parser.add_argument('--workload', help='File of queries separated by semicolons, analytical_queries if not given')
+    parser.add_argument('--runs', type=int, default=1, help='Runs of the whole workload')
+    parser.add_argument('--concurrency', type=int, default=4, help='Queries executed concurrently')
+    parser.add_argument('--no-cache', action='store_true', help='Always execute the queries, e.g. to measure them')
+    parser.add_argument('--cache', action='store_true',
+                        help='Return cached results also with --runs above 1, which then records few timings')
+    parser.add_argument('--cache-dir', default='.query_cache', help='Directory of cached results')
+    parser.add_argument('--history', default='query_history.jsonl', help='File the timings of every run are added to')
+    parser.add_argument('--report', help='Write the plans and timings of this invocation to a JSON file')
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Run on the Redshift cluster or the local Postgres stand-in')
+    args = parser.parse_args()
+
+    if args.workload:
+        workload = read_workload(args.workload)
+    else:
+        workload = list(zip(analytical_query_titles, analytical_queries))
+
+    # repeated runs are for timing, cached results would leave p50/p95 with one sample per query
+    use_cache = not args.no_cache and (args.runs == 1 or args.cache)
+    if not use_cache and not args.no_cache:
+        print("Result cache is off for --runs {}, pass --cache to use it".format(args.runs))
+
+    previous_history = read_history(args.history)
+    runner = QueryRunner(args.target, args.concurrency, args.cache_dir, args.history)
+    try:
+        report = runner.run(workload, args.runs, use_cache)
+    finally:
+        runner.close()
+
+    print_report(report, read_history(args.history), previous_history)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
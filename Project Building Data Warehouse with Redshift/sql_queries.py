@@ -7,6 +7,8 @@ config.read('dwh.cfg')
 S3_LOG_DATA = config.get('S3', 'LOG_DATA')
 S3_LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH')
 S3_SONG_DATA = config.get('S3', 'SONG_DATA')
+S3_MANIFEST_PREFIX = config.get('S3', 'MANIFEST_PREFIX')
+S3_COMPACT_PREFIX = config.get('S3', 'COMPACT_PREFIX')
 DWH_IAM_ROLE_ARN = config.get("IAM_ROLE", "ARN")
 
 # DROP TABLES
@@ -18,13 +20,19 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+song_lookup_table_drop = "DROP TABLE IF EXISTS song_lookup;"
+load_state_table_drop = "DROP TABLE IF EXISTS load_state;"
+table_versions_table_drop = "DROP TABLE IF EXISTS table_versions;"
  
 # CREATE TABLES
+# Distribution and sort keys follow table_design.py on the analytical_queries workload with the dataset's row
+# counts (songplays 7k, users 100, songs 400k, artists 10k, time 8k): all dimensions are copied to every node, so
+# songplays joins them without moving data and is distributed evenly.
 
 staging_events_table_create= ("""
     CREATE TABLE staging_events ( artist VARCHAR(500), auth VARCHAR(20), firstName VARCHAR(500), gender CHAR(1), itemInSession INTEGER,
     lastName VARCHAR(500), length DECIMAL(12, 5), level VARCHAR(10), location VARCHAR(500), method VARCHAR(20), page VARCHAR(500),
-    registration FLOAT, sessionId INTEGER, song VARCHAR(500), status INTEGER, ts VARCHAR(50), userAgent VARCHAR(500), userId INTEGER
+    registration FLOAT, sessionId INTEGER, song VARCHAR(500), status INTEGER, ts BIGINT, userAgent VARCHAR(500), userId INTEGER
     );
 """)
 
@@ -35,35 +43,70 @@ staging_songs_table_create = ("""
 """)
 
 songplay_table_create = ("""
-    CREATE TABLE IF NOT EXISTS songplays ( songplay_id INTEGER IDENTITY(0,1) SORTKEY, start_time TIMESTAMP NOT NULL, 
+    CREATE TABLE IF NOT EXISTS songplays ( songplay_id INTEGER IDENTITY(0,1), start_time TIMESTAMP NOT NULL, 
     user_id INTEGER NOT NULL REFERENCES users (user_id), level VARCHAR(10), song_id VARCHAR(20) REFERENCES songs (song_id),
     artist_id VARCHAR(20) REFERENCES artists (artist_id), session_id INTEGER NOT NULL, location VARCHAR(500), user_agent VARCHAR(500)
     )
+    DISTSTYLE EVEN
+    COMPOUND SORTKEY (start_time)
 """)
 
 user_table_create = ("""
     CREATE TABLE IF NOT EXISTS users ( user_id INTEGER PRIMARY KEY, first_name VARCHAR(500) NOT NULL, last_name VARCHAR(500) NOT NULL,
     gender CHAR(1), level VARCHAR(10) NOT NULL
     )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (user_id)
 """)
 
 song_table_create = ("""
-    CREATE TABLE IF NOT EXISTS songs ( song_id VARCHAR(20) PRIMARY KEY, title VARCHAR(500) NOT NULL SORTKEY, 
-    artist_id VARCHAR NOT NULL DISTKEY REFERENCES artists (artist_id), year INTEGER NOT NULL,
+    CREATE TABLE IF NOT EXISTS songs ( song_id VARCHAR(20) PRIMARY KEY, title VARCHAR(500) NOT NULL, 
+    artist_id VARCHAR NOT NULL REFERENCES artists (artist_id), year INTEGER NOT NULL,
     duration DECIMAL (15, 5) NOT NULL
     )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (song_id)
 """)
 
 artist_table_create = ("""
-    CREATE TABLE IF NOT EXISTS artists ( artist_id VARCHAR(20) PRIMARY KEY, name VARCHAR(500) NOT NULL SORTKEY,
+    CREATE TABLE IF NOT EXISTS artists ( artist_id VARCHAR(20) PRIMARY KEY, name VARCHAR(500) NOT NULL,
     location VARCHAR(500), latitude DECIMAL(12,6), longitude DECIMAL(12,6)
     )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (artist_id)
 """)
 
 time_table_create = ("""
-    CREATE TABLE IF NOT EXISTS time ( start_time TIMESTAMP NOT NULL PRIMARY KEY SORTKEY, hour NUMERIC NOT NULL,
+    CREATE TABLE IF NOT EXISTS time ( start_time TIMESTAMP NOT NULL PRIMARY KEY, hour NUMERIC NOT NULL,
     day NUMERIC NOT NULL, week NUMERIC NOT NULL, month NUMERIC NOT NULL, year NUMERIC NOT NULL, weekday NUMERIC NOT NULL
     )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (start_time)
+""")
+
+# Deduplicated (title, artist_name, duration) -> (song_id, artist_id) lookup used to match log events to songs.
+# It is small enough to be copied to every node and is sorted on the join keys, so the songplays load joins
+# it without redistributing staging_events.
+song_lookup_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_lookup ( title VARCHAR(500) NOT NULL, artist_name VARCHAR(500) NOT NULL,
+    duration DECIMAL(15, 5) NOT NULL, song_id VARCHAR(20) NOT NULL, artist_id VARCHAR(20) NOT NULL
+    )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (title, artist_name, duration)
+""")
+
+# High-water mark of the loaded staging data, so incremental runs only merge events newer than the last load
+load_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_state ( table_name VARCHAR(50) PRIMARY KEY, high_water_ts BIGINT NOT NULL,
+    loaded_at TIMESTAMP NOT NULL
+    )
+""")
+
+# Version stamp of every warehouse table, bumped by the ETL on every load and used to key cached query results
+table_versions_table_create = ("""
+    CREATE TABLE IF NOT EXISTS table_versions ( table_name VARCHAR(50) NOT NULL, version INTEGER NOT NULL,
+    loaded_at TIMESTAMP NOT NULL
+    )
 """)
 
 # STAGING TABLES
@@ -80,67 +123,241 @@ staging_songs_copy = ("""
     format as json 'auto'
 """).format(S3_SONG_DATA, DWH_IAM_ROLE_ARN)
 
+# Incremental loads COPY only the log objects of one window, listed in a manifest
+staging_events_copy_manifest = ("""
+    copy staging_events from '{}' region 'us-west-2'
+    iam_role '{}' compupdate off statupdate off
+    format as json {} timeformat as 'epochmillisecs'
+    manifest
+""")
+
+# compact.py packs the small JSON objects into a multiple of the slice count of gzip or Parquet files,
+# COPY reads them through the manifest it writes
+staging_events_copy_gzip = ("""
+    copy staging_events from '{}' region 'us-west-2'
+    iam_role '{}' compupdate off statupdate off
+    format as json {} gzip timeformat as 'epochmillisecs'
+    manifest
+""")
+
+staging_songs_copy_gzip = ("""
+    copy staging_songs from '{}' region 'us-west-2'
+    iam_role '{}' compupdate off statupdate off
+    format as json 'auto' gzip
+    manifest
+""")
+
+staging_events_copy_parquet = ("""
+    copy staging_events from '{}'
+    iam_role '{}'
+    format as parquet
+    manifest
+""")
+
+staging_songs_copy_parquet = ("""
+    copy staging_songs from '{}'
+    iam_role '{}'
+    format as parquet
+    manifest
+""")
+
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+
+# INCREMENTAL STATE
+
+high_water_mark_select = "SELECT high_water_ts FROM load_state WHERE table_name = 'staging_events';"
+
+# Drops staging events that were already merged by an earlier window. Events at the high-water mark are kept, a
+# later file can hold another event of the same millisecond, and the songplays anti-join skips those already loaded
+staging_events_delete_loaded = ("""
+    DELETE FROM staging_events
+    WHERE ts < (SELECT high_water_ts FROM load_state WHERE table_name = 'staging_events');
+""")
+
+high_water_mark_update = ("""
+    CREATE TEMP TABLE load_state_stage AS
+    SELECT 'staging_events' AS table_name, MAX(ts) AS high_water_ts
+    FROM (
+        SELECT ts FROM staging_events
+        UNION ALL
+        SELECT high_water_ts AS ts FROM load_state WHERE table_name = 'staging_events'
+    ) loaded
+    HAVING MAX(ts) IS NOT NULL;
+
+    DELETE FROM load_state USING load_state_stage WHERE load_state.table_name = load_state_stage.table_name;
+
+    INSERT INTO load_state (table_name, high_water_ts, loaded_at)
+    SELECT table_name, high_water_ts, GETDATE() FROM load_state_stage;
+
+    DROP TABLE load_state_stage;
+""")
+
 # FINAL TABLES
+# Each load dedups staging into a temp table and anti-joins it against the target on the table key
+# (LEFT JOIN ... IS NULL) instead of NOT IN over the whole target, so the cost grows with the size of
+# staging rather than staging x warehouse. All statements of one load run in a single transaction.
+
+# The lookup keeps every spelling of an artist's name from the song files, as the events name artists the same
+# way, and the staged keys are replaced on each load so a changed song or artist id is picked up.
+song_lookup_table_insert = ("""
+    CREATE TEMP TABLE song_lookup_stage AS
+    SELECT title, artist_name, duration, song_id, artist_id
+    FROM (
+        SELECT title, artist_name, duration, song_id, artist_id,
+        ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS row_num
+        FROM staging_songs
+        WHERE title IS NOT NULL AND artist_name IS NOT NULL AND duration IS NOT NULL
+        AND song_id IS NOT NULL AND artist_id IS NOT NULL
+    ) unique_songs
+    WHERE row_num = 1;
+
+    DELETE FROM song_lookup USING song_lookup_stage
+    WHERE song_lookup.title = song_lookup_stage.title AND song_lookup.artist_name = song_lookup_stage.artist_name
+    AND song_lookup.duration = song_lookup_stage.duration;
 
+    INSERT INTO song_lookup (title, artist_name, duration, song_id, artist_id)
+    SELECT title, artist_name, duration, song_id, artist_id FROM song_lookup_stage;
+
+    DROP TABLE song_lookup_stage;
+""")
+
+# Staging can hold an event twice, e.g. a full load after an incremental one, so the plays are deduped on the
+# key of the anti-join, start_time being ts in whole seconds
 songplay_table_insert = ("""
+    CREATE TEMP TABLE songplays_stage AS
+    SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM (
+        SELECT TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time, e.userId AS user_id,
+        e.level, l.song_id AS song_id, l.artist_id AS artist_id, e.sessionId AS session_id, e.location AS location, e.userAgent AS user_agent,
+        ROW_NUMBER() OVER (PARTITION BY e.ts/1000, e.userId, e.sessionId ORDER BY e.itemInSession, l.song_id) AS row_num
+        FROM staging_events e
+        JOIN song_lookup l ON e.song = l.title AND e.artist = l.artist_name AND e.length = l.duration
+        WHERE e.page = 'NextSong'
+    ) unique_plays
+    WHERE row_num = 1;
+
     INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' AS start_time, e.userId as user_id,
-    e.level, s.song_id AS song_id, s.artist_id AS artist_id, e.sessionId AS session_id, e.location AS location, e.userAgent AS user_agent
-    FROM
-        staging_events e, staging_songs s
-    WHERE 
-        e.page = 'NextSong' AND  e.song = s.title AND  e.userId NOT IN 
-        ( 
-            SELECT DISTINCT s2.user_id FROM songplays s2 WHERE s2.user_id = e.userId AND s2.session_id = e.sessionId
-        ) 
+    SELECT n.start_time, n.user_id, n.level, n.song_id, n.artist_id, n.session_id, n.location, n.user_agent
+    FROM songplays_stage n
+    LEFT JOIN songplays p ON p.start_time = n.start_time AND p.user_id = n.user_id AND p.session_id = n.session_id
+    WHERE p.user_id IS NULL;
+
+    DROP TABLE songplays_stage;
 """)
 
 user_table_insert = ("""
+    CREATE TEMP TABLE users_stage AS
+    SELECT user_id, first_name, last_name, gender, level
+    FROM (
+        SELECT userId AS user_id, firstName AS first_name, lastName AS last_name, gender, level,
+        ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_num
+        FROM staging_events
+        WHERE page = 'NextSong' AND userId IS NOT NULL
+    ) latest
+    WHERE row_num = 1;
+
+    DELETE FROM users USING users_stage WHERE users.user_id = users_stage.user_id;
+
     INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT userId AS user_id, firstName AS first_name, lastName AS last_name, gender, level
-    FROM staging_events
-    WHERE page = 'NextSong' AND user_id NOT IN (SELECT DISTINCT user_id FROM users)
+    SELECT user_id, first_name, last_name, gender, level FROM users_stage;
+
+    DROP TABLE users_stage;
 """)
 
 song_table_insert = ("""
+    CREATE TEMP TABLE songs_stage AS
+    SELECT song_id, title, artist_id, year, duration
+    FROM (
+        SELECT song_id, title, artist_id, year, duration, ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS row_num
+        FROM staging_songs
+        WHERE song_id IS NOT NULL
+    ) unique_songs
+    WHERE row_num = 1;
+
     INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT DISTINCT song_id, title, artist_id, year, duration
-    FROM staging_songs
-    WHERE song_id NOT IN (SELECT DISTINCT song_id FROM songs)
+    SELECT n.song_id, n.title, n.artist_id, n.year, n.duration
+    FROM songs_stage n
+    LEFT JOIN songs s ON s.song_id = n.song_id
+    WHERE s.song_id IS NULL;
+
+    DROP TABLE songs_stage;
 """)
 
 artist_table_insert = ("""
+    CREATE TEMP TABLE artists_stage AS
+    SELECT artist_id, name, location, latitude, longitude
+    FROM (
+        SELECT artist_id, artist_name AS name, artist_location AS location, artist_latitude AS latitude, artist_longitude AS longitude,
+        ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS row_num
+        FROM staging_songs
+        WHERE artist_id IS NOT NULL
+    ) unique_artists
+    WHERE row_num = 1;
+
     INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT DISTINCT artist_id, artist_name AS name, artist_location AS location, artist_latitude AS latitude, artist_longitude AS longitude
-    FROM staging_songs
-    WHERE artist_id NOT IN (SELECT DISTINCT artist_id FROM artists)
+    SELECT n.artist_id, n.name, n.location, n.latitude, n.longitude
+    FROM artists_stage n
+    LEFT JOIN artists a ON a.artist_id = n.artist_id
+    WHERE a.artist_id IS NULL;
+
+    DROP TABLE artists_stage;
 """)
 
 time_table_insert = ("""
+    CREATE TEMP TABLE time_stage AS
+    SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' AS start_time
+    FROM staging_events;
+
     INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-    SELECT ts AS start_time, 
-    EXTRACT(hr FROM ts) AS hour, EXTRACT(d FROM ts) AS day, EXTRACT(w FROM ts) AS week,
-    EXTRACT(mon FROM ts) AS month, EXTRACT(yr FROM ts) AS year, EXTRACT(weekday FROM ts) AS weekday
-    FROM ( 
-    SELECT DISTINCT  TIMESTAMP 'epoch' + ts/1000 *INTERVAL '1 second' as ts FROM staging_events s     
-    )
-    WHERE start_time NOT IN (SELECT DISTINCT start_time FROM time)
+    SELECT n.start_time,
+    EXTRACT(hr FROM n.start_time) AS hour, EXTRACT(d FROM n.start_time) AS day, EXTRACT(w FROM n.start_time) AS week,
+    EXTRACT(mon FROM n.start_time) AS month, EXTRACT(yr FROM n.start_time) AS year, EXTRACT(weekday FROM n.start_time) AS weekday
+    FROM time_stage n
+    LEFT JOIN time t ON t.start_time = n.start_time
+    WHERE t.start_time IS NULL;
+
+    DROP TABLE time_stage;
+""")
+
+# VERSION STAMPS
+
+table_version_bump = ("""
+    INSERT INTO table_versions (table_name, version, loaded_at)
+    SELECT '{0}', COALESCE(MAX(version), 0) + 1, GETDATE() FROM table_versions WHERE table_name = '{0}';
+
+    DELETE FROM table_versions
+    WHERE table_name = '{0}' AND version < (SELECT MAX(version) FROM table_versions WHERE table_name = '{0}');
 """)
 
+table_versions_select = "SELECT table_name, version FROM table_versions;"
+
 analytical_queries = [
     'SELECT COUNT(*) AS total FROM artists',
     'SELECT COUNT(*) AS total FROM songs',
     'SELECT COUNT(*) AS total FROM time',
     'SELECT COUNT(*) AS total FROM users',
-    'SELECT COUNT(*) AS total FROM songplays'
+    'SELECT COUNT(*) AS total FROM songplays',
+    """SELECT s.title, a.name AS artist, COUNT(*) AS plays FROM songplays sp JOIN songs s ON sp.song_id = s.song_id
+    JOIN artists a ON sp.artist_id = a.artist_id GROUP BY s.title, a.name ORDER BY plays DESC LIMIT 10""",
+    """SELECT t.hour, COUNT(*) AS plays FROM songplays sp JOIN time t ON sp.start_time = t.start_time
+    GROUP BY t.hour ORDER BY t.hour""",
+    """SELECT u.level, COUNT(*) AS plays FROM songplays sp JOIN users u ON sp.user_id = u.user_id
+    WHERE sp.start_time BETWEEN '2018-11-01' AND '2018-11-30' GROUP BY u.level"""
 ]
-analytical_query_titles = ['Artists table count','Songs table count','Time table count','Users table count','Song plays table count']
+analytical_query_titles = ['Artists table count','Songs table count','Time table count','Users table count','Song plays table count',
+                           'Top 10 songs','Song plays per hour of day','Song plays per user level in November 2018']
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create,staging_songs_table_create,time_table_create,user_table_create,artist_table_create,song_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create,staging_songs_table_create,time_table_create,user_table_create,artist_table_create,song_table_create, songplay_table_create, song_lookup_table_create, load_state_table_create, table_versions_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, song_lookup_table_drop, load_state_table_drop, table_versions_table_drop]
 copy_table_order = ['staging_events', 'staging_songs']
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_order = ['artists', 'songs', 'time', 'users', 'songplays']
-insert_table_queries = [artist_table_insert, song_table_insert, time_table_insert, user_table_insert, songplay_table_insert]
+truncate_staging_queries = [staging_events_truncate, staging_songs_truncate]
+compacted_copy_table_queries = {
+    'gzip': [staging_events_copy_gzip, staging_songs_copy_gzip],
+    'parquet': [staging_events_copy_parquet, staging_songs_copy_parquet],
+}
+insert_table_order = ['artists', 'songs', 'song_lookup', 'time', 'users', 'songplays']
+insert_table_queries = [artist_table_insert, song_table_insert, song_lookup_table_insert, time_table_insert, user_table_insert, songplay_table_insert]
@@ -0,0 +1,329 @@
+import argparse
+import json
+import re
+from collections import Counter, defaultdict
+
+import psycopg2
+
+from dialect import connect
+from sql_queries import analytical_queries, analytical_query_titles, create_table_queries
+
+CANDIDATE_SCHEMA = 'design_candidate'
+SQL_KEYWORDS = {'on', 'join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'where', 'group', 'order', 'limit',
+                'having', 'union', 'using', 'as'}
+FILTER_OPERATORS = r'(?:=|<>|!=|<=|>=|<|>|\bBETWEEN\b|\bIN\b|\bLIKE\b|\bIS\b)'
+
+
+def split_columns(body):
+    """
+    Splits the body of a CREATE TABLE statement into column definitions, ignoring commas inside parentheses
+
+    :params body: Text between the outer parentheses of the statement
+
+    :return List of column definitions
+    """
+    columns, depth, current = [], 0, ''
+    for char in body:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            columns.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        columns.append(current.strip())
+    return columns
+
+
+def parse_create_table(query):
+    """
+    Extracts the table name, column definitions and outer parentheses of a CREATE TABLE statement
+
+    :params query: CREATE TABLE statement from sql_queries
+
+    :return Dict with name, columns (name -> definition), body_start and body_end
+    """
+    name = re.search(r'CREATE TABLE (?:IF NOT EXISTS )?(\w+)', query, re.IGNORECASE).group(1)
+    body_start = query.index('(')
+    depth = 0
+    for position in range(body_start, len(query)):
+        if query[position] == '(':
+            depth += 1
+        elif query[position] == ')':
+            depth -= 1
+            if depth == 0:
+                body_end = position
+                break
+    columns = {}
+    for definition in split_columns(query[body_start + 1:body_end]):
+        columns[definition.split()[0].lower()] = definition
+    return {'name': name.lower(), 'columns': columns, 'body_start': body_start, 'body_end': body_end}
+
+
+def analyze_workload(queries, tables):
+    """
+    Collects how the tables are used by a workload of analytic queries:
+    equi-join columns with their partner tables, filtered columns and grouped/ordered columns
+
+    :params queries: List of SQL queries
+    :params tables: Dict mapping table name to its parsed CREATE TABLE statement
+
+    :return Dict with joins (table -> Counter of (column, partner table)), filters and groupings (table -> Counter of column)
+    """
+    usage = {'joins': defaultdict(Counter), 'filters': defaultdict(Counter), 'groupings': defaultdict(Counter)}
+    for query in queries:
+        aliases = {}
+        for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', query, re.IGNORECASE):
+            table = table.lower()
+            if table not in tables:
+                continue
+            aliases[table] = table
+            if alias and alias.lower() not in SQL_KEYWORDS:
+                aliases[alias.lower()] = table
+        query_tables = set(aliases.values())
+
+        def resolve(alias, column):
+            column = column.lower()
+            if alias:
+                table = aliases.get(alias.lower())
+                return (table, column) if table and column in tables[table]['columns'] else None
+            owners = [table for table in query_tables if column in tables[table]['columns']]
+            return (owners[0], column) if len(owners) == 1 else None
+
+        join_pattern = r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)'
+        for left_alias, left_column, right_alias, right_column in re.findall(join_pattern, query):
+            left, right = resolve(left_alias, left_column), resolve(right_alias, right_column)
+            if left and right and left[0] != right[0]:
+                usage['joins'][left[0]][(left[1], right[0])] += 1
+                usage['joins'][right[0]][(right[1], left[0])] += 1
+
+        where = re.search(r'\bWHERE\b(.*?)(?:\bGROUP BY\b|\bORDER BY\b|\bLIMIT\b|$)', query, re.IGNORECASE | re.DOTALL)
+        if where:
+            predicates = re.sub(join_pattern, ' ', where.group(1))
+            for alias, column in re.findall(r'(?:(\w+)\.)?(\w+)\s*' + FILTER_OPERATORS, predicates, re.IGNORECASE):
+                resolved = resolve(alias, column)
+                if resolved:
+                    usage['filters'][resolved[0]][resolved[1]] += 1
+
+        for clause in re.findall(r'\b(?:GROUP|ORDER) BY\b(.*?)(?:\bORDER BY\b|\bLIMIT\b|\bHAVING\b|$)', query,
+                                 re.IGNORECASE | re.DOTALL):
+            for alias, column in re.findall(r'(?:(\w+)\.)?(\w+)', clause):
+                resolved = resolve(alias, column)
+                if resolved:
+                    usage['groupings'][resolved[0]][resolved[1]] += 1
+    return usage
+
+
+def recommend_design(tables, usage, table_rows, small_table_rows):
+    """
+    Recommends a distribution style, distribution key and sort key for every table.
+
+    Dimension tables (joined on their primary key) of up to small_table_rows rows are copied to every node
+    (DISTSTYLE ALL). Other tables are distributed on the join column whose partner tables hold the most rows, so
+    the most expensive join is collocated; partners distributed ALL do not count, as joins to them move no data. Filtered columns become the sort key, interleaved when several columns
+    are filtered about equally often and compound otherwise; tables without filters are sorted on their busiest
+    join column. Tables the workload does not reference get no recommendation and keep their current design.
+
+    :params tables: Dict mapping table name to its parsed CREATE TABLE statement
+    :params usage: Workload usage as returned by analyze_workload
+    :params table_rows: Dict mapping table name to its row count
+    :params small_table_rows: Largest row count of a table that is distributed with DISTSTYLE ALL
+
+    :return Dict mapping table name to a dict with diststyle, distkey, sortkey_style and sortkey, or None
+    """
+    distributed_all = set()
+    for table in tables:
+        joins = usage['joins'].get(table, Counter())
+        primary_keys = {column for column, definition in tables[table]['columns'].items()
+                        if 'PRIMARY KEY' in definition.upper()}
+        is_dimension = not joins or bool(primary_keys & {column for column, _ in joins})
+        if table_rows.get(table, 0) <= small_table_rows and is_dimension:
+            distributed_all.add(table)
+
+    design = {}
+    for table in tables:
+        joins = usage['joins'].get(table, Counter())
+        filters = usage['filters'].get(table, Counter())
+        if not joins and not filters and not usage['groupings'].get(table):
+            design[table] = None
+            continue
+
+        join_count, join_weight = Counter(), Counter()
+        for (column, partner), count in joins.items():
+            join_count[column] += count
+            if partner not in distributed_all:
+                join_weight[column] += count * max(table_rows.get(partner, 0), 1)
+
+        if table in distributed_all:
+            diststyle, distkey = 'ALL', None
+        elif join_weight:
+            diststyle, distkey = 'KEY', join_weight.most_common(1)[0][0]
+        else:
+            diststyle, distkey = 'EVEN', None
+
+        ranked_filters = [column for column, _ in filters.most_common()]
+        if len(ranked_filters) > 1 and filters.most_common()[0][1] <= 2 * filters.most_common()[-1][1]:
+            sortkey_style, sortkey = 'INTERLEAVED', ranked_filters
+        elif ranked_filters:
+            sortkey_style, sortkey = 'COMPOUND', ranked_filters
+        elif join_count:
+            sortkey_style, sortkey = 'COMPOUND', [join_count.most_common(1)[0][0]]
+        else:
+            sortkey_style, sortkey = None, []
+        design[table] = {'diststyle': diststyle, 'distkey': distkey, 'sortkey_style': sortkey_style, 'sortkey': sortkey}
+    return design
+
+
+def generate_ddl(query, table_design):
+    """
+    Rewrites a CREATE TABLE statement with the recommended distribution and sort keys.
+    Inline DISTKEY/SORTKEY column attributes and existing table attributes are replaced.
+
+    :params query: CREATE TABLE statement from sql_queries
+    :params table_design: Recommendation for the table as returned by recommend_design
+
+    :return CREATE TABLE statement with the new table attributes
+    """
+    if table_design is None:
+        return query.strip()
+    parsed = parse_create_table(query)
+    body = query[parsed['body_start']:parsed['body_end'] + 1]
+    body = re.sub(r'\s+(?:DISTKEY|SORTKEY)\b(?!\s*\()', '', body, flags=re.IGNORECASE)
+    attributes = ['DISTSTYLE {}'.format(table_design['diststyle'])]
+    if table_design['distkey']:
+        attributes.append('DISTKEY ({})'.format(table_design['distkey']))
+    if table_design['sortkey']:
+        attributes.append('{} SORTKEY ({})'.format(table_design['sortkey_style'], ', '.join(table_design['sortkey'])))
+    return '{}{}\n    {}'.format(query[:parsed['body_start']].strip() + ' ', body, '\n    '.join(attributes))
+
+
+def get_table_rows(cur, conn, tables):
+    """
+    Reads table row counts from svv_table_info, falling back to COUNT(*) when it is not available (e.g. on Postgres)
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params tables: Names of the tables to count
+
+    :return Dict mapping table name to its row count
+    """
+    try:
+        cur.execute("SELECT \"table\", tbl_rows FROM svv_table_info WHERE schema = 'public'")
+        rows = {table: int(count) for table, count in cur.fetchall()}
+    except psycopg2.Error:
+        conn.rollback()
+        rows = {}
+    for table in tables:
+        if table not in rows:
+            cur.execute("SELECT COUNT(*) FROM {}".format(table))
+            rows[table] = cur.fetchone()[0]
+    return rows
+
+
+def plan_cost(cur, query):
+    """
+    Runs EXPLAIN for a query and returns the total cost of the top plan node
+
+    :params cur: The cursor for executing queries in the database
+    :params query: Query to explain
+
+    :return Total estimated cost
+    """
+    cur.execute("EXPLAIN {}".format(query))
+    plan = [row[0] for row in cur.fetchall()]
+    return float(re.search(r'cost=[\d.]+\.\.([\d.]+)', plan[0]).group(1))
+
+
+def compare_explain_costs(cur, conn, tables, ddl):
+    """
+    Builds the recommended tables in a separate schema with a copy of the current data and prints the
+    EXPLAIN cost of every analytic query against the current and the recommended design side by side
+
+    :params cur: The cursor for executing queries in the database
+    :params conn: The connection to the database
+    :params tables: Dict mapping table name to its parsed CREATE TABLE statement
+    :params ddl: Recommended CREATE TABLE statements in creation order
+
+    :return None
+    """
+    cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(CANDIDATE_SCHEMA))
+    cur.execute("CREATE SCHEMA {}".format(CANDIDATE_SCHEMA))
+    cur.execute("SET search_path TO {}, public".format(CANDIDATE_SCHEMA))
+    for query in ddl:
+        cur.execute(query)
+        table = parse_create_table(query)['name']
+        columns = [column for column, definition in tables[table]['columns'].items()
+                   if 'IDENTITY' not in definition.upper()]
+        cur.execute("INSERT INTO {schema}.{table} ({columns}) SELECT {columns} FROM public.{table}".format(
+            schema=CANDIDATE_SCHEMA, table=table, columns=', '.join(columns)))
+        cur.execute("ANALYZE {}.{}".format(CANDIDATE_SCHEMA, table))
+    conn.commit()
+
+    print("{:<45} {:>14} {:>14}".format('query', 'current cost', 'design cost'))
+    for title, query in zip(analytical_query_titles, analytical_queries):
+        cur.execute("SET search_path TO public")
+        current = plan_cost(cur, query)
+        cur.execute("SET search_path TO {}, public".format(CANDIDATE_SCHEMA))
+        candidate = plan_cost(cur, query)
+        print("{:<45} {:>14.2f} {:>14.2f}".format(title, current, candidate))
+    cur.execute("SET search_path TO public")
+    conn.commit()
+
+
+def main():
+    """
+    Recommends distribution and sort keys for the warehouse tables from the analytic workload in sql_queries,
+    prints the resulting DDL and optionally compares EXPLAIN costs of the current and recommended designs.
+
+    :params None
+
+    :return None
+    """
+    parser = argparse.ArgumentParser(description='Recommend Redshift DISTKEY/SORTKEY design from the query workload')
+    parser.add_argument('--stats', help='JSON file mapping table name to row count, instead of reading the cluster')
+    parser.add_argument('--small-table-rows', type=int, default=1000000,
+                        help='Tables up to this many rows are distributed with DISTSTYLE ALL')
+    parser.add_argument('--explain', action='store_true',
+                        help='Build the design in the {} schema and compare EXPLAIN costs'.format(CANDIDATE_SCHEMA))
+    parser.add_argument('--target', choices=['redshift', 'postgres'], default='redshift',
+                        help='Read row counts and plans from the Redshift cluster or the local Postgres stand-in')
+    args = parser.parse_args()
+
+    warehouse_queries = [query for query in create_table_queries if 'staging_' not in query]
+    tables = {parsed['name']: parsed for parsed in map(parse_create_table, warehouse_queries)}
+    usage = analyze_workload(analytical_queries, tables)
+
+    conn = None
+    if args.stats:
+        with open(args.stats) as f:
+            table_rows = json.load(f)
+    else:
+        conn = connect(args.target)
+        table_rows = get_table_rows(conn.cursor(), conn, tables)
+
+    design = recommend_design(tables, usage, table_rows, args.small_table_rows)
+    ddl = [generate_ddl(query, design[parse_create_table(query)['name']]) for query in warehouse_queries]
+    for table, table_design in design.items():
+        if table_design is None:
+            print("-- {}: not referenced by the workload, unchanged".format(table))
+            continue
+        print("-- {}: {} rows, DISTSTYLE {}{}{}".format(
+            table, table_rows.get(table, 0), table_design['diststyle'],
+            ', DISTKEY ({})'.format(table_design['distkey']) if table_design['distkey'] else '',
+            ', {} SORTKEY ({})'.format(table_design['sortkey_style'], ', '.join(table_design['sortkey']))
+            if table_design['sortkey'] else ''))
+    print(';\n\n'.join(ddl) + ';')
+
+    if args.explain:
+        if conn is None:
+            parser.error('--explain needs a database connection, drop --stats')
+        compare_explain_costs(conn.cursor(), conn, tables, ddl)
+    if conn is not None:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -49,6 +49,13 @@ CREATE TABLE public.staging_events (
 	userid int4
 );
 
+CREATE TABLE public.staging_load_log (
+	table_name varchar(256) NOT NULL,
+	s3_key varchar(1024) NOT NULL,
+	loaded_at timestamp NOT NULL,
+	status varchar(16) NOT NULL DEFAULT 'loaded'
+);
+
 CREATE TABLE public.staging_songs (
 	num_songs int4,
 	artist_id varchar(256),
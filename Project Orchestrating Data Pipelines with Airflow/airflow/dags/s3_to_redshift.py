@@ -1,80 +1,65 @@
 from datetime import datetime, timedelta
 import os
 from airflow import DAG
-from airflow.operators.dummy_operator import DummyOperator
-from airflow.operators import (StageToRedshiftOperator,
-                               LoadFactOperator,                             
-                                LoadDimensionOperator,
-                                 DataQualityOperator
-                            )
 
 from helpers import SqlQueries
+from helpers.dag_factory import build_load_dag
 
 default_args = {
     'owner': 'udacity',
     'depends_on_past':False,
     'retries': 0,
-    'catchup':False,
     'retry_delay': timedelta(minutes=5), 
-    'start_date': datetime(2019, 1, 12),
+    'start_date': datetime(2018, 11, 1),
+    'end_date': datetime(2018, 11, 30, 23),
 }
 
 dag = DAG('MOVE_S3_TO_REDSHIFT', default_args=default_args,
-          description='Loads and transforms data in Redshift with Airflow', schedule_interval='0 * * * *'
+          description='Loads and transforms data in Redshift with Airflow', schedule_interval='0 * * * *',
+          catchup=True, max_active_runs=1
         )
 
-start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
-stage_events_to_redshift = StageToRedshiftOperator(task_id='Stage_Events', dag=dag, table="public.staging_events",
-    redshift_conn_id="redshift", aws_credentials_id="aws_credentials", s3_bucket="udacity-dend",
-    s3_key="log_data", json="s3://udacity-dend/log_json_path.json"
-)
-stage_songs_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_Songs_In_Redshift',
-    dag=dag, table="public.staging_songs",
-    redshift_conn_id="redshift",  aws_credentials_id="aws_credentials",
-    s3_bucket="udacity-dend", s3_key="song_data/A/A/A", json="auto"
-)
-load_songplays_table = LoadFactOperator(
-    task_id='Load_SongPlays_facts_table_redshift',
-    dag=dag, redshift_conn_id="redshift",
-    table="public.songplays", truncate_table=True,
-    query=SqlQueries.songplay_table_insert
-)
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_Users_dimensions_table_to_redshift',
-    dag=dag, redshift_conn_id="redshift",
-    table="public.users", truncate_table=True,
-    query=SqlQueries.user_table_insert
-)
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_songs_dimensionsions_table_redshift',
-    dag=dag, redshift_conn_id="redshift",
-    table="public.songs", truncate_table=True,
-    query=SqlQueries.song_table_insert
-)
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dimensions_table_to_redshift',
-    dag=dag, redshift_conn_id="redshift",
-    table="public.artists", truncate_table=True,
-    query=SqlQueries.artist_table_insert
-)
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dimensions_table_to_redshift',
-    dag=dag, redshift_conn_id="redshift",
-    table="public.time",truncate_table=True,
-    query=SqlQueries.time_table_insert
-)
+# Tables in load order. Every table is loaded after the tables its query reads (FROM and JOIN), so users, songs
+# and artists load from staging in parallel with songplays, and only time waits for songplays.
+tables = [
+    # the log objects are daily, hourly runs only copy the day's file once, recorded in the load log
+    {'table': "public.staging_events", 'kind': 'stage', 'task_id': 'Stage_Events',
+     'aws_credentials_id': "aws_credentials", 's3_bucket': "udacity-dend",
+     's3_key': "log_data/{{ execution_date.strftime('%Y/%m') }}/{{ ds }}-events.json",
+     'json': "s3://udacity-dend/log_json_path.json", 'incremental': True,
+     'manifest_bucket': "{{ var.value.sparkify_manifest_bucket }}"},
+    # the three song prefixes are copied in parallel, taking three slots of the pool
+    {'table': "public.staging_songs", 'kind': 'stage', 'task_id': 'Stage_Songs_In_Redshift',
+     'aws_credentials_id': "aws_credentials", 's3_bucket': "udacity-dend",
+     's3_key': ["song_data/A/A/A", "song_data/A/A/B", "song_data/A/A/C"], 'json': "auto",
+     'incremental': True, 'manifest_bucket': "{{ var.value.sparkify_manifest_bucket }}", 'max_concurrency': 3},
+    {'table': "public.songplays", 'kind': 'fact', 'task_id': 'Load_SongPlays_facts_table_redshift',
+     'load_strategy': "window", 'query': SqlQueries.songplay_table_insert},
+    {'table': "public.users", 'kind': 'dimension', 'task_id': 'Load_Users_dimensions_table_to_redshift',
+     'load_strategy': "merge", 'primary_key': "userid", 'order_by': "ts", 'query': SqlQueries.user_table_merge},
+    {'table': "public.songs", 'kind': 'dimension', 'task_id': 'Load_songs_dimensionsions_table_redshift',
+     'load_strategy': "merge", 'primary_key': "songid", 'query': SqlQueries.song_table_insert},
+    {'table': "public.artists", 'kind': 'dimension', 'task_id': 'Load_artist_dimensions_table_to_redshift',
+     'load_strategy': "merge", 'primary_key': "artistid", 'query': SqlQueries.artist_table_insert},
+    {'table': "public.time", 'kind': 'dimension', 'task_id': 'Load_time_dimensions_table_to_redshift',
+     'load_strategy': "swap", 'query': SqlQueries.time_table_insert},
+]
 
-dq_checks=[{'check_sql': "SELECT COUNT(*) FROM users WHERE userid is null", 'expected_result': 0},
-           {'check_sql': "SELECT COUNT(*) FROM songs WHERE songid is null", 'expected_result': 0}]
-run_quality_checks = DataQualityOperator(
-    task_id='Execute_data_quality_checks',
-    dag=dag, redshift_conn_id="redshift",
-    dq_checks=dq_checks
-)
-end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
+# checks on the same table run as one query, see plugins/helpers/quality_checks.py. songplays and songs have no
+# row_count check: songplays loads one hour at a time and the backfill starts hours before the first event, and
+# songs is empty until song data is staged, so both are empty on a correct load.
+dq_checks=[{'table': 'public.songplays', 'check': 'duplicate_count', 'column': 'playid', 'value': 0},
+           {'table': 'public.songplays', 'check': 'null_count', 'column': 'userid', 'value': 0},
+           {'table': 'public.users', 'check': 'row_count', 'operator': '>', 'value': 0},
+           {'table': 'public.users', 'check': 'null_count', 'column': 'userid', 'value': 0},
+           {'table': 'public.users', 'check': 'duplicate_count', 'column': 'userid', 'value': 0},
+           {'table': 'public.users', 'check': 'null_fraction', 'column': 'level', 'operator': '<=', 'value': 0.01},
+           {'table': 'public.songs', 'check': 'null_count', 'column': 'songid', 'value': 0},
+           {'table': 'public.songs', 'check': 'duplicate_count', 'column': 'songid', 'value': 0},
+           {'table': 'public.artists', 'check': 'duplicate_count', 'column': 'artistid', 'value': 0},
+           {'table': 'public.time', 'check': 'null_count', 'column': 'start_time', 'value': 0}]
 
-start_operator >> [stage_events_to_redshift, stage_songs_to_redshift] >> \
-load_songplays_table>>[ load_user_dimension_table, load_song_dimension_table,
-                       load_artist_dimension_table, load_time_dimension_table] \
->> run_quality_checks >> end_operator
\ No newline at end of file
+# the redshift pool caps the concurrent Redshift connections, every task takes a slot per connection it opens, so
+# the pool needs at least as many slots as the largest max_concurrency. Create it with:
+# airflow pool -s redshift 4 "Redshift connections"
+tasks = build_load_dag(dag, tables, dq_checks, redshift_conn_id="redshift", pool="redshift")
@@ -0,0 +1,153 @@
+import re
+
+from airflow.operators.dummy_operator import DummyOperator
+from operators import DataQualityOperator, LoadDimensionOperator, LoadFactOperator, StageToRedshiftOperator
+
+TABLE_OPERATORS = {
+    'stage': StageToRedshiftOperator,
+    'fact': LoadFactOperator,
+    'dimension': LoadDimensionOperator,
+}
+
+TASK_PREFIXES = {
+    'stage': 'Stage',
+    'fact': 'Load_fact',
+    'dimension': 'Load_dimension',
+}
+
+
+def table_name(table):
+    """
+    Name of a table without schema and quotes
+
+    :params table: Table, optionally with its schema
+    :return Lower case table name
+    """
+    return table.rpartition('.')[2].strip('"').lower()
+
+
+def source_tables(query, tables):
+    """
+    Tables of the DAG a query reads, from the names following FROM and JOIN. Names that are not tables of the DAG,
+    like the column in extract(hour from start_time), are ignored.
+
+    :params query: SQL query
+    :params tables: Names of the tables the DAG loads
+    :return Set of table names
+    """
+    names = re.findall(r'\b(?:from|join)\s+([\w."]+)', query or '', flags=re.IGNORECASE)
+    return {table_name(name) for name in names} & set(tables)
+
+
+def table_dependencies(tables):
+    """
+    Tables every table of the config is loaded from, depends_on of the config or the tables its query reads
+
+    :params tables: Table config, see build_load_dag
+    :return Dict of table name to the set of table names it depends on
+    """
+    names = [table_name(config['table']) for config in tables]
+    dependencies = {}
+    for config in tables:
+        name = table_name(config['table'])
+        if 'depends_on' in config:
+            dependencies[name] = {table_name(table) for table in config['depends_on']}
+        else:
+            dependencies[name] = source_tables(config.get('query'), names) - {name}
+        unknown = dependencies[name] - set(names)
+        if unknown:
+            raise ValueError(f"{config['table']} depends on {', '.join(sorted(unknown))}, which the DAG does not load")
+    return dependencies
+
+
+def critical_path_weights(dependencies):
+    """
+    Priority weight of every table: the number of loads on the longest path from it to the quality checks, so the
+    scheduler starts the loads the end of the run waits on first when the pool is full
+
+    :params dependencies: Dict of table name to the set of table names it depends on
+    :return Dict of table name to priority weight
+    """
+    downstream = {name: {other for other, sources in dependencies.items() if name in sources} for name in dependencies}
+    weights = {}
+
+    def weight(name, path=()):
+        if name in path:
+            raise ValueError(f"Cyclic table dependencies: {' -> '.join(path + (name,))}")
+        if name not in weights:
+            weights[name] = 1 + max((weight(other, path + (name,)) for other in downstream[name]), default=0)
+        return weights[name]
+
+    for name in dependencies:
+        weight(name)
+    return weights
+
+
+def connection_slots(kind, arguments):
+    """
+    Redshift connections a task opens at the same time, the pool slots it takes. A staging task copies its
+    prefixes in parallel, the load log is only locked while the new objects are claimed, so it reaches one
+    connection per prefix up to max_concurrency.
+
+    :params kind: stage, fact, dimension or quality
+    :params arguments: Arguments of the task's operator
+    :return Number of connections
+    """
+    if kind not in ('stage', 'quality'):
+        return 1
+    slots = arguments.get('max_concurrency', 1 if kind == 'stage' else 4)
+    if kind == 'stage' and isinstance(arguments.get('s3_key'), (list, tuple)):
+        slots = min(slots, len(arguments['s3_key']))
+    return max(1, slots)
+
+
+def build_load_dag(dag, tables, dq_checks, redshift_conn_id="redshift", pool="redshift", dq_max_concurrency=4):
+    """
+    Adds the stage, fact, dimension and quality check tasks of a table config to a DAG. Every table is loaded
+    after the tables it reads, so loads that do not depend on each other run in parallel. All tasks using
+    Redshift run in pool, sized to the connections Redshift allows, with the critical path weighted first. Every
+    task takes a slot per connection it opens (pool_slots, Airflow 1.10.15 and later), so tasks copying or
+    checking with max_concurrency connections count them all.
+
+    :params dag: DAG to add the tasks to
+    :params tables: List of dicts with the table, its kind (stage, fact or dimension), and the arguments of its
+        operator. Optional keys: task_id, depends_on (tables it is loaded from, read from the query's FROM and JOIN
+        if not given) and priority_weight (from the critical path if not given)
+    :params dq_checks: Checks of the DataQualityOperator run after all loads
+    :params redshift_conn_id: Airflow connection of Redshift
+    :params pool: Airflow pool limiting the concurrent Redshift connections
+    :params dq_max_concurrency: Tables the quality checks run on at the same time
+    :return Dict of table name to task, with the start, quality check and end tasks under begin, quality and end
+    """
+    dependencies = table_dependencies(tables)
+    weights = critical_path_weights(dependencies)
+    start_operator = DummyOperator(task_id='Begin_execution', dag=dag)
+    tasks = {}
+    for config in tables:
+        arguments = dict(config)
+        kind = arguments.pop('kind')
+        if kind not in TABLE_OPERATORS:
+            raise ValueError(f"Unknown table kind {kind}, use one of {', '.join(TABLE_OPERATORS)}")
+        arguments.pop('depends_on', None)
+        name = table_name(config['table'])
+        arguments.setdefault('task_id', f"{TASK_PREFIXES[kind]}_{name}")
+        # absolute, Airflow's default sums the weights of all downstream tasks instead of the longest path
+        arguments.setdefault('priority_weight', weights[name])
+        arguments.setdefault('pool_slots', connection_slots(kind, arguments))
+        tasks[name] = TABLE_OPERATORS[kind](dag=dag, redshift_conn_id=redshift_conn_id, pool=pool,
+                                            weight_rule='absolute', **arguments)
+
+    dq_slots = connection_slots('quality', {'max_concurrency': dq_max_concurrency})
+    run_quality_checks = DataQualityOperator(task_id='Execute_data_quality_checks', dag=dag,
+                                             redshift_conn_id=redshift_conn_id, dq_checks=dq_checks, pool=pool,
+                                             max_concurrency=dq_max_concurrency, pool_slots=dq_slots)
+    end_operator = DummyOperator(task_id='Stop_execution', dag=dag)
+    for name, task in tasks.items():
+        for source in dependencies[name]:
+            tasks[source] >> task
+        if not dependencies[name]:
+            start_operator >> task
+        if not any(name in sources for sources in dependencies.values()):
+            task >> run_quality_checks
+    run_quality_checks >> end_operator
+    return dict(tasks, begin=start_operator, quality=run_quality_checks, end=end_operator)
@@ -0,0 +1,204 @@
+import time
+from contextlib import contextmanager
+
+LOAD_STRATEGIES = ['truncate', 'append', 'swap']
+# merge needs a primary key, only the dimension operator takes it
+DIMENSION_LOAD_STRATEGIES = LOAD_STRATEGIES + ['merge']
+# window replaces the rows of one execution window, only the fact operator takes it
+FACT_LOAD_STRATEGIES = LOAD_STRATEGIES + ['window']
+
+# LIKE keeps the distribution and sort keys on Redshift, primary keys are informational there and not copied
+create_shadow_sql = "CREATE TABLE {shadow} (LIKE {table})"
+
+
+def resolve_load_strategy(load_strategy=None, truncate_table=True, strategies=LOAD_STRATEGIES):
+    """
+    Load strategy of an operator, falling back to the older truncate_table flag
+
+    :params load_strategy: One of strategies or None
+    :params truncate_table: Whether the table is cleared when no load strategy is given
+    :params strategies: Load strategies the operator supports
+    :return Load strategy
+    """
+    strategy = load_strategy or ('truncate' if truncate_table else 'append')
+    if strategy not in strategies:
+        raise ValueError(f"Unknown load strategy {strategy}, use one of {', '.join(strategies)}")
+    return strategy
+
+
+def table_names(table, suffix):
+    """
+    Splits a table into schema and name and derives a sibling table in the same schema
+
+    :params table: Table, optionally with its schema
+    :params suffix: Suffix of the sibling table
+    :return Tuple of (schema, name, sibling table with schema)
+    """
+    schema, _, name = table.rpartition('.')
+    name = name.strip('"')
+    sibling = f'"{name}{suffix}"'
+    return schema, name, f'{schema}.{sibling}' if schema else sibling
+
+
+@contextmanager
+def table_load(redshift, table, strategy, log):
+    """
+    Yields the table the new rows are written to and logs the build time and how long readers saw no rows.
+    truncate empties the table with TRUNCATE, which does not leave deleted rows to vacuum, and readers see it
+    empty until the rows are written. append writes to the table as it is. swap writes to a shadow table and
+    then renames it over the table in one transaction, so readers see the old rows until the rename commits.
+    Views on the table have to be late binding for swap, as the old table is dropped.
+
+    :params redshift: PostgresHook of the database
+    :params table: Table to load, optionally with its schema
+    :params strategy: truncate, append or swap
+    :params log: Logger of the operator
+    """
+    start = time.perf_counter()
+    if strategy == 'truncate':
+        log.info(f'Truncating Table... {table}')
+        redshift.run(f"TRUNCATE {table}")
+        yield table
+        elapsed = time.perf_counter() - start
+        log.info(f"Loaded {table} with truncate: build {elapsed:.2f}s, readers saw an empty table for {elapsed:.2f}s")
+    elif strategy == 'swap':
+        _, name, shadow = table_names(table, '_swap')
+        _, _, old = table_names(table, '_old')
+        log.info(f'Building shadow table {shadow} of {table}')
+        redshift.run([f"DROP TABLE IF EXISTS {shadow}", create_shadow_sql.format(shadow=shadow, table=table)])
+        try:
+            yield shadow
+        except Exception:
+            redshift.run(f"DROP TABLE IF EXISTS {shadow}")
+            raise
+        built = time.perf_counter()
+        # run() commits once after all statements, the renames are seen together
+        redshift.run([f"DROP TABLE IF EXISTS {old}",
+                      f'ALTER TABLE {table} RENAME TO "{name}_old"',
+                      f'ALTER TABLE {shadow} RENAME TO "{name}"',
+                      f"DROP TABLE {old}"])
+        log.info(f"Loaded {table} with swap: build {built - start:.2f}s, readers waited at most "
+                 f"{time.perf_counter() - built:.2f}s for the rename and saw no empty table")
+    else:
+        yield table
+        log.info(f"Loaded {table} with append: build {time.perf_counter() - start:.2f}s, "
+                 f"readers saw no empty table")
+
+
+def table_columns(cursor, table):
+    """
+    Column names of a table in their order
+
+    :params cursor: Cursor of the database connection
+    :params table: Table, optionally with its schema
+    :return List of column names
+    """
+    schema, _, name = table.rpartition('.')
+    cursor.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+                   (schema or 'public', name.strip('"')))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def equal_columns(columns, left, right, null_equal=False):
+    """
+    Condition that the columns of two tables are equal, DELETE does not take an alias on Redshift so the
+    tables are referred to by name
+
+    :params columns: Column names
+    :params left: Name or alias of the first table
+    :params right: Name or alias of the second table
+    :params null_equal: Whether two NULLs are equal
+    :return SQL condition
+    """
+    conditions = []
+    for column in columns:
+        condition = f'{left}."{column}" = {right}."{column}"'
+        if null_equal:
+            condition = f'({condition} OR ({left}."{column}" IS NULL AND {right}."{column}" IS NULL))'
+        conditions.append(condition)
+    return ' AND '.join(conditions)
+
+
+def merge_table(redshift, table, query, primary_key, order_by, log):
+    """
+    Merges the rows of a query into a table in one transaction. The query's columns are named like the table's,
+    further columns can be used by order_by. The rows are deduplicated to the first row per primary key by order_by
+    descending, e.g. the latest by ts. Rows equal to the table's are dropped, then the keys left are deleted from the
+    table and their rows inserted, so only new and changed keys are written.
+
+    :params redshift: PostgresHook of the database
+    :params table: Table to merge into, optionally with its schema
+    :params query: SELECT giving the new rows
+    :params primary_key: Key column or list of key columns
+    :params order_by: Expression ordering the rows of a key, the first row is kept, the key if None
+    :params log: Logger of the operator
+    :return Tuple of (inserted, updated) row counts
+    """
+    start = time.perf_counter()
+    keys = [primary_key] if isinstance(primary_key, str) else list(primary_key)
+    _, name, _ = table_names(table, '')
+    source = f'"{name}_merge"'
+    conn = redshift.get_conn()
+    try:
+        cursor = conn.cursor()
+        columns = table_columns(cursor, table)
+        values = [column for column in columns if column not in keys]
+        partition = ', '.join(f'"{key}"' for key in keys)
+        column_list = ', '.join(f'"{column}"' for column in columns)
+
+        cursor.execute(f"""
+            CREATE TEMP TABLE {source} AS
+            SELECT * FROM (
+                SELECT query_rows.*,
+                       ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {order_by or partition} DESC) AS merge_row
+                FROM ({query}) query_rows
+            ) ranked
+            WHERE merge_row = 1""")
+        # rows equal to the table's need no write
+        cursor.execute(f"DELETE FROM {source} USING {table} target WHERE "
+                       + equal_columns(keys, source, 'target')
+                       + (' AND ' + equal_columns(values, source, 'target', null_equal=True) if values else ''))
+        cursor.execute(f'SELECT COUNT(*), COUNT(target."{keys[0]}") FROM {source} source '
+                       f"LEFT JOIN {table} target ON {equal_columns(keys, 'source', 'target')}")
+        changed, updated = cursor.fetchone()
+        cursor.execute(f"DELETE FROM {table} USING {source} source WHERE {equal_columns(keys, table, 'source')}")
+        cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {source}")
+        cursor.execute(f"DROP TABLE {source}")
+        conn.commit()
+    finally:
+        conn.close()
+    log.info(f"Merged {table} on {partition}: {changed - updated} rows inserted, {updated} rows updated "
+             f"in {time.perf_counter() - start:.2f}s")
+    return changed - updated, updated
+
+
+def window_load(redshift, table, query, column, window_start, window_end, log):
+    """
+    Replaces the rows of one window in one transaction: deletes the table's rows with column in
+    [window_start, window_end) and inserts the query's, which has to select the same window. Readers see the
+    old rows of the window until the transaction commits, the other rows are not touched.
+
+    :params redshift: PostgresHook of the database
+    :params table: Table to load, optionally with its schema
+    :params query: SELECT giving the rows of the window
+    :params column: Column the window is on, e.g. start_time
+    :params window_start: Start of the window, included
+    :params window_end: End of the window, excluded
+    :params log: Logger of the operator
+    :return Tuple of (deleted, inserted) row counts
+    """
+    start = time.perf_counter()
+    conn = redshift.get_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'DELETE FROM {table} WHERE "{column}" >= %s AND "{column}" < %s', (window_start, window_end))
+        deleted = cursor.rowcount
+        cursor.execute(f"INSERT INTO {table} {query}")
+        inserted = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    log.info(f"Loaded {table} for {column} in [{window_start}, {window_end}): {deleted} rows deleted, "
+             f"{inserted} rows inserted in {time.perf_counter() - start:.2f}s")
+    return deleted, inserted
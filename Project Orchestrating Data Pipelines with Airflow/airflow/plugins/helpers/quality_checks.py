@@ -0,0 +1,125 @@
+import operator
+from collections import OrderedDict
+from decimal import Decimal
+
+# aggregate of every check type, checks on the same table and filter are computed in one SELECT
+CHECK_EXPRESSIONS = {
+    'row_count': "COUNT(*)",
+    'null_count': "COUNT(*) - COUNT({column})",
+    'null_fraction': "CAST(COUNT(*) - COUNT({column}) AS FLOAT) / NULLIF(COUNT(*), 0)",
+    'duplicate_count': "COUNT({column}) - COUNT(DISTINCT {column})",
+    'min': "MIN({column})",
+    'max': "MAX({column})",
+    'expression': "{expression}",
+}
+
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def normalize_check(check):
+    """
+    Fills in the defaults of a check and validates it. A check is either a query with check_sql, whose first value
+    is compared, or a check type on a table, e.g. {'table': 'users', 'check': 'null_count', 'column': 'userid'}.
+    The value is compared with operator (== by default) against value, expected_result is read as value.
+
+    :params check: Dict describing the check
+    :return Dict with table, check, column, where, sql, operator and value
+    """
+    check = dict(check)
+    check.setdefault('operator', '==')
+    check.setdefault('value', check.pop('expected_result', None))
+    if check['operator'] not in COMPARISONS:
+        raise ValueError(f"Unknown operator {check['operator']}, use one of {', '.join(COMPARISONS)}")
+    if 'check_sql' in check:
+        check.update(table=None, check='sql', column=None, where=None, sql=check['check_sql'])
+        return check
+    if check.get('check') not in CHECK_EXPRESSIONS:
+        raise ValueError(f"Unknown check {check.get('check')}, use one of {', '.join(CHECK_EXPRESSIONS)} or check_sql")
+    if not check.get('table'):
+        raise ValueError(f"The {check['check']} check needs a table")
+    check.setdefault('column', None)
+    check.setdefault('where', None)
+    check['sql'] = CHECK_EXPRESSIONS[check['check']].format(column=check['column'],
+                                                            expression=check.get('expression'))
+    return check
+
+
+def group_checks(checks):
+    """
+    Groups checks that can be computed in one scan, those on the same table with the same filter. check_sql
+    checks are groups of their own.
+
+    :params checks: Normalized checks
+    :return List of lists of checks
+    """
+    groups = OrderedDict()
+    for index, check in enumerate(checks):
+        key = ('sql', index) if check['check'] == 'sql' else (check['table'], check['where'])
+        groups.setdefault(key, []).append(check)
+    return list(groups.values())
+
+
+def group_query(checks):
+    """
+    SELECT computing the checks of one group
+
+    :params checks: Checks of a group as returned by group_checks
+    :return SQL query giving one row with a value per check
+    """
+    if checks[0]['check'] == 'sql':
+        return checks[0]['sql']
+    where = f" WHERE {checks[0]['where']}" if checks[0]['where'] else ''
+    aggregates = ',\n       '.join(check['sql'] for check in checks)
+    return f"SELECT {aggregates}\nFROM {checks[0]['table']}{where}"
+
+
+def to_value(value):
+    """
+    Converts a value of the database to one that is JSON serializable for XCom
+
+    :params value: Value of a record
+    :return int, float, str or None
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+def evaluate(check, actual):
+    """
+    Compares the value of a check against its expectation
+
+    :params check: Normalized check
+    :params actual: Value computed by the database
+    :return Result row with table, check, column, operator, expected, actual and passed
+    """
+    actual = to_value(actual)
+    try:
+        passed = actual is not None and COMPARISONS[check['operator']](actual, check['value'])
+    except TypeError:
+        passed = False
+    return {'table': check['table'], 'check': check['check'], 'column': check['column'], 'sql': check['sql'],
+            'operator': check['operator'], 'expected': check['value'], 'actual': actual, 'passed': passed}
+
+
+def format_results(results):
+    """
+    Formats results as a text table for the task log
+
+    :params results: Result rows as returned by evaluate
+    :return Text table
+    """
+    header = ['table', 'check', 'column', 'operator', 'expected', 'actual', 'passed']
+    rows = [header] + [[str(result['table'] if result['table'] else result['sql'].strip()[:40])] +
+                       [str(result[name]) for name in header[1:]] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
@@ -1,4 +1,5 @@
 class SqlQueries:
+    # rows of one execution window, the LoadFactOperator fills in window_start and window_end
     songplay_table_insert = ("""
         SELECT
                 md5(events.sessionid || events.start_time) songplay_id,
@@ -17,6 +18,7 @@ class SqlQueries:
             ON events.song = songs.title
                 AND events.artist = songs.artist_name
                 AND events.length = songs.duration
+            WHERE events.start_time >= '{window_start}' AND events.start_time < '{window_end}'
     """)
 
     user_table_insert = ("""
@@ -25,13 +27,21 @@ class SqlQueries:
         WHERE page='NextSong'
     """)
 
+    # every event of a user, the merge keeps the latest by ts so a level change updates the user
+    user_table_merge = ("""
+        SELECT userid, firstname AS first_name, lastname AS last_name, gender, level, ts
+        FROM staging_events
+        WHERE page='NextSong' AND userid IS NOT NULL
+    """)
+
     song_table_insert = ("""
-        SELECT distinct song_id, title, artist_id, year, duration
+        SELECT distinct song_id AS songid, title, artist_id AS artistid, year, duration
         FROM staging_songs
     """)
 
     artist_table_insert = ("""
-        SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        SELECT distinct artist_id AS artistid, artist_name AS name, artist_location AS location,
+               artist_latitude AS lattitude, artist_longitude AS longitude
         FROM staging_songs
     """)
 
@@ -0,0 +1,181 @@
+import csv
+import gzip
+import io
+import json
+import os
+import re
+
+from airflow.hooks.S3_hook import S3Hook
+
+FILE_FORMATS = ['json', 'csv', 'parquet']
+NULL_MARKER = '\\N'
+NUMERIC_TYPES = {'smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision'}
+
+
+def copy_options(file_format, json_paths='auto', ignore_headers=1, compression=None, manifest=False):
+    """
+    Format options of a Redshift COPY
+
+    :params file_format: json, csv or parquet
+    :params json_paths: auto or the S3 URL of a JSONPaths file, for json
+    :params ignore_headers: Header rows to skip, for csv
+    :params compression: gzip or None
+    :params manifest: Whether the source is a manifest
+    :return Options to append to COPY ... FROM
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unknown file format {file_format}, use one of {', '.join(FILE_FORMATS)}")
+    if file_format == 'parquet' and compression:
+        raise ValueError("Parquet files are compressed internally, COPY does not take a compression for them")
+    options = {
+        'json': [f"FORMAT AS JSON '{json_paths}'"],
+        'csv': ['CSV', f'IGNOREHEADER {ignore_headers}'],
+        'parquet': ['FORMAT AS PARQUET'],
+    }[file_format]
+    if compression == 'gzip':
+        options.append('GZIP')
+    if manifest:
+        options.append('MANIFEST')
+    return ' '.join(options)
+
+
+def build_manifest(bucket, keys):
+    """
+    Redshift COPY manifest of the given objects
+
+    :params bucket: Bucket of the objects
+    :params keys: Object keys
+    :return Manifest as JSON
+    """
+    return json.dumps({'entries': [{'url': f's3://{bucket}/{key}', 'mandatory': True} for key in keys]}, indent=2)
+
+
+def split_url(url):
+    """
+    Splits an S3 URL into bucket and key
+
+    :params url: s3://bucket/key
+    :return Tuple of (bucket, key)
+    """
+    bucket, _, key = re.sub(r'^s3a?://', '', url).partition('/')
+    return bucket, key
+
+
+class S3Storage:
+    """
+    Objects on S3, through the S3Hook of an AWS connection
+    """
+
+    def __init__(self, aws_conn_id):
+        self.hook = S3Hook(aws_conn_id=aws_conn_id)
+
+    def list_keys(self, bucket, prefix):
+        return sorted(self.hook.list_keys(bucket_name=bucket, prefix=prefix) or [])
+
+    def write(self, bucket, key, text):
+        self.hook.load_string(text, key, bucket_name=bucket, replace=True)
+
+
+class LocalStorage:
+    """
+    Local directory standing in for S3, the object s3://bucket/key is the file root/bucket/key
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_keys(self, bucket, prefix):
+        bucket_root = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(prefix) and not name.startswith('.'):
+                    keys.append(key)
+        return sorted(keys)
+
+    def write(self, bucket, key, text):
+        path = os.path.join(self.root, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, url):
+        bucket, key = split_url(url)
+        with open(os.path.join(self.root, bucket, key), 'rb') as f:
+            return f.read()
+
+
+def read_records(content, file_format, compression=None, ignore_headers=1):
+    """
+    Records of one object: dicts for JSON lines and Parquet, lists in column order for CSV
+
+    :params content: Bytes of the object
+    :params file_format: json, csv or parquet
+    :params compression: gzip or None
+    :params ignore_headers: Header rows to skip, for csv
+    :return List of records
+    """
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        return pq.read_table(io.BytesIO(content)).to_pylist()
+    if compression == 'gzip':
+        content = gzip.decompress(content)
+    text = content.decode('utf-8')
+    if file_format == 'csv':
+        return list(csv.reader(io.StringIO(text)))[ignore_headers:]
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def copy_from_local(cursor, table, storage, source, file_format='json', json_paths='auto', ignore_headers=1,
+                    compression=None, manifest=False):
+    """
+    Emulates a Redshift COPY on Postgres: reads the objects below a prefix or listed in a manifest from a
+    LocalStorage and streams them into the table with COPY FROM STDIN. JSON keys are matched to the columns
+    through the JSONPaths file, or by name ignoring case for auto.
+
+    :params cursor: Cursor of the Postgres connection
+    :params table: Table to load, optionally with its schema
+    :params storage: LocalStorage holding the objects
+    :params source: s3:// URL of the prefix or of the manifest
+    :params file_format: json, csv or parquet
+    :params json_paths: auto or the S3 URL of a JSONPaths file, for json
+    :params ignore_headers: Header rows to skip, for csv
+    :params compression: gzip or None
+    :params manifest: Whether the source is a manifest
+    :return Number of rows loaded
+    """
+    if manifest:
+        urls = [entry['url'] for entry in json.loads(storage.read(source).decode('utf-8'))['entries']]
+    else:
+        bucket, prefix = split_url(source)
+        urls = [f's3://{bucket}/{key}' for key in storage.list_keys(bucket, prefix)]
+
+    schema, _, table_name = table.rpartition('.')
+    cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                   "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+                   (schema or 'public', table_name.strip('"')))
+    columns = cursor.fetchall()
+    if json_paths and json_paths != 'auto':
+        paths = json.loads(storage.read(json_paths).decode('utf-8'))['jsonpaths']
+        keys = [re.sub(r"^\$\.|^\$\['|'\]$", '', path) for path in paths]
+    else:
+        keys = [name for name, _ in columns]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = 0
+    for url in urls:
+        for record in read_records(storage.read(url), file_format, compression, ignore_headers):
+            if isinstance(record, dict):
+                lowered = {key.lower(): value for key, value in record.items()}
+                record = [lowered.get(key.lower()) for key in keys]
+            # COPY reads empty numeric fields as NULL
+            writer.writerow([NULL_MARKER if value is None or (value == '' and data_type in NUMERIC_TYPES) else value
+                             for value, (_, data_type) in zip(record, columns)])
+            rows += 1
+    buffer.seek(0)
+    column_list = ', '.join(f'"{name}"' for name, _ in columns)
+    cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{NULL_MARKER}')", buffer)
+    return rows
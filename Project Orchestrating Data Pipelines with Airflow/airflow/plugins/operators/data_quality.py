@@ -1,27 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers.quality_checks import evaluate, format_results, group_checks, group_query, normalize_check
 
 class DataQualityOperator(BaseOperator):
+    """
+    Runs data quality checks, see helpers/quality_checks.py for their format. Checks on the same table and filter
+    are computed in one SELECT, and up to max_concurrency tables are checked at the same time. The results are
+    pushed to XCom as dq_results, and the task fails if any check does not pass.
+    """
     ui_color = '#89DA59'
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  dq_checks=[],
+                 max_concurrency=4,
                  *args, **kwargs):
         super(DataQualityOperator, self).__init__(*args, **kwargs)
-        self.checks=dq_checks
+        self.checks=[normalize_check(check) for check in dq_checks]
         self.redshift_conn_id = redshift_conn_id
+        self.max_concurrency = max_concurrency
+
+    def run_group(self, redshift_hook, checks):
+        sql = group_query(checks)
+        self.log.info(f"Running {len(checks)} checks with {sql}")
+        records = redshift_hook.get_records(sql)
+        if not records or len(records[0]) < len(checks):
+            raise ValueError(f"Data quality check returned no results: {sql}")
+        return [evaluate(check, value) for check, value in zip(checks, records[0])]
 
     def execute(self, context):
-        redshift_hook = PostgresHook("redshift")
-        for check in dq_checks:
-            sql = check["check_sql"]
-            exp = check["expected_result"]
-            records = redshift_hook.get_records(sql)
-            num_records = records[0][0]
-            if num_records != exp:
-                raise ValueError(f"Data quality check not succeeded. Expected: {exp} | Got: {num_records}")
-            else:
-                self.log.info(f"Data quality on SQL {sql} check succeeded with {records[0][0]} records")
-       
\ No newline at end of file
+        redshift_hook = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        groups = group_checks(self.checks)
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) as executor:
+            futures = [executor.submit(self.run_group, redshift_hook, group) for group in groups]
+            results = [result for future in futures for result in future.result()]
+        self.log.info(f"Data quality results of {len(results)} checks in {len(groups)} queries:\n"
+                      f"{format_results(results)}")
+        context['task_instance'].xcom_push(key='dq_results', value=results)
+
+        failed = [result for result in results if not result['passed']]
+        if failed:
+            raise ValueError("Data quality check not succeeded: " + '; '.join(
+                f"{result['table'] or result['sql'].strip()} {result['check']}"
+                f"{' ' + result['column'] if result['column'] else ''}: "
+                f"expected {result['operator']} {result['expected']} | Got: {result['actual']}" for result in failed))
@@ -1,6 +1,7 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers.load_strategy import DIMENSION_LOAD_STRATEGIES, merge_table, resolve_load_strategy, table_load
 
 class LoadDimensionOperator(BaseOperator):
     ui_color = '#80BD9E'
@@ -10,17 +11,27 @@ class LoadDimensionOperator(BaseOperator):
                  table="",
                  truncate_table=True,
                  query="",
+                 load_strategy=None,
+                 primary_key=None,
+                 order_by=None,
                  *args, **kwargs):
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
         self.table=table
         self.redshift_conn_id = redshift_conn_id
         self.truncate_table=truncate_table
         self.query=query
-        
+        self.load_strategy=resolve_load_strategy(load_strategy, truncate_table, DIMENSION_LOAD_STRATEGIES)
+        if self.load_strategy == 'merge' and not primary_key:
+            raise ValueError(f"Merging into {table} needs its primary_key")
+        self.primary_key=primary_key
+        self.order_by=order_by
+
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        if self.truncate_table:
-            self.log.info(f'Truncating Table... {self.table}')
-            redshift.run("DELETE FROM {}".format(self.table))
-        self.log.info(f'Executing query {self.query}')
-        redshift.run(f"Insert into {self.table} {self.query}")
+        if self.load_strategy == 'merge':
+            self.log.info(f'Merging query {self.query}')
+            merge_table(redshift, self.table, self.query, self.primary_key, self.order_by, self.log)
+            return
+        with table_load(redshift, self.table, self.load_strategy, self.log) as target:
+            self.log.info(f'Executing query {self.query}')
+            redshift.run(f"Insert into {target} {self.query}")
@@ -1,26 +1,46 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers.load_strategy import FACT_LOAD_STRATEGIES, resolve_load_strategy, table_load, window_load
 
 class LoadFactOperator(BaseOperator):
+    """
+    Loads a fact table from a query. With load_strategy window only the rows of the execution window are deleted
+    and inserted, so a backfill loads every interval once. The query selects the window's rows with the
+    placeholders {window_start} and {window_end}, e.g. SqlQueries.songplay_table_insert.
+    """
     ui_color = '#F98866'
+    template_fields = ("window_start", "window_end")
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  table="",
                  truncate_table=True,
                  query="",
+                 load_strategy=None,
+                 window_column="start_time",
+                 window_start="{{ execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
+                 window_end="{{ next_execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
                  *args, **kwargs):
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.table=table
         self.redshift_conn_id = redshift_conn_id
         self.truncate_table=truncate_table
         self.query=query
+        self.load_strategy=resolve_load_strategy(load_strategy, truncate_table, FACT_LOAD_STRATEGIES)
+        if self.load_strategy != 'window' and '{window_start}' in query:
+            raise ValueError(f"The query of {table} selects one window, use load_strategy window")
+        self.window_column=window_column
+        self.window_start=window_start
+        self.window_end=window_end
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        if self.truncate_table:
-            self.log.info(f'Truncating Table... {self.table}')
-            redshift.run("DELETE FROM {}".format(self.table))
-        self.log.info(f'Execusing query... {self.query}')
-        redshift.run(f"Insert into {self.table} {self.query}")
-        
+        if self.load_strategy == 'window':
+            query = self.query.format(window_start=self.window_start, window_end=self.window_end)
+            self.log.info(f'Execusing query... {query}')
+            window_load(redshift, self.table, query, self.window_column, self.window_start, self.window_end,
+                        self.log)
+            return
+        with table_load(redshift, self.table, self.load_strategy, self.log) as target:
+            self.log.info(f'Execusing query... {self.query}')
+            redshift.run(f"Insert into {target} {self.query}")
@@ -1,17 +1,50 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.contrib.hooks.aws_hook import AwsHook
+from helpers.load_strategy import resolve_load_strategy, table_load
+from helpers.staging import LocalStorage, S3Storage, build_manifest, copy_from_local, copy_options
+
+
 class StageToRedshiftOperator(BaseOperator):
-    template_fields=("s3_key",)
+    """
+    Copies JSON, CSV or Parquet objects from S3 into a staging table. s3_key is a templated prefix or a list of
+    disjoint prefixes, which are copied concurrently with up to max_concurrency connections.
+    In incremental mode the table is not cleared: only the objects below the prefixes that are not in the load log
+    table yet are copied, through a COPY manifest written to manifest_bucket, and then recorded in the load log.
+    The new objects are first claimed in the load log in a short transaction holding its lock, so concurrent runs
+    never copy an object twice, while the COPYs themselves run in parallel. A claim is marked loaded in the COPY's
+    transaction and deleted if the COPY fails. Claims older than claim_timeout, left by a run that died, are
+    claimed again.
+    With local_root the objects are read from a local directory standing in for S3 (root/bucket/key) and the COPY
+    is emulated, so the operator runs against a local Postgres.
+    load_strategy truncate or swap replaces the table's rows, incremental mode appends.
+    """
+    template_fields = ("s3_key", "manifest_bucket")
     ui_color = '#358140'
     copy_sql = """
-        COPY {} FROM '{}' ACCESS_KEY_ID '{}' SECRET_ACCESS_KEY '{}' json '{}';
+        COPY {} FROM '{}' ACCESS_KEY_ID '{}' SECRET_ACCESS_KEY '{}' {};
     """
+    claimed_keys_sql = "SELECT s3_key FROM {} WHERE table_name = %s AND (status = 'loaded' OR loaded_at > %s)"
+    release_stale_sql = "DELETE FROM {} WHERE table_name = %s AND status = 'claimed' AND loaded_at <= %s"
+    claim_sql = "INSERT INTO {} (table_name, s3_key, loaded_at, status) VALUES %s"
+    mark_loaded_sql = ("UPDATE {} SET status = 'loaded', loaded_at = %s "
+                       "WHERE table_name = %s AND status = 'claimed' AND s3_key IN %s")
+    release_sql = "DELETE FROM {} WHERE table_name = %s AND status = 'claimed' AND s3_key IN %s"
 
     @apply_defaults
     def __init__(self, redshift_conn_id="", aws_credentials_id="", table="", s3_bucket="",
-                 s3_key="", json="auto", ignore_headers=1, *args, **kwargs):
+                 s3_key="", json="auto", ignore_headers=1, file_format="json", compression=None,
+                 incremental=False, manifest_bucket="", manifest_prefix="manifests",
+                 load_log_table="public.staging_load_log", max_concurrency=1, local_root=None,
+                 load_strategy=None, claim_timeout=timedelta(hours=6), *args, **kwargs):
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
         self.table = table
         self.redshift_conn_id = redshift_conn_id
@@ -20,17 +53,107 @@ class StageToRedshiftOperator(BaseOperator):
         self.json = json
         self.ignore_headers = ignore_headers
         self.aws_credentials_id = aws_credentials_id
+        self.file_format = file_format
+        self.compression = compression
+        self.incremental = incremental
+        self.manifest_bucket = manifest_bucket
+        self.manifest_prefix = manifest_prefix
+        self.load_log_table = load_log_table
+        self.max_concurrency = max_concurrency
+        self.local_root = local_root
+        self.claim_timeout = claim_timeout
+        self.load_strategy = resolve_load_strategy(load_strategy, truncate_table=not incremental)
+        if incremental and self.load_strategy != 'append':
+            raise ValueError("Incremental staging keeps the rows loaded before, use load_strategy append")
 
     def execute(self, context):
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        self.log.info("Deleting data from destination Redshift table")
-        redshift.run("DELETE FROM {}".format(self.table))
-        self.log.info("Moving data from S3 to Redshift")
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
-        formatted_sql = StageToRedshiftOperator.copy_sql.format( self.table, s3_path, credentials.access_key, 
-                                                                credentials.secret_key, self.json
-        )
-        redshift.run(formatted_sql)
\ No newline at end of file
+        if self.local_root:
+            storage, credentials = LocalStorage(self.local_root), None
+        else:
+            storage, credentials = S3Storage(self.aws_credentials_id), AwsHook(self.aws_credentials_id).get_credentials()
+
+        keys = [self.s3_key] if isinstance(self.s3_key, str) else list(self.s3_key)
+        rendered_keys = [key.format(**context) for key in keys]
+        self.log.info(f"Moving data from S3 to Redshift: {len(rendered_keys)} prefixes, "
+                      f"{min(self.max_concurrency, len(rendered_keys))} at a time")
+        with table_load(redshift, self.table, self.load_strategy, self.log) as target, \
+                ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) as executor:
+            futures = [executor.submit(self.load_prefix, redshift, storage, credentials, target, key, context)
+                       for key in rendered_keys]
+            # result() raises the error of a failed load
+            for future in futures:
+                future.result()
+
+    def claim_keys(self, redshift, storage, prefix):
+        # listed before locking, the lock is only held to read the load log and write the claims
+        listed = storage.list_keys(self.s3_bucket, prefix)
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"LOCK {self.load_log_table}")
+            stale = datetime.utcnow() - self.claim_timeout
+            cursor.execute(self.release_stale_sql.format(self.load_log_table), (self.table, stale))
+            cursor.execute(self.claimed_keys_sql.format(self.load_log_table), (self.table, stale))
+            claimed = {row[0] for row in cursor.fetchall()}
+            keys = [key for key in listed if key not in claimed]
+            if keys:
+                claimed_at = datetime.utcnow()
+                execute_values(cursor, self.claim_sql.format(self.load_log_table),
+                               [(self.table, key, claimed_at, 'claimed') for key in keys])
+            conn.commit()
+        finally:
+            conn.close()
+        return keys
+
+    def release_keys(self, redshift, keys):
+        conn = redshift.get_conn()
+        try:
+            conn.cursor().execute(self.release_sql.format(self.load_log_table), (self.table, tuple(keys)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def load_prefix(self, redshift, storage, credentials, target, prefix, context):
+        start = time.perf_counter()
+        options = copy_options(self.file_format, self.json, self.ignore_headers, self.compression,
+                               manifest=self.incremental)
+        keys = []
+        if self.incremental:
+            keys = self.claim_keys(redshift, storage, prefix)
+            if not keys:
+                self.log.info(f"No new objects below s3://{self.s3_bucket}/{prefix}")
+                return
+        try:
+            if self.incremental:
+                manifest_bucket = self.manifest_bucket or self.s3_bucket
+                manifest_key = "{}/{}/{}-{}.manifest".format(self.manifest_prefix, self.table, context['ts_nodash'],
+                                                             hashlib.md5(prefix.encode('utf-8')).hexdigest()[:8])
+                storage.write(manifest_bucket, manifest_key, build_manifest(self.s3_bucket, keys))
+                self.log.info(f"{len(keys)} new objects below s3://{self.s3_bucket}/{prefix}")
+                source = f"s3://{manifest_bucket}/{manifest_key}"
+            else:
+                source = "s3://{}/{}".format(self.s3_bucket, prefix)
+
+            conn = redshift.get_conn()
+            try:
+                cursor = conn.cursor()
+                if self.local_root:
+                    copy_from_local(cursor, target, storage, source, self.file_format, self.json,
+                                    self.ignore_headers, self.compression, manifest=self.incremental)
+                else:
+                    cursor.execute(StageToRedshiftOperator.copy_sql.format(target, source, credentials.access_key,
+                                                                           credentials.secret_key, options))
+                # marked loaded in the COPY's transaction, the rows and the load log commit together
+                if keys:
+                    cursor.execute(self.mark_loaded_sql.format(self.load_log_table),
+                                   (datetime.utcnow(), self.table, tuple(keys)))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            # a failed COPY leaves its objects to the next run
+            if keys:
+                self.release_keys(redshift, keys)
+            raise
+        self.log.info(f"Copied {source} into {target} in {time.perf_counter() - start:.2f}s")